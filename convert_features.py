@@ -0,0 +1,16 @@
+# python peripherals
+import argparse
+
+# gipmed
+from wsi.utils.features_store import convert_h5_features
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a directory of per slide *_features.h5 files into a memory-mapped features store.')
+    parser.add_argument('--features-dir', type=str, required=True)
+    parser.add_argument('--store-dir', type=str, required=True)
+    parser.add_argument('--dtype', type=str, default=None, choices=['float16', 'float32'])
+    args = parser.parse_args()
+
+    store = convert_h5_features(features_dir=args.features_dir, store_dir=args.store_dir, dtype=args.dtype)
+    print(f'Saved {len(store.slide_names)} slides and {store.features.shape[0]} tiles to {args.store_dir}')
@@ -0,0 +1,28 @@
+# python peripherals
+from pathlib import Path
+from multiprocessing import Pool
+import argparse
+
+# gipmed
+from wsi.core.h5_tiles import convert_h5_tile_layout
+
+
+def convert(path: Path):
+    try:
+        convert_h5_tile_layout(src_path=path)
+        return path, None
+    except Exception as e:
+        return path, e
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert slide h5 files from the per tile group layout to the contiguous tiles layout, in place.')
+    parser.add_argument('--h5-dir-path', type=str, required=True)
+    parser.add_argument('--num-workers', type=int, default=8)
+    args = parser.parse_args()
+
+    paths = sorted(Path(args.h5_dir_path).glob('*.h5'))
+    with Pool(processes=args.num_workers) as pool:
+        for path, error in pool.imap_unordered(convert, paths):
+            if error is not None:
+                print(f'{path} was not converted: {error}')
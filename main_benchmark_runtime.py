@@ -0,0 +1,26 @@
+# python peripherals
+import argparse
+import json
+
+# gipmed
+from wsi.runtime import PatchRuntime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the CPU throughput in tiles/s of an artifact exported by main_export.py, needs only torch and numpy (and onnxruntime for ONNX).')
+    parser.add_argument('--artifact-path', type=str, required=True)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[16, 64, 256])
+    parser.add_argument('--num-threads', type=int, nargs='+', default=[None], help='intra-op threads, all cores by default')
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=3)
+    parser.add_argument('--stats-path', type=str, default=None, help='json file for the throughput stats')
+    args = parser.parse_args()
+
+    results = []
+    for num_threads in args.num_threads:
+        for batch_size in args.batch_sizes:
+            runtime = PatchRuntime(args.artifact_path, num_threads=num_threads, batch_size=batch_size)
+            results.append(runtime.benchmark(batches=args.batches, warmup=args.warmup))
+    if args.stats_path is not None:
+        with open(args.stats_path, 'w') as file:
+            json.dump(results, file, indent=2)
@@ -0,0 +1,52 @@
+# python peripherals
+import argparse
+import json
+
+# gipmed
+from wsi.datasets.datamodules import NORMALIZATIONS
+from wsi.export import export_patch_scorer
+from wsi.runtime import PatchRuntime
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export a trained WsiClassifier or WsiRegressor backbone and head to a TorchScript or ONNX artifact for the CPU runtime (wsi/runtime.py), check its parity with the checkpoint and benchmark it.')
+    parser.add_argument('--ckpt-path', type=str, required=True)
+    parser.add_argument('--output-path', type=str, required=True)
+    parser.add_argument('--task', type=str, default='classifier', choices=['classifier', 'regressor'])
+    parser.add_argument('--format', type=str, default='torchscript', choices=['torchscript', 'onnx'])
+    parser.add_argument('--normalization', type=str, default='cat', choices=list(NORMALIZATIONS))
+    parser.add_argument('--img-size', type=int, default=256)
+    parser.add_argument('--no-fold', action='store_true', help='keep the batch norms unfolded')
+    parser.add_argument('--atol', type=float, default=1e-3, help='max allowed score difference from the checkpoint')
+    parser.add_argument('--benchmark-batches', type=int, default=20, help='0 skips the benchmark')
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--num-threads', type=int, default=None)
+    args = parser.parse_args()
+
+    # the regressor imports wsi_ssl, only needed for regressor checkpoints
+    if args.task == 'classifier':
+        from wsi.wsi_classifier import WsiClassifier
+        model = WsiClassifier.load_from_checkpoint(args.ckpt_path, map_location='cpu').eval()
+        head = model.classifier
+    else:
+        from wsi.wsi_regressor import WsiRegressor
+        model = WsiRegressor.load_from_checkpoint(args.ckpt_path, map_location='cpu').eval()
+        head = model.regressor
+
+    metadata = export_patch_scorer(
+        model.backbone,
+        head,
+        args.output_path,
+        mean=NORMALIZATIONS[args.normalization]['mean'],
+        std=NORMALIZATIONS[args.normalization]['std'],
+        img_size=args.img_size,
+        softmax=args.task == 'classifier',
+        export_format=args.format,
+        fold=not args.no_fold,
+        metadata={'task': args.task, 'model': model.hparams.model, 'normalization': args.normalization, 'ckpt_path': args.ckpt_path},
+        atol=args.atol,
+    )
+    print(json.dumps(metadata, indent=2))
+
+    if args.benchmark_batches > 0:
+        PatchRuntime(args.output_path, num_threads=args.num_threads, batch_size=args.batch_size).benchmark(batches=args.benchmark_batches)
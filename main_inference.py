@@ -0,0 +1,67 @@
+# python peripherals
+import argparse
+import json
+
+# torch
+import torch
+
+# gipmed
+from wsi.datasets.datamodules import NORMALIZATIONS
+from wsi.datasets.datasets import create_slides_manager
+from wsi.inference import SlideInference
+from wsi.wsi_classifier import WsiClassifier
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score every tile of every slide with a trained WsiClassifier and write a score grid per slide.')
+    parser.add_argument('--ckpt-path', type=str, required=True)
+    parser.add_argument('--output-dir', type=str, required=True)
+    parser.add_argument('--datasets-folds', type=json.loads, default={'CAT': [1]})
+    parser.add_argument('--target', type=str, default='none', help='none scores all slides, a target only the slides labeled for it')
+    parser.add_argument('--metadata-file-path', type=str, default=None)
+    parser.add_argument('--datasets-base-dir-path', type=str, default=None)
+    parser.add_argument('--min-tiles', type=int, default=0)
+    parser.add_argument('--normalization', type=str, default='cat', choices=list(NORMALIZATIONS))
+    parser.add_argument('--img-size', type=int, default=256)
+    parser.add_argument('--chunk-size', type=int, default=512, help='tiles per read and per forward')
+    parser.add_argument('--num-workers', type=int, default=8)
+    parser.add_argument('--prefetch-factor', type=int, default=4)
+    parser.add_argument('--writer-threads', type=int, default=4)
+    parser.add_argument('--format', type=str, default='h5', choices=['h5', 'npy'])
+    parser.add_argument('--overlay', action='store_true', help='also write a downsampled overlay png per slide')
+    parser.add_argument('--thumbnail-size', type=int, default=8, help='overlay pixels per tile')
+    parser.add_argument('--overlay-class', type=int, default=1)
+    parser.add_argument('--no-autocast', action='store_true')
+    parser.add_argument('--stats-path', type=str, default=None, help='json file for the throughput stats')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = WsiClassifier.load_from_checkpoint(args.ckpt_path, map_location=device)
+    slides_manager = create_slides_manager(
+        datasets_folds=args.datasets_folds,
+        target=args.target,
+        min_tiles=args.min_tiles,
+        metadata_file_path=args.metadata_file_path,
+        datasets_base_dir_path=args.datasets_base_dir_path,
+    )
+
+    inference = SlideInference(
+        model,
+        mean=NORMALIZATIONS[args.normalization]['mean'],
+        std=NORMALIZATIONS[args.normalization]['std'],
+        img_size=args.img_size,
+        chunk_size=args.chunk_size,
+        num_workers=args.num_workers,
+        prefetch_factor=args.prefetch_factor,
+        file_format=args.format,
+        overlay=args.overlay,
+        thumbnail_size=args.thumbnail_size,
+        overlay_class=args.overlay_class,
+        writer_threads=args.writer_threads,
+        device=device,
+        autocast=not args.no_autocast,
+    )
+    stats = inference.run(slides_manager, args.output_dir)
+    if args.stats_path is not None:
+        with open(args.stats_path, 'w') as file:
+            json.dump(stats, file, indent=2)
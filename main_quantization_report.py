@@ -0,0 +1,116 @@
+# python peripherals
+import argparse
+import json
+
+# numpy / torch
+import numpy as np
+import torch
+from sklearn.metrics import roc_auc_score
+from torch.utils.data import DataLoader
+
+# gipmed
+from wsi.core import constants
+from wsi.datasets.datasets import create_slides_manager
+from wsi.datasets.features_datasets import SlideGridFeaturesDataset
+from wsi.mil_transformer_classifier import MilTransformerClassifier
+from wsi.utils.features_store import open_features_reader
+from wsi.utils.quantization import QuantizedRoundTripReader, dequantize_int8, quantization_axes
+
+
+def get_slide_scores(model, dataset, batch_size, device, seed):
+    # the same seed gives every features variant the same grids
+    np.random.seed(seed)
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, num_workers=0)
+    slide_scores, slide_labels = {}, {}
+    with torch.no_grad():
+        for batch in loader:
+            scores = model(batch["features"].to(device)).softmax(1)[:, 1].cpu().numpy()
+            for slide_name, score, label in zip(batch["slide_name"], scores, batch["label"].numpy()):
+                slide_scores.setdefault(slide_name, []).append(score)
+                slide_labels[slide_name] = label
+    slide_names = sorted(slide_scores)
+    return (
+        np.array([np.mean(slide_scores[name]) for name in slide_names]),
+        np.array([slide_labels[name] for name in slide_names]),
+    )
+
+
+def get_float_features(reader, slide_name, rows):
+    features = reader.get_features(slide_name, rows)
+    quantization = reader.get_quantization(slide_name)
+    if quantization is not None:
+        features = dequantize_int8(features, *quantization)
+    return features.astype(np.float32)
+
+
+def get_cosine_similarities(float_reader, reader, slide_names):
+    # per tile, the tiles of a slide are matched by their coords
+    similarities = []
+    for slide_name in slide_names:
+        coords = float_reader.get_coords(slide_name)
+        rows = reader.lookup(slide_name, coords)
+        found = rows >= 0
+        a = get_float_features(float_reader, slide_name, np.flatnonzero(found))
+        b = get_float_features(reader, slide_name, rows[found])
+        norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+        similarities.append((a * b).sum(axis=1) / np.maximum(norms, 1e-12))
+    return np.concatenate(similarities)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the slide AUC of a MIL transformer on float32 features, on the same features after an int8 quantization round trip and optionally on features extracted by a statically quantized int8 backbone, with the cosine similarity of every variant to the float32 features.')
+    parser.add_argument('--ckpt-path', type=str, required=True)
+    parser.add_argument('--features-dir', type=str, required=True)
+    parser.add_argument('--static-int8-features-dir', type=str, default=None, help='features of the same tiles extracted with model.static_quantization')
+    parser.add_argument('--datasets-folds', type=json.loads, default={'CAT': [1]})
+    parser.add_argument('--target', type=str, default='er_status')
+    parser.add_argument('--metadata-file-path', type=str, default=None)
+    parser.add_argument('--min-tiles', type=int, default=100)
+    parser.add_argument('--bags-per-slide', type=int, default=4)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    model = MilTransformerClassifier.load_from_checkpoint(args.ckpt_path, map_location=device).eval()
+    side_length = int(model.hparams.bag_size ** 0.5)
+    slides_manager = create_slides_manager(
+        datasets_folds=args.datasets_folds,
+        target=args.target,
+        min_tiles=args.min_tiles,
+        metadata_file_path=args.metadata_file_path,
+    )
+
+    float_reader = open_features_reader(args.features_dir)
+    readers = {'float32': float_reader}
+    for axis in quantization_axes:
+        readers[f'int8 per {axis}'] = QuantizedRoundTripReader(float_reader, axis=axis)
+    features_dirs = {name: args.features_dir for name in readers}
+    if args.static_int8_features_dir is not None:
+        readers['static int8 backbone'] = open_features_reader(args.static_int8_features_dir)
+        features_dirs['static int8 backbone'] = args.static_int8_features_dir
+
+    results = {}
+    for name, reader in readers.items():
+        dataset = SlideGridFeaturesDataset(
+            features_dir=features_dirs[name],
+            features_reader=reader,
+            bags_per_slide=args.bags_per_slide,
+            side_length=side_length,
+            target=args.target,
+            min_tiles=args.min_tiles,
+            datasets_folds=args.datasets_folds,
+            metadata_file_path=args.metadata_file_path,
+            slides_manager=slides_manager,
+        )
+        results[name] = get_slide_scores(model, dataset, args.batch_size, device, args.seed)
+
+    slide_names = slides_manager.metadata[constants.file_column_name].to_numpy()
+    float_scores, labels = results['float32']
+    float_auc = roc_auc_score(labels, float_scores)
+    print(f'{len(labels)} slides, bag size {side_length ** 2}, {args.bags_per_slide} bags per slide')
+    print(f'{"features":<24}{"slide AUC":>12}{"delta AUC":>12}{"max |delta score|":>20}{"mean cosine":>14}{"min cosine":>14}')
+    for name, (scores, _) in results.items():
+        auc = roc_auc_score(labels, scores)
+        similarities = get_cosine_similarities(float_reader, readers[name], slide_names)
+        print(f'{name:<24}{auc:>12.4f}{auc - float_auc:>12.4f}{np.abs(scores - float_scores).max():>20.4f}{similarities.mean():>14.4f}{similarities.min():>14.4f}')
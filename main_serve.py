@@ -0,0 +1,79 @@
+# python peripherals
+import argparse
+import json
+
+# torch
+import torch
+
+# gipmed
+from wsi.datasets.datamodules import NORMALIZATIONS
+from wsi.datasets.datasets import create_slides_manager
+from wsi.mil_transformer_classifier import MilTransformerClassifier
+from wsi.serving import SlideScoringService, create_server
+from wsi.wsi_classifier import WsiClassifier
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve slide and tile scores of a trained WsiClassifier or MilTransformerClassifier over HTTP, batching the tiles of concurrent requests. POST /score {"slide_name": ...}, GET /stats.')
+    parser.add_argument('--ckpt-path', type=str, required=True)
+    parser.add_argument('--model-type', type=str, default='classifier', choices=['classifier', 'mil'])
+    parser.add_argument('--feature-extractor-ckpt', type=str, default=None, help='WsiClassifier checkpoint to extract the features of a MIL model without online extraction')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--datasets-folds', type=json.loads, default={'CAT': [1]})
+    parser.add_argument('--target', type=str, default='none', help='none serves all slides, a target only the slides labeled for it')
+    parser.add_argument('--metadata-file-path', type=str, default=None)
+    parser.add_argument('--datasets-base-dir-path', type=str, default=None)
+    parser.add_argument('--min-tiles', type=int, default=0)
+    parser.add_argument('--normalization', type=str, default='cat', choices=list(NORMALIZATIONS))
+    parser.add_argument('--img-size', type=int, default=256)
+    parser.add_argument('--max-batch-size', type=int, default=256, help='patches per model batch')
+    parser.add_argument('--max-latency-ms', type=float, default=20, help='longest wait of a patch for its batch to fill')
+    parser.add_argument('--work-item-size', type=int, default=64, help='tiles per read and per queued work item')
+    parser.add_argument('--max-inflight-items', type=int, default=16, help='work items of a request read or queued at a time')
+    parser.add_argument('--reader-threads', type=int, default=8)
+    parser.add_argument('--min-bag-fill', type=float, default=0.5, help='MIL bags need this fraction of their grid window')
+    parser.add_argument('--no-autocast', action='store_true')
+    args = parser.parse_args()
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    feature_extractor = None
+    if args.model_type == 'classifier':
+        model = WsiClassifier.load_from_checkpoint(args.ckpt_path, map_location=device)
+    else:
+        model = MilTransformerClassifier.load_from_checkpoint(args.ckpt_path, map_location=device)
+        if args.feature_extractor_ckpt is not None:
+            feature_extractor = WsiClassifier.load_from_checkpoint(args.feature_extractor_ckpt, map_location=device)
+    slides_manager = create_slides_manager(
+        datasets_folds=args.datasets_folds,
+        target=args.target,
+        min_tiles=args.min_tiles,
+        metadata_file_path=args.metadata_file_path,
+        datasets_base_dir_path=args.datasets_base_dir_path,
+    )
+
+    service = SlideScoringService(
+        model,
+        slides_manager,
+        mean=NORMALIZATIONS[args.normalization]['mean'],
+        std=NORMALIZATIONS[args.normalization]['std'],
+        img_size=args.img_size,
+        max_batch_size=args.max_batch_size,
+        max_latency_ms=args.max_latency_ms,
+        work_item_size=args.work_item_size,
+        max_inflight_items=args.max_inflight_items,
+        reader_threads=args.reader_threads,
+        device=device,
+        autocast=not args.no_autocast,
+        feature_extractor=feature_extractor,
+        min_bag_fill=args.min_bag_fill,
+    )
+    server = create_server(service, args.host, args.port)
+    print(f'Serving {slides_manager.slides_count} slides on http://{args.host}:{args.port}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
@@ -34,6 +34,15 @@ current_mpp = 1.0  # TODO: maybe infer it directly from the folder?
 main_metadata_csv = "/home/dahen/WSI/metadata_csvs/largest_with_taylor.csv"
 data_root_gipdeep10 = "/SSDStorage/h5"
 data_root_netapp = ""
+h5_max_open_files = 128  # per process, see core.handle_pools
+openslide_max_open_files = 64  # per process, see core.handle_pools
+openslide_max_open_bytes = 2 * 1024**3  # estimated, per process
+openslide_tile_cache_bytes = None  # None keeps OpenSlide's default per-slide cache
+openslide_default_tile_cache_bytes = 32 * 1024**2
+slides_index_dir_path = os.path.expanduser("~/.cache/wsi/slides_index")  # see datasets.slides_index
+slides_loading_workers = 8
+features_cache_dir_path = "/dev/shm/wsi_features_cache"  # see utils.features_store
+embeddings_cache_dir_path = os.path.expanduser("~/.cache/wsi/embeddings")  # see utils.embeddings_cache
 
 # Invalid values
 invalid_values = ["Missing Data", "Not performed", "[Not Evaluated]", "[Not Available]", "Was not stained", numpy.nan]
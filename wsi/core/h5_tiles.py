@@ -0,0 +1,168 @@
+import os
+import re
+from pathlib import Path
+from typing import Optional, Tuple, Union
+
+import h5py
+import numpy as np
+
+from . import utils
+
+# Contiguous h5 layout:
+# - tiles_array: (N, tile_size, tile_size, 3) uint8, one chunk per tile
+# - tiles_coords: (N, 2) int64 top left coordinates of each tile (in tile_size pixels
+#   at the stored mpp), rows sorted by their packed coordinates
+# The legacy layout stores each tile in its own group: tiles/<key>/array
+tiles_group_name = "tiles"
+tiles_array_dataset_name = "tiles_array"
+tiles_coords_dataset_name = "tiles_coords"
+
+
+def is_contiguous_layout(file: h5py.File) -> bool:
+    return tiles_array_dataset_name in file
+
+
+class TileIndex:
+    """Maps tile coordinates to rows of the contiguous tiles dataset using a sorted array of packed keys."""
+
+    def __init__(self, coords: np.ndarray):
+        keys = utils.pack_coords(coords)
+        self._order = np.argsort(keys, kind="stable")
+        self._keys = keys[self._order]
+
+    @classmethod
+    def from_sorted_keys(cls, keys: np.ndarray, order: np.ndarray) -> "TileIndex":
+        """Creates an index from precomputed sorted packed keys and the rows they came from."""
+        index = cls.__new__(cls)
+        index._keys = keys
+        index._order = order
+        return index
+
+    def __len__(self) -> int:
+        return self._keys.shape[0]
+
+    def lookup(self, coords: np.ndarray) -> np.ndarray:
+        """Returns the row of every coordinate in coords (shape (..., 2)), -1 where there is no tile."""
+        keys = utils.pack_coords(coords)
+        if len(self._keys) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        positions = np.searchsorted(self._keys, keys)
+        positions = np.minimum(positions, len(self._keys) - 1)
+        found = self._keys[positions] == keys
+        return np.where(found, self._order[positions], -1)
+
+
+def get_neighbour_tiles_coords(
+    pixels: np.ndarray, tile_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    For (B, 2) center pixels, returns the (B, 4, 2) top left coordinates of the 2x2 tiles a
+    tile_size region around each pixel touches, and the (B, 2) offset of the region inside
+    its top left tile. The neighbour order is: top left, +axis 0, +axis 1, +both axes.
+    """
+    pixels = np.asarray(pixels).reshape(-1, 2)
+    top_left_pixels = (pixels - 0.5 * tile_size).astype(int)
+    local_coords = top_left_pixels % tile_size
+    top_left_coords = top_left_pixels - local_coords
+    offsets = np.array([[0, 0], [tile_size, 0], [0, tile_size], [tile_size, tile_size]])
+    return top_left_coords[:, None, :] + offsets[None, :, :], local_coords
+
+
+def stitch_regions(
+    tiles: np.ndarray,
+    neighbour_rows: np.ndarray,
+    local_coords: np.ndarray,
+    tile_size: int,
+    color_channels: int = 3,
+) -> np.ndarray:
+    """
+    Assembles (B, tile_size, tile_size, C) uint8 regions from the 2x2 neighbourhoods given by
+    neighbour_rows (B, 4), rows into tiles (M, tile_size, tile_size, C) or -1 for missing
+    tiles which are left black.
+    """
+    regions = np.zeros(
+        (neighbour_rows.shape[0], tile_size, tile_size, color_channels), dtype=np.uint8
+    )
+    for i in range(neighbour_rows.shape[0]):
+        l0, l1 = local_coords[i]
+        r0, r1 = tile_size - l0, tile_size - l1
+        rows = neighbour_rows[i]
+        if rows[0] >= 0:
+            regions[i, :r0, :r1] = tiles[rows[0], l0:, l1:]
+        if rows[1] >= 0 and l0 > 0:
+            regions[i, r0:, :r1] = tiles[rows[1], :l0, l1:]
+        if rows[2] >= 0 and l1 > 0:
+            regions[i, :r0, r1:] = tiles[rows[2], l0:, :l1]
+        if rows[3] >= 0 and l0 > 0 and l1 > 0:
+            regions[i, r0:, r1:] = tiles[rows[3], :l0, :l1]
+    return regions
+
+
+def read_tiles(file: h5py.File, rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Reads the tiles at rows (-1 entries are ignored) with a single fancy indexed read.
+    Returns the tiles and rows remapped to index into them.
+    """
+    unique_rows, inverse = np.unique(rows, return_inverse=True)
+    inverse = inverse.reshape(rows.shape)
+    if unique_rows.size > 0 and unique_rows[0] < 0:
+        unique_rows = unique_rows[1:]
+        inverse = inverse - 1
+    tiles = file[tiles_array_dataset_name][unique_rows]
+    return tiles, np.where(rows >= 0, inverse, -1)
+
+
+def parse_legacy_tile_key(key: str) -> Tuple[int, int]:
+    # keys are str((x, y)) of python or numpy ints, e.g. "(512, 256)" or "(np.int64(512), np.int64(256))"
+    values = re.findall(r"-?\d+", re.sub(r"np\.\w+\(", "(", key))
+    return int(values[0]), int(values[1])
+
+
+def convert_h5_tile_layout(
+    src_path: Union[str, Path],
+    dst_path: Optional[Union[str, Path]] = None,
+    keep_legacy_tiles: bool = False,
+):
+    """
+    Converts a slide h5 file from the per tile group layout to the contiguous layout.
+    All other datasets and attributes are copied. When dst_path is None, the source
+    file is replaced atomically once the conversion is complete.
+    """
+    src_path = Path(src_path)
+    in_place = dst_path is None
+    dst_path = Path(f"{src_path}.tmp") if in_place else Path(dst_path)
+
+    try:
+        with h5py.File(src_path, "r") as src, h5py.File(dst_path, "w") as dst:
+            if is_contiguous_layout(src):
+                raise ValueError(f"{src_path} is already in the contiguous tiles layout")
+
+            for key, value in src.attrs.items():
+                dst.attrs[key] = value
+            for name in src.keys():
+                if name != tiles_group_name or keep_legacy_tiles:
+                    src.copy(src[name], dst, name=name)
+
+            tiles_group = src[tiles_group_name]
+            keys = list(tiles_group.keys())
+            coords = np.array([parse_legacy_tile_key(key) for key in keys], dtype=np.int64).reshape(-1, 2)
+            order = np.argsort(utils.pack_coords(coords), kind="stable")
+
+            tile_shape = tiles_group[keys[0]]["array"].shape if keys else (0, 0, 3)
+            tiles_array = dst.create_dataset(
+                tiles_array_dataset_name,
+                shape=(len(keys), *tile_shape),
+                dtype=np.uint8,
+                chunks=(1, *tile_shape) if keys else None,
+            )
+            for row, key_index in enumerate(order):
+                tiles_array[row] = tiles_group[keys[key_index]]["array"][...].astype(np.uint8)
+            dst.create_dataset(tiles_coords_dataset_name, data=coords[order])
+    except BaseException:
+        # a half-written temporary file would be overwritten silently by the next run
+        if in_place:
+            dst_path.unlink(missing_ok=True)
+        raise
+
+    if in_place:
+        os.replace(dst_path, src_path)
@@ -0,0 +1,359 @@
+import math
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Generic, Iterator, Optional, Set, TypeVar, Union
+
+import h5py
+import openslide
+
+from . import constants
+
+T = TypeVar("T")
+
+
+class HandlePool(ABC, Generic[T]):
+    """
+    Process-local LRU pool of open file handles keyed by path.
+
+    Handles are opened lazily on first access and kept open until evicted, either
+    because more than max_open handles are open or because the estimated memory of
+    the open handles exceeds max_bytes (if given). The pool
+    remembers the pid that opened its handles; after a fork (e.g. in a DataLoader
+    worker) the inherited handles are dropped without being closed and reopened
+    on demand by the new process.
+
+    The pool is thread-safe. A handle used by several threads should be taken with
+    acquire: it is not closed by evictions, close or clear until it is released, so
+    the pool may be over budget while all of its handles are in use.
+    """
+
+    def __init__(self, max_open: int, max_bytes: Optional[int] = None):
+        self._max_open = max_open
+        self._max_bytes = max_bytes
+        self._handles: "OrderedDict[str, T]" = OrderedDict()
+        self._sizes: Dict[str, int] = {}
+        self._pid = os.getpid()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._lock = threading.RLock()
+        self._refs: Dict[str, int] = {}
+        self._close_on_release: Set[str] = set()
+
+    @property
+    def max_open(self) -> int:
+        return self._max_open
+
+    @max_open.setter
+    def max_open(self, max_open: int):
+        with self._lock:
+            self._max_open = max_open
+            self._evict()
+
+    @property
+    def max_bytes(self) -> Optional[int]:
+        return self._max_bytes
+
+    @max_bytes.setter
+    def max_bytes(self, max_bytes: Optional[int]):
+        with self._lock:
+            self._max_bytes = max_bytes
+            self._evict()
+
+    @property
+    def open_count(self) -> int:
+        return len(self._handles)
+
+    @property
+    def estimated_bytes(self) -> int:
+        return sum(self._sizes.values())
+
+    @property
+    def hits(self) -> int:
+        return self._hits
+
+    @property
+    def misses(self) -> int:
+        return self._misses
+
+    @property
+    def evictions(self) -> int:
+        return self._evictions
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hits": self._hits,
+                "misses": self._misses,
+                "evictions": self._evictions,
+                "open": len(self._handles),
+                "in_use": len(self._refs),
+                "estimated_bytes": self.estimated_bytes,
+            }
+
+    def get(self, path: Union[str, Path]) -> T:
+        """The handle of path, for single threaded use: another thread may evict it, see acquire."""
+        self._check_pid()
+        with self._lock:
+            key = str(path)
+            handle = self._get(key)
+            self._evict(keep=key)
+            return handle
+
+    @contextmanager
+    def acquire(self, path: Union[str, Path]) -> Iterator[T]:
+        """The handle of path, not closed by the pool until the context exits."""
+        self._check_pid()
+        with self._lock:
+            key = str(path)
+            handle = self._get(key)
+            self._refs[key] = self._refs.get(key, 0) + 1
+            self._evict()
+        try:
+            yield handle
+        finally:
+            self._release(key)
+
+    def close(self, path: Union[str, Path]):
+        self._check_pid()
+        with self._lock:
+            self._close_key(str(path))
+
+    def clear(self):
+        self._check_pid()
+        with self._lock:
+            for key in list(self._handles):
+                self._close_key(key)
+
+    def reset_after_fork(self):
+        # handles belong to the parent process, closing them here could corrupt its state.
+        # The lock may have been held by another thread of the parent, it is replaced.
+        self._lock = threading.RLock()
+        self._handles = OrderedDict()
+        self._sizes = {}
+        self._refs = {}
+        self._close_on_release = set()
+        self._pid = os.getpid()
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def _get(self, key: str) -> T:
+        handle = self._handles.get(key)
+        if handle is not None:
+            self._hits += 1
+            self._handles.move_to_end(key)
+            return handle
+
+        self._misses += 1
+        handle = self._open(key)
+        self._handles[key] = handle
+        self._sizes[key] = self._estimate_bytes(handle)
+        return handle
+
+    def _release(self, key: str):
+        with self._lock:
+            refs = self._refs.get(key)
+            if refs is None:
+                # acquired before a fork, the child does not own the handle
+                return
+            if refs > 1:
+                self._refs[key] = refs - 1
+                return
+            del self._refs[key]
+            if key in self._close_on_release:
+                self._close_key(key)
+            else:
+                self._evict()
+
+    def _close_key(self, key: str):
+        if self._refs.get(key):
+            self._close_on_release.add(key)
+            return
+        self._close_on_release.discard(key)
+        handle = self._handles.pop(key, None)
+        self._sizes.pop(key, None)
+        if handle is not None:
+            self._close(handle)
+
+    def _check_pid(self):
+        # before taking the lock, a copy of the lock of the parent may be held forever
+        if self._pid != os.getpid():
+            self.reset_after_fork()
+
+    def _over_budget(self) -> bool:
+        if len(self._handles) > self._max_open:
+            return True
+        # always keep the most recent handle, even if it alone is over budget
+        return (
+            self._max_bytes is not None
+            and len(self._handles) > 1
+            and self.estimated_bytes > self._max_bytes
+        )
+
+    def _evict(self, keep: Optional[str] = None):
+        while self._over_budget():
+            # the least recently used handle that is not in use
+            key = next((key for key in self._handles if key != keep and not self._refs.get(key)), None)
+            if key is None:
+                return
+            handle = self._handles.pop(key)
+            self._sizes.pop(key, None)
+            self._close(handle)
+            self._evictions += 1
+
+    def _estimate_bytes(self, handle: T) -> int:
+        return 0
+
+    @abstractmethod
+    def _open(self, path: str) -> T:
+        pass
+
+    @abstractmethod
+    def _close(self, handle: T):
+        pass
+
+    def __getstate__(self):
+        # pools are process-local, a pickled copy (spawned workers) starts empty
+        d = dict(self.__dict__)
+        d["_handles"] = OrderedDict()
+        d["_sizes"] = {}
+        d["_refs"] = {}
+        d["_close_on_release"] = set()
+        del d["_lock"]
+        return d
+
+    def __setstate__(self, d):
+        self.__dict__.update(d)
+        self._lock = threading.RLock()
+        self._pid = os.getpid()
+
+
+class H5HandlePool(HandlePool[h5py.File]):
+    """LRU pool of read-only h5py.File handles."""
+
+    def _open(self, path: str) -> h5py.File:
+        return h5py.File(path, "r")
+
+    def _close(self, handle: h5py.File):
+        try:
+            handle.close()
+        except Exception:
+            pass
+
+
+class OpenSlideHandlePool(HandlePool[openslide.AbstractSlide]):
+    """
+    LRU pool of OpenSlide handles, bounded by count and by estimated memory.
+
+    The memory estimate of a handle is the size of its tile index (a fixed number of
+    bytes per 256x256 tile over all levels) plus its tile cache, unless a shared
+    tile cache of tile_cache_bytes is used. Setting the tile cache size requires
+    openslide-python >= 1.3, older versions silently keep OpenSlide's default.
+    """
+
+    _index_bytes_per_tile = 64
+    _index_tile_size = 256
+
+    def __init__(
+        self,
+        max_open: int,
+        max_bytes: Optional[int] = None,
+        tile_cache_bytes: Optional[int] = None,
+    ):
+        super().__init__(max_open=max_open, max_bytes=max_bytes)
+        self._tile_cache_bytes = tile_cache_bytes
+        self._tile_cache = None
+
+    @property
+    def tile_cache_bytes(self) -> Optional[int]:
+        return self._tile_cache_bytes
+
+    @tile_cache_bytes.setter
+    def tile_cache_bytes(self, tile_cache_bytes: Optional[int]):
+        if tile_cache_bytes != self._tile_cache_bytes:
+            # only affects slides opened from now on
+            self._tile_cache_bytes = tile_cache_bytes
+            self._tile_cache = None
+
+    def reset_after_fork(self):
+        super().reset_after_fork()
+        self._tile_cache = None
+
+    def _get_tile_cache(self):
+        if self._tile_cache_bytes is None or not hasattr(openslide, "OpenSlideCache"):
+            return None
+        if self._tile_cache is None:
+            self._tile_cache = openslide.OpenSlideCache(self._tile_cache_bytes)
+        return self._tile_cache
+
+    def _open(self, path: str) -> openslide.AbstractSlide:
+        slide = openslide.open_slide(path)
+        tile_cache = self._get_tile_cache()
+        if tile_cache is not None and hasattr(slide, "set_cache"):
+            slide.set_cache(tile_cache)
+        return slide
+
+    def _close(self, handle: openslide.AbstractSlide):
+        try:
+            handle.close()
+        except Exception:
+            pass
+
+    def _estimate_bytes(self, handle: openslide.AbstractSlide) -> int:
+        index_bytes = 0
+        for width, height in handle.level_dimensions:
+            tiles = math.ceil(width / self._index_tile_size) * math.ceil(
+                height / self._index_tile_size
+            )
+            index_bytes += tiles * self._index_bytes_per_tile
+
+        # a shared tile cache is accounted for once, not per handle
+        if self._get_tile_cache() is not None:
+            return index_bytes
+        return index_bytes + constants.openslide_default_tile_cache_bytes
+
+    def __getstate__(self):
+        d = super().__getstate__()
+        d["_tile_cache"] = None
+        return d
+
+
+_h5_pool = H5HandlePool(max_open=constants.h5_max_open_files)
+_openslide_pool = OpenSlideHandlePool(
+    max_open=constants.openslide_max_open_files,
+    max_bytes=constants.openslide_max_open_bytes,
+    tile_cache_bytes=constants.openslide_tile_cache_bytes,
+)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_h5_pool.reset_after_fork)
+    os.register_at_fork(after_in_child=_openslide_pool.reset_after_fork)
+
+
+def get_h5_pool() -> H5HandlePool:
+    return _h5_pool
+
+
+def configure_h5_pool(max_open: int) -> H5HandlePool:
+    _h5_pool.max_open = max_open
+    return _h5_pool
+
+
+def get_openslide_pool() -> OpenSlideHandlePool:
+    return _openslide_pool
+
+
+def configure_openslide_pool(
+    max_open: int,
+    max_bytes: Optional[int] = None,
+    tile_cache_bytes: Optional[int] = None,
+) -> OpenSlideHandlePool:
+    _openslide_pool.tile_cache_bytes = tile_cache_bytes
+    _openslide_pool.max_bytes = max_bytes
+    _openslide_pool.max_open = max_open
+    return _openslide_pool
@@ -186,6 +186,12 @@ def save_object_dict(obj: object, file_path: str):
 #     return cast(instance_type, argument_parser.parse_args())
 
 
+def pack_coords(coords: numpy.ndarray) -> numpy.ndarray:
+    """Packs integer (N, 2) coordinates into sortable int64 keys, one per row."""
+    coords = numpy.asarray(coords).astype(numpy.int64)
+    return (coords[..., 0] << 32) | (coords[..., 1] & 0xFFFFFFFF)
+
+
 def round_to_nearest_power_of_two(mpp: float) -> float:
     log_mpp = math.log(mpp, 2.0)
     return 2 ** round(log_mpp)
@@ -4,7 +4,7 @@ import pickle
 from abc import ABC, abstractmethod
 from enum import Enum, auto
 from pathlib import Path
-from typing import Callable, Dict, List, Optional, cast
+from typing import Callable, Dict, List, Optional, Tuple, cast
 import datetime
 
 import cv2
@@ -24,7 +24,8 @@ import torch
 from matplotlib import pyplot as plt
 from PIL import Image
 
-from . import constants, utils
+from . import constants, h5_tiles, utils
+from .handle_pools import get_h5_pool, get_openslide_pool
 
 BINARY_BIOMARKERS = ["er_status", "pr_status", "her2_status"]
 
@@ -40,45 +41,50 @@ class SlideContext:
         dataset_paths: Dict[str, Path],
         desired_mpp: int,
         tile_size: int,
+        level: Optional[int] = None,
+        level_downsample: Optional[float] = None,
     ):
         self._row_index = row_index
-        self._row = metadata.iloc[[row_index]]
+        # a plain dict, holding on to a DataFrame slice per slide is costly with many slides and workers
+        self._row = metadata.iloc[row_index].to_dict()
         self._dataset_path = dataset_paths[
-            self._row[constants.dataset_id_column_name].item()
+            self._row[constants.dataset_id_column_name]
         ]
         self._desired_mpp = desired_mpp
         self._tile_size = tile_size
-        self._image_file_name = self._row[constants.file_column_name].item()
+        self._image_file_name = self._row[constants.file_column_name]
         self._image_file_path = self._dataset_path / self._image_file_name
-        self._dataset_id = self._row[constants.dataset_id_column_name].item()
+        self._dataset_id = self._row[constants.dataset_id_column_name]
         self._image_file_name_stem = self._image_file_path.stem
         self._image_file_name_suffix = self._image_file_path.suffix
-        self._orig_mpp = self._row[constants.mpp_column_name].item()
+        self._orig_mpp = self._row[constants.mpp_column_name]
         if "ABCTB" == self._dataset_id:
             self._orig_mpp = 10.0 / self._row[constants.magnification_column_name]  # placeholder value, this should be dealt with when creating the metadata.
         self._curr_mpp = constants.current_mpp
         self._legitimate_tiles_count = self._row[
             constants.legitimate_tiles_column_name
-        ].item()
-        self._fold = self._row[constants.fold_column_name].item()
+        ]
+        self._fold = self._row[constants.fold_column_name]
         self._downsample_from_curr = self._desired_mpp / self._curr_mpp
         self._downsample_from_orig = utils.round_to_nearest_power_of_two(
             self._desired_mpp / self._orig_mpp
         )
         self._zero_level_tile_size = self._tile_size * self._downsample_from_orig
-        self._dfs = self._row[constants.disease_free_status_column_name].item()
+        self._dfs = self._row[constants.disease_free_status_column_name]
         self._color_channels = 3
         self._is_h5 = "/h5" in str(self._dataset_path)
+        self._tile_index = None
+        self._level, self._level_downsample = None, None
         if self._is_h5:
             self.read_region_around_pixel = self._read_region_around_pixel_h5
         else:
             self.read_region_around_pixel = self._read_region_around_pixel_openslide
-            self.openslide_slide = openslide.open_slide(self._image_file_path)
-            self._level, self._level_downsample = self._get_best_level_for_downsample(
-                slide=self.openslide_slide
-            )
+            # a precomputed level (e.g. from a slides index) avoids opening the slide
+            if level is None:
+                with get_openslide_pool().acquire(self._image_file_path) as slide:
+                    level, level_downsample = self._get_best_level_for_downsample(slide=slide)
+            self._level, self._level_downsample = level, level_downsample
             self._selected_level_tile_size = self._tile_size * self._level_downsample
-            self.openslide_slide.close()
 
     @property
     def row_index(self) -> int:
@@ -112,6 +118,14 @@ class SlideContext:
     # def slide(self) -> openslide.OpenSlide:
     #     return self._slide
 
+    @property
+    def level(self) -> Optional[int]:
+        return self._level
+
+    @property
+    def level_downsample(self) -> Optional[float]:
+        return self._level_downsample
+
     # @property
     # def level(self) -> int:
     #     return self._level
@@ -185,103 +199,108 @@ class SlideContext:
     # def read_region_around_pixel(self, pixel: np.ndarray) -> Image:
     #     return self._read_region_around_pixel_h5(pixel=pixel)
 
+    def read_regions(self, pixels: np.ndarray) -> np.ndarray:
+        """Reads the (tile_size, tile_size) regions around (B, 2) zero level center pixels into a (B, T, T, 3) uint8 array."""
+        pixels = np.asarray(pixels).reshape(-1, 2)
+        if self._is_h5:
+            return self._read_regions_h5(pixels=pixels)
+        return self._read_regions_openslide(pixels=pixels)
+
     def _read_region_around_pixel_openslide(self, pixel: np.ndarray) -> Image:
-        # slide = openslide.open_slide(self._image_file_path)
-        # level, level_downsample = self._get_best_level_for_downsample(slide=slide)
-        # selected_level_tile_size = self._tile_size * level_downsample
-        openslide_slide = openslide.open_slide(self._image_file_path)
+        return Image.fromarray(self._read_regions_openslide(pixels=pixel.reshape(-1, 2))[0], mode="RGB")
+
+    def _read_regions_openslide(self, pixels: np.ndarray) -> np.ndarray:
+        # reader threads share the pool, the slide must not be closed while it is read
+        with get_openslide_pool().acquire(self._image_file_path) as openslide_slide:
+            return self._read_regions_from_slide(openslide_slide=openslide_slide, pixels=pixels)
+
+    def _read_regions_from_slide(self, openslide_slide: openslide.AbstractSlide, pixels: np.ndarray) -> np.ndarray:
         level, _ = self._level, self._level_downsample
         selected_level_tile_size = self._selected_level_tile_size
-        top_left_pixel = (pixel - self.zero_level_half_tile_size).astype(int)
-        top_left_pixel[0], top_left_pixel[1] = top_left_pixel[1], top_left_pixel[0].copy()
-        region = openslide_slide.read_region(
-            top_left_pixel, level, (selected_level_tile_size, selected_level_tile_size)
-        ).convert("RGB")
-        if selected_level_tile_size != self.tile_size:
-            region = region.resize((self.tile_size, self.tile_size))
-        openslide_slide.close()
-        return region
+        top_left_pixels = (pixels - self.zero_level_half_tile_size).astype(int)
+        # openslide reads are the expensive part, duplicated pixels are read once
+        unique_top_left_pixels, inverse = np.unique(top_left_pixels, axis=0, return_inverse=True)
+        regions = np.empty(
+            (unique_top_left_pixels.shape[0], self._tile_size, self._tile_size, self._color_channels),
+            dtype=np.uint8,
+        )
+        for i, top_left_pixel in enumerate(unique_top_left_pixels):
+            region = openslide_slide.read_region(
+                (int(top_left_pixel[1]), int(top_left_pixel[0])),
+                level,
+                (selected_level_tile_size, selected_level_tile_size),
+            ).convert("RGB")
+            if selected_level_tile_size != self.tile_size:
+                region = region.resize((self.tile_size, self.tile_size))
+            regions[i] = np.asarray(region)
+        return regions[inverse.reshape(-1)]
 
     def _np_to_h5_key(self, coords: np.ndarray) -> str:
         coords = coords.astype(int)
         key = str((coords[0], coords[1]))
         return key
 
+    def _get_tile_index(self, file: h5py.File) -> Optional[h5_tiles.TileIndex]:
+        # False marks a file in the legacy per tile group layout
+        if self._tile_index is None:
+            if h5_tiles.is_contiguous_layout(file):
+                self._tile_index = h5_tiles.TileIndex(
+                    coords=file[h5_tiles.tiles_coords_dataset_name][...]
+                )
+            else:
+                self._tile_index = False
+        return self._tile_index or None
+
+    def _read_tiles_h5_legacy(
+        self, file: h5py.File, neighbours_coords: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        unique_coords, inverse = np.unique(
+            neighbours_coords.reshape(-1, 2), axis=0, return_inverse=True
+        )
+        tiles_group = file[h5_tiles.tiles_group_name]
+        tiles = []
+        unique_rows = np.full(unique_coords.shape[0], -1)
+        for i, coords in enumerate(unique_coords):
+            key = self._np_to_h5_key(coords)
+            if key in tiles_group:
+                unique_rows[i] = len(tiles)
+                tiles.append(tiles_group[key]["array"][...])
+        rows = unique_rows[inverse.reshape(-1)].reshape(neighbours_coords.shape[:-1])
+        return np.array(tiles), rows
+
     # TODO enable larger sample & sample at other mpp.
     def _read_region_around_pixel_h5(self, pixel: np.ndarray) -> Image:
-        pixel = pixel // self._downsample_from_orig
-        # fopen_time = datetime.now()
-        with h5py.File(f"{self._image_file_path}.h5", "r") as file:
-            # print(f"time to open the file is {datetime.now() - fopen_time}")
-            tile_size = self._tile_size
-            x_offset = np.array([tile_size, 0])
-            y_offset = np.array([0, tile_size])
-            top_left_pixel = (pixel - 0.5 * (x_offset + y_offset)).astype(int)
-            local_coords = top_left_pixel % tile_size
-            top_left_coords = top_left_pixel - local_coords
-
-            image = np.zeros((self._tile_size, self._tile_size, self._color_channels))
-            filled_area = 0
-            
-            fread_time = datetime.datetime.now()
-            if self._np_to_h5_key(top_left_coords) in file["tiles"].keys():
-                image[
-                    : (self._tile_size - local_coords[0]),
-                    : (self._tile_size - local_coords[1]),
-                    :,
-                ] = file["tiles"][self._np_to_h5_key(top_left_coords)]["array"][
-                    local_coords[0] :, local_coords[1] :, :
-                ]
-                filled_area += (self._tile_size - local_coords[0]) * (
-                    self._tile_size - local_coords[1]
-                )
+        return Image.fromarray(self._read_regions_h5(pixels=pixel.reshape(-1, 2))[0], mode="RGB")
+
+    def _read_regions_h5(self, pixels: np.ndarray) -> np.ndarray:
+        pixels = pixels // self._downsample_from_orig
+        with get_h5_pool().acquire(f"{self._image_file_path}.h5") as file:
+            return self._read_regions_from_file(file=file, pixels=pixels)
 
-            if filled_area == self._tile_size**2:
-                return Image.fromarray(np.uint8(image), mode="RGB")
-
-            if self._np_to_h5_key(top_left_coords + x_offset) in file["tiles"].keys():
-                image[
-                    (self._tile_size - local_coords[0]) :,
-                    : (self._tile_size - local_coords[1]),
-                    :,
-                ] = file["tiles"][self._np_to_h5_key(top_left_coords + x_offset)]["array"][
-                    : local_coords[0], local_coords[1] :, :
-                ]
-                filled_area += local_coords[0] * (self._tile_size - local_coords[1])
-
-            if filled_area == self._tile_size**2:
-                return Image.fromarray(np.uint8(image), mode="RGB")
-
-            if self._np_to_h5_key(top_left_coords + y_offset) in file["tiles"].keys():
-                image[
-                    : (self._tile_size - local_coords[0]),
-                    (self._tile_size - local_coords[1]) :,
-                    :,
-                ] = file["tiles"][self._np_to_h5_key(top_left_coords + y_offset)]["array"][
-                    local_coords[0] :, : local_coords[1], :
-                ]
-                filled_area += (self._tile_size - local_coords[0]) * local_coords[1]
-                
-            if filled_area == self._tile_size**2:
-                return Image.fromarray(np.uint8(image), mode="RGB")
-
-            if (self._np_to_h5_key(top_left_coords + x_offset + y_offset)
-                in file["tiles"].keys()):
-                image[
-                    (self._tile_size - local_coords[0]) :,
-                    (self._tile_size - local_coords[1]) :,
-                    :,
-                ] = file["tiles"][self._np_to_h5_key(top_left_coords + x_offset + y_offset)]["array"][
-                    : local_coords[0], : local_coords[1], :
-                ]
-                filled_area += local_coords[0] * local_coords[1]
-            read_time = datetime.datetime.now() - fread_time
-            # print(im_chunk)
-            # print(f"{self._image_file_name_stem} from {self._dataset_id} takes {read_time}")
-        return Image.fromarray(np.uint8(image), mode="RGB")
+    def _read_regions_from_file(self, file: h5py.File, pixels: np.ndarray) -> np.ndarray:
+        neighbours_coords, local_coords = h5_tiles.get_neighbour_tiles_coords(
+            pixels=pixels, tile_size=self._tile_size
+        )
+        # every tile touched by the batch is read once, however many regions overlap it
+        tile_index = self._get_tile_index(file=file)
+        if tile_index is not None:
+            tiles, rows = h5_tiles.read_tiles(
+                file=file, rows=tile_index.lookup(coords=neighbours_coords)
+            )
+        else:
+            tiles, rows = self._read_tiles_h5_legacy(
+                file=file, neighbours_coords=neighbours_coords
+            )
+        return h5_tiles.stitch_regions(
+            tiles=tiles,
+            neighbour_rows=rows,
+            local_coords=local_coords,
+            tile_size=self._tile_size,
+            color_channels=self._color_channels,
+        )
 
     def get_biomarker_value(self, bio_marker) -> bool:
-        return self._row[bio_marker].item()
+        return self._row[bio_marker]
 
     def _get_best_level_for_downsample(self, slide: openslide.OpenSlide):
         level = 0
@@ -397,16 +416,19 @@ class TilesManager(ABC, SlideElement):
             if slide_context._is_h5
             else self._load_pixels_openslide
         )
-        self._tiles_df = self._create_tiles_dataframe(pixels=pixels)
+        self._pixels = self._create_tiles_table(pixels=pixels)
+        self._locations_index = None
+
+    @property
+    def pixels(self) -> np.ndarray:
+        return self._pixels
 
     @property
     def tiles_count(self) -> int:
-        return self._tiles_df.shape[0]
+        return self._pixels.shape[0]
     
     def get_tile(self, tile_index: int) -> Tile:
-        row = self._tiles_df.iloc[[tile_index]]
-        top_left_pixel = row[[TilesManager.pixel_x, TilesManager.pixel_y]].to_numpy()
-        return Tile(slide_context=self._slide_context, top_left_pixel=top_left_pixel)
+        return Tile(slide_context=self._slide_context, top_left_pixel=self._pixels[tile_index])
     
     def get_random_tile(self) -> Tile:
         tile_index = np.random.randint(low=0, high=self.tiles_count)
@@ -417,15 +439,24 @@ class TilesManager(ABC, SlideElement):
         return tile.get_random_pixel()
 
     def get_tile_at_pixel(self, pixel: np.ndarray) -> Optional[Tile]:
-        location = self._slide_context.pixels_to_locations(pixels=pixel)
-        row = self._tiles_df.loc[
-            (self._tiles_df[TilesManager.pixel_x] == location[0])
-            & (self._tiles_df[TilesManager.pixel_y] == location[1])
-        ]
-        return self._location_to_tile.get(location.tobytes())
-
-    def _get_top_left_pixels_from_dataframe(df: pandas.DataFrame) -> np.ndarray:
-        return df[[TilesManager.pixel_x, TilesManager.pixel_y]].to_numpy()
+        if self._locations_index is None:
+            # sorted packed tile locations, built on first use
+            keys = utils.pack_coords(self._slide_context.pixels_to_locations(pixels=self._pixels))
+            order = np.argsort(keys, kind="stable")
+            self._locations_index = (keys[order], order)
+        keys, order = self._locations_index
+        if keys.shape[0] == 0:
+            return None
+        key = utils.pack_coords(self._slide_context.pixels_to_locations(pixels=np.asarray(pixel).flatten()))
+        position = min(int(np.searchsorted(keys, key)), keys.shape[0] - 1)
+        if keys[position] != key:
+            return None
+        return self.get_tile(tile_index=order[position])
+
+    def set_pixels(self, pixels: np.ndarray):
+        """Replaces the tile table, e.g. with a view into a table shared by many slides."""
+        self._pixels = pixels
+        self._locations_index = None
 
     def _tiles_from_pixels(self, top_left_pixels: np.ndarray) -> List[Tile]:
         return [
@@ -433,23 +464,11 @@ class TilesManager(ABC, SlideElement):
             for i in range(top_left_pixels.shape[0])
         ]
 
-    def _create_tiles_dataframe(self, pixels: Optional[np.ndarray]) -> pandas.DataFrame:
+    def _create_tiles_table(self, pixels: Optional[np.ndarray]) -> np.ndarray:
         if pixels is None:
             pixels = self._load_pixels()
-        tile_indices = np.array(list(range(pixels.shape[0])))
-        tile_indices = np.expand_dims(tile_indices, axis=1)
-        data = np.concatenate(
-            (tile_indices, pixels), axis=1
-        ).astype(np.int32) 
-        tiles_df = pandas.DataFrame(
-            data=data,
-            columns=[
-                TilesManager.tile_index,
-                TilesManager.pixel_x,
-                TilesManager.pixel_y,
-            ],
-        )
-        return tiles_df
+        # (tiles_count, 2) top left pixels, the row is the tile index
+        return np.ascontiguousarray(pixels, dtype=np.int32).reshape(-1, 2)
 
     def _load_pixels_h5(self) -> np.ndarray:
         try:
@@ -504,8 +523,9 @@ class Slide(TilesManager):
         slide_context: SlideContext,
         min_component_ratio: float = 0.92,
         max_aspect_ratio_diff: float = 0.02,
+        pixels: Optional[np.ndarray] = None,
     ):
-        super().__init__(slide_context=slide_context, pixels=None)
+        super().__init__(slide_context=slide_context, pixels=pixels)
         self._min_component_ratio = min_component_ratio
         self._max_aspect_ratio_diff = max_aspect_ratio_diff
         # self._bitmap = self._create_bitmap(plot_bitmap=False)
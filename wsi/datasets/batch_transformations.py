@@ -0,0 +1,287 @@
+import math
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from torchvision.transforms import InterpolationMode
+from torchvision.transforms import functional as TF
+
+# Transformations of whole (B, C, H, W) image batches with independent random parameters per
+# sample, the batched counterparts of the per patch PIL transforms used by the datamodules.
+# They run on the device of the batch, so they can augment on the GPU after the transfer.
+
+
+def _uniform(low: float, high: float, size: int, device: torch.device) -> torch.Tensor:
+    return low + (high - low) * torch.rand(size, device=device)
+
+
+def _per_sample(values: torch.Tensor) -> torch.Tensor:
+    return values.view(-1, 1, 1, 1)
+
+
+def _rgb_to_grayscale(x: torch.Tensor) -> torch.Tensor:
+    return (0.2989 * x[:, 0] + 0.587 * x[:, 1] + 0.114 * x[:, 2]).unsqueeze(1)
+
+
+def _blend(x: torch.Tensor, other: torch.Tensor, factor: torch.Tensor) -> torch.Tensor:
+    return (_per_sample(factor) * x + (1 - _per_sample(factor)) * other).clamp_(0, 1)
+
+
+def _rgb_to_hsv(x: torch.Tensor) -> torch.Tensor:
+    r, g, b = x.unbind(dim=1)
+    max_c = x.max(dim=1).values
+    min_c = x.min(dim=1).values
+    equal = max_c == min_c
+    chroma = max_c - min_c
+    s = chroma / torch.where(equal, torch.ones_like(max_c), max_c)
+    chroma_divisor = torch.where(equal, torch.ones_like(chroma), chroma)
+    rc = (max_c - r) / chroma_divisor
+    gc = (max_c - g) / chroma_divisor
+    bc = (max_c - b) / chroma_divisor
+    hr = (max_c == r) * (bc - gc)
+    hg = ((max_c == g) & (max_c != r)) * (2.0 + rc - bc)
+    hb = ((max_c != g) & (max_c != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, max_c), dim=1)
+
+
+def _hsv_to_rgb(x: torch.Tensor) -> torch.Tensor:
+    h, s, v = x.unbind(dim=1)
+    i = torch.floor(h * 6.0)
+    f = (h * 6.0) - i
+    i = i.to(torch.int32) % 6
+    p = (v * (1.0 - s)).clamp_(0.0, 1.0)
+    q = (v * (1.0 - s * f)).clamp_(0.0, 1.0)
+    t = (v * (1.0 - s * (1.0 - f))).clamp_(0.0, 1.0)
+    mask = i.unsqueeze(dim=1) == torch.arange(6, device=i.device).view(1, -1, 1, 1)
+    a1 = torch.stack((v, q, p, p, t, v), dim=1)
+    a2 = torch.stack((t, v, v, q, p, p), dim=1)
+    a3 = torch.stack((p, p, t, v, v, q), dim=1)
+    a4 = torch.stack((a1, a2, a3), dim=1)
+    return torch.einsum("...ijk, ...xijk -> ...xjk", mask.to(dtype=x.dtype), a4)
+
+
+class BatchRandomCrop:
+    """Crops a size x size region at an independent random position of every image."""
+
+    def __init__(self, size: int):
+        self.size = size
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        batch_size, _, height, width = x.shape
+        if height == self.size and width == self.size:
+            return x
+        top = torch.randint(0, height - self.size + 1, (batch_size,), device=x.device)
+        left = torch.randint(0, width - self.size + 1, (batch_size,), device=x.device)
+        offsets = torch.arange(self.size, device=x.device)
+        rows = (top[:, None] + offsets)[:, :, None]
+        cols = (left[:, None] + offsets)[:, None, :]
+        batch = torch.arange(batch_size, device=x.device)[:, None, None]
+        # advanced indexing moves the channels last: (B, size, size, C)
+        return x.permute(0, 2, 3, 1)[batch, rows, cols].permute(0, 3, 1, 2).contiguous()
+
+
+class BatchRandomFlip:
+    """Flips every image along dim (-1 horizontal, -2 vertical) with probability p."""
+
+    def __init__(self, dim: int = -1, p: float = 0.5):
+        self.dim = dim
+        self.p = p
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        flip = torch.rand(x.shape[0], device=x.device) < self.p
+        return torch.where(_per_sample(flip), x.flip(self.dim), x)
+
+
+class BatchRandomRot90:
+    """Rotates every (square) image by a random multiple of 90 degrees."""
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        k = torch.randint(0, 4, (x.shape[0],), device=x.device)
+        x = x.clone()
+        for rotations in range(1, 4):
+            selected = k == rotations
+            if selected.any():
+                x[selected] = torch.rot90(x[selected], rotations, dims=(-2, -1))
+        return x
+
+
+class BatchColorJitter:
+    """
+    ColorJitter on float images in [0, 1] with per sample factors. The order of the four
+    adjustments is drawn once per batch instead of once per image.
+    """
+
+    def __init__(self, brightness: float = 0, contrast: float = 0, saturation: float = 0, hue: float = 0):
+        self.brightness = (max(0.0, 1 - brightness), 1 + brightness) if brightness else None
+        self.contrast = (max(0.0, 1 - contrast), 1 + contrast) if contrast else None
+        self.saturation = (max(0.0, 1 - saturation), 1 + saturation) if saturation else None
+        self.hue = (-hue, hue) if hue else None
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        batch_size = x.shape[0]
+        for adjustment in torch.randperm(4).tolist():
+            if adjustment == 0 and self.brightness is not None:
+                factor = _uniform(*self.brightness, batch_size, x.device)
+                x = _blend(x, torch.zeros_like(x), factor)
+            elif adjustment == 1 and self.contrast is not None:
+                factor = _uniform(*self.contrast, batch_size, x.device)
+                mean = _rgb_to_grayscale(x).mean(dim=(-3, -2, -1), keepdim=True)
+                x = _blend(x, mean, factor)
+            elif adjustment == 2 and self.saturation is not None:
+                factor = _uniform(*self.saturation, batch_size, x.device)
+                x = _blend(x, _rgb_to_grayscale(x), factor)
+            elif adjustment == 3 and self.hue is not None:
+                factor = _uniform(*self.hue, batch_size, x.device)
+                hsv = _rgb_to_hsv(x)
+                hsv[:, 0] = torch.remainder(hsv[:, 0] + factor.view(-1, 1, 1), 1.0)
+                x = _hsv_to_rgb(hsv)
+        return x
+
+
+class BatchGaussianBlur:
+    """3x3 gaussian blur with a per sample sigma, as a single grouped convolution."""
+
+    def __init__(self, kernel_size: int = 3, sigma: Tuple[float, float] = (0.1, 2.0)):
+        self.kernel_size = kernel_size
+        self.sigma = sigma
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        batch_size, channels, height, width = x.shape
+        sigma = _uniform(*self.sigma, batch_size, x.device)
+        half = (self.kernel_size - 1) * 0.5
+        grid = torch.linspace(-half, half, self.kernel_size, device=x.device)
+        kernel_1d = torch.exp(-0.5 * (grid[None, :] / sigma[:, None]) ** 2)
+        kernel_1d = kernel_1d / kernel_1d.sum(dim=1, keepdim=True)
+        kernel_2d = kernel_1d[:, :, None] * kernel_1d[:, None, :]
+        weight = kernel_2d.repeat_interleave(channels, dim=0).unsqueeze(1).to(x.dtype)
+        padding = self.kernel_size // 2
+        x = F.pad(x.reshape(1, batch_size * channels, height, width), [padding] * 4, mode="reflect")
+        return F.conv2d(x, weight, groups=batch_size * channels).view(batch_size, channels, height, width)
+
+
+class BatchRandomScale:
+    """RandomAffine(degrees=0, scale=scale) with a per sample scale, zooming around the center."""
+
+    def __init__(self, scale: Tuple[float, float], interpolation: str = "nearest"):
+        self.scale = scale
+        self.interpolation = interpolation
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        batch_size = x.shape[0]
+        scale = _uniform(*self.scale, batch_size, x.device)
+        theta = torch.zeros((batch_size, 2, 3), device=x.device, dtype=x.dtype)
+        theta[:, 0, 0] = 1 / scale
+        theta[:, 1, 1] = 1 / scale
+        grid = F.affine_grid(theta, list(x.shape), align_corners=False)
+        return F.grid_sample(x, grid, mode=self.interpolation, padding_mode="zeros", align_corners=False)
+
+
+class BatchAutoAugment:
+    """
+    AutoAugment with the ImageNet policy on uint8 batches. Every image gets its own
+    sub-policy, applied probabilities and magnitude signs. Images are grouped by sub-policy so
+    each operation runs once per group.
+    """
+
+    _imagenet_policy = (
+        (("Posterize", 0.4, 8), ("Rotate", 0.6, 9)),
+        (("Solarize", 0.6, 5), ("AutoContrast", 0.6, None)),
+        (("Equalize", 0.8, None), ("Equalize", 0.6, None)),
+        (("Posterize", 0.6, 7), ("Posterize", 0.6, 6)),
+        (("Equalize", 0.4, None), ("Solarize", 0.2, 4)),
+        (("Equalize", 0.4, None), ("Rotate", 0.8, 8)),
+        (("Solarize", 0.6, 3), ("Equalize", 0.6, None)),
+        (("Posterize", 0.8, 5), ("Equalize", 1.0, None)),
+        (("Rotate", 0.2, 3), ("Solarize", 0.6, 8)),
+        (("Equalize", 0.6, None), ("Posterize", 0.4, 6)),
+        (("Rotate", 0.8, 8), ("Color", 0.4, 0)),
+        (("Rotate", 0.4, 9), ("Equalize", 0.6, None)),
+        (("Equalize", 0.0, None), ("Equalize", 0.8, None)),
+        (("Invert", 0.6, None), ("Equalize", 1.0, None)),
+        (("Color", 0.6, 4), ("Contrast", 1.0, 8)),
+        (("Rotate", 0.8, 8), ("Color", 1.0, 2)),
+        (("Color", 0.8, 8), ("Solarize", 0.8, 7)),
+        (("Sharpness", 0.4, 7), ("Invert", 0.6, None)),
+        (("ShearX", 0.6, 5), ("Equalize", 1.0, None)),
+        (("Color", 0.4, 0), ("Equalize", 0.6, None)),
+        (("Equalize", 0.4, None), ("Solarize", 0.2, 4)),
+        (("Solarize", 0.6, 5), ("AutoContrast", 0.6, None)),
+        (("Invert", 0.6, None), ("Equalize", 1.0, None)),
+        (("Color", 0.6, 4), ("Contrast", 1.0, 8)),
+        (("Equalize", 0.8, None), ("Equalize", 0.6, None)),
+    )
+    _num_bins = 10
+
+    def __init__(self, interpolation: InterpolationMode = InterpolationMode.NEAREST, fill: Optional[List[float]] = None):
+        self.interpolation = interpolation
+        self.fill = fill
+
+    def _magnitude(self, op_name: str, magnitude_id: Optional[int]) -> Tuple[float, bool]:
+        if magnitude_id is None:
+            return 0.0, False
+        if op_name == "ShearX":
+            return 0.3 * magnitude_id / (self._num_bins - 1), True
+        if op_name == "Rotate":
+            return 30.0 * magnitude_id / (self._num_bins - 1), True
+        if op_name in ("Color", "Contrast", "Sharpness", "Brightness"):
+            return 0.9 * magnitude_id / (self._num_bins - 1), True
+        if op_name == "Posterize":
+            return float(8 - round(magnitude_id / ((self._num_bins - 1) / 4))), False
+        if op_name == "Solarize":
+            return 255.0 * (1 - magnitude_id / (self._num_bins - 1)), False
+        raise ValueError(f"Unsupported AutoAugment operation {op_name}")
+
+    def _apply_op(self, x: torch.Tensor, op_name: str, magnitude: float) -> torch.Tensor:
+        if op_name == "ShearX":
+            return TF.affine(
+                x,
+                angle=0.0,
+                translate=[0, 0],
+                scale=1.0,
+                shear=[math.degrees(math.atan(magnitude)), 0.0],
+                interpolation=self.interpolation,
+                fill=self.fill,
+                center=[0, 0],
+            )
+        if op_name == "Rotate":
+            return TF.rotate(x, magnitude, interpolation=self.interpolation, fill=self.fill)
+        if op_name == "Brightness":
+            return TF.adjust_brightness(x, 1.0 + magnitude)
+        if op_name == "Color":
+            return TF.adjust_saturation(x, 1.0 + magnitude)
+        if op_name == "Contrast":
+            return TF.adjust_contrast(x, 1.0 + magnitude)
+        if op_name == "Sharpness":
+            return TF.adjust_sharpness(x, 1.0 + magnitude)
+        if op_name == "Posterize":
+            return TF.posterize(x, int(magnitude))
+        if op_name == "Solarize":
+            return TF.solarize(x, magnitude)
+        if op_name == "AutoContrast":
+            return TF.autocontrast(x)
+        if op_name == "Equalize":
+            return TF.equalize(x)
+        if op_name == "Invert":
+            return TF.invert(x)
+        raise ValueError(f"Unsupported AutoAugment operation {op_name}")
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        x = x.clone()
+        policy_ids = torch.randint(len(self._imagenet_policy), (x.shape[0],), device=x.device)
+        for policy_id in torch.unique(policy_ids).tolist():
+            group = torch.nonzero(policy_ids == policy_id).squeeze(1)
+            for op_name, p, magnitude_id in self._imagenet_policy[policy_id]:
+                applied = group[torch.rand(group.shape[0], device=x.device) < p]
+                if applied.numel() == 0:
+                    continue
+                magnitude, signed = self._magnitude(op_name, magnitude_id)
+                if signed:
+                    negative = torch.rand(applied.shape[0], device=x.device) < 0.5
+                    subsets = ((applied[~negative], magnitude), (applied[negative], -magnitude))
+                else:
+                    subsets = ((applied, magnitude),)
+                for indices, signed_magnitude in subsets:
+                    if indices.numel() > 0:
+                        x[indices] = self._apply_op(x[indices], op_name, signed_magnitude)
+        return x
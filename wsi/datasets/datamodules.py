@@ -1,17 +1,35 @@
 from typing import Callable, Literal, Optional, Tuple
 
+import numpy as np
+import torch
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 from torchvision import transforms
+from torchvision import transforms as transforms_module  # __init__ has a transforms argument
 
+from .batch_transformations import (
+    BatchAutoAugment,
+    BatchColorJitter,
+    BatchGaussianBlur,
+    BatchRandomCrop,
+    BatchRandomFlip,
+    BatchRandomRot90,
+    BatchRandomScale,
+)
 from .datasets import (
+    create_slides_manager,
     RandomPatchDataset,
     SerialPatchDataset,
+    SlideStridedChunksDataset,
     SlideStridedDataset,
     SlideRandomDataset,
 )
+from .samplers import SlideAwareBatchSampler, SlideShardedSampler
+from .slides_manager import SlidesManager, merge_datasets_folds
 
-from wsi.datasets.transformations import MyGaussianNoiseTransform, MyRotation
+from wsi.core import constants
+from wsi.datasets.transformations import GaussianNoise, MyRotation
+from wsi.utils.features_writer import FeaturesWriter
 # from legacy.datasets_legacy import WSI_REGdataset
 
 NORMALIZATIONS = {
@@ -56,6 +74,17 @@ class WsiDataModule(LightningDataModule):
         openslide: bool = False,
         ssd: bool = True,
         metadata_file_path = None,
+        max_open_files: int = constants.h5_max_open_files,
+        max_open_slides: int = constants.openslide_max_open_files,
+        openslide_tile_cache_bytes: Optional[int] = constants.openslide_tile_cache_bytes,
+        slides_index_dir_path: Optional[str] = constants.slides_index_dir_path,
+        num_loading_workers: int = constants.slides_loading_workers,
+        slide_affinity: bool = False,
+        slides_per_worker: int = 4,
+        slide_rotation_period: int = 8,
+        gpu_augment: bool = False,
+        deterministic_train_patches: bool = False,
+        eval_chunk_size: Optional[int] = None,
         **kwargs
     ):
         """
@@ -74,6 +103,17 @@ class WsiDataModule(LightningDataModule):
             autoaug: whether to use autoaugment imagenet recipe for default train transforms
             transforms: override default transforms, of the form (train_transforms, eval_transforms)
             openslide: whether to use openslide for reading images
+            max_open_files: maximum number of h5 slide files kept open by each dataloader worker
+            max_open_slides: maximum number of OpenSlide handles kept open by each dataloader worker
+            openslide_tile_cache_bytes: size of OpenSlide's tile cache shared by the open slides of a worker
+            slides_index_dir_path: directory of the on-disk slides index shared by all datasets and ranks, None to build it in memory
+            num_loading_workers: number of processes used to build the slides index
+            slide_affinity: whether training batches of each dataloader worker are drawn from a small rotating set of slides
+            slides_per_worker: number of slides each dataloader worker reads from at a time with slide_affinity
+            slide_rotation_period: number of batches after which a slide is rotated out of a worker's set with slide_affinity
+            gpu_augment: whether dataloader workers return uint8 tensors and the transforms run batched on the device of the batch, after the transfer
+            deterministic_train_patches: whether training patches are the same tile centers every epoch, through the eval transforms, e.g. for a frozen backbone embeddings cache
+            eval_chunk_size: evaluate on patches_per_slide_eval patches per slide in chunks of eval_chunk_size patches, batched across slides, instead of one slide per batch (WsiClassifier)
         """
         super().__init__()
 
@@ -93,6 +133,18 @@ class WsiDataModule(LightningDataModule):
         self.autoaug = autoaug
         self.openslide = openslide
         self.metadata_file_path = metadata_file_path
+        self.max_open_files = max_open_files
+        self.max_open_slides = max_open_slides
+        self.openslide_tile_cache_bytes = openslide_tile_cache_bytes
+        self.slides_index_dir_path = slides_index_dir_path
+        self.num_loading_workers = num_loading_workers
+        self.slide_affinity = slide_affinity
+        self.slides_per_worker = slides_per_worker
+        self.slide_rotation_period = slide_rotation_period
+        self.gpu_augment = gpu_augment
+        self.deterministic_train_patches = deterministic_train_patches
+        self.eval_chunk_size = eval_chunk_size
+        self._slides_manager = None
 
         self.GIPDEEP10_OPENSLIDE_ROOT = "/data"
         self.GIPDEEP10_H5_ROOT = "/data/unsynced_data/h5"
@@ -104,10 +156,40 @@ class WsiDataModule(LightningDataModule):
         self.train_transforms, self.eval_transforms = (
             self.define_transforms() if transforms is None else transforms
         )
+        if self.gpu_augment:
+            # the datasets only decode, the recipe runs in on_after_batch_transfer
+            self.train_batch_transforms, self.eval_batch_transforms = self.define_batch_transforms()
+            self.train_transforms = self.eval_transforms = transforms_module.PILToTensor()
 
     def prepare_data(self, *args, **kwargs):
         """Any preparations to be done once before the data is loaded"""
-        pass
+        # builds and saves the slides index once per node, setup on every rank then maps it
+        if self.slides_index_dir_path is not None:
+            self._create_slides_manager()
+
+    def _create_slides_manager(self) -> SlidesManager:
+        return create_slides_manager(
+            datasets_folds=merge_datasets_folds(self.datasets_folds, self.datasets_folds_val),
+            target=self.target,
+            secondary_target=self.secondary_target,
+            min_tiles=min(self.patches_per_slide_train, self.min_tiles_eval),
+            metadata_file_path=self.metadata_file_path,
+            datasets_base_dir_path=(
+                self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
+            ),
+            slides_index_dir_path=self.slides_index_dir_path,
+            num_loading_workers=self.num_loading_workers,
+        )
+
+    def get_slides_manager(self, datasets_folds: dict, min_tiles: int) -> SlidesManager:
+        """A view of the slides manager shared by all the datasets of this datamodule"""
+        if self._slides_manager is None:
+            self._slides_manager = self._create_slides_manager()
+        return self._slides_manager.view(
+            datasets_folds=datasets_folds,
+            min_tiles=min_tiles,
+            secondary_target=self.secondary_target,
+        )
 
     def setup(self, stage=None):
         """Initialize datasets / splits and transforms, called on every process in ddp"""
@@ -119,40 +201,23 @@ class WsiDataModule(LightningDataModule):
                 secondary_target=self.secondary_target,
                 patches_per_slide=self.patches_per_slide_train,
                 min_tiles=self.patches_per_slide_train,
-                transform=self.train_transforms,
+                transform=self.eval_transforms if self.deterministic_train_patches else self.train_transforms,
+                deterministic=self.deterministic_train_patches,
                 datasets_base_dir_path=(
                     self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
                 ),
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                max_open_files=self.max_open_files,
+                max_open_slides=self.max_open_slides,
+                openslide_tile_cache_bytes=self.openslide_tile_cache_bytes,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.patches_per_slide_train),
             )
 
-            self.val_dataset = SlideStridedDataset(
-                datasets_folds=self.datasets_folds_val,
-                target=self.target,
-                secondary_target=self.secondary_target,
-                bag_size=self.patches_per_slide_eval,
-                min_tiles=self.min_tiles_eval,
-                transform=self.eval_transforms,
-                datasets_base_dir_path=(
-                    self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
-                ),
-                metadata_file_path=self.metadata_file_path
-            )
-            
-            self.train_dloader = DataLoader(
-                self.train_dataset,
-                batch_size=self.batch_size,
-                shuffle=True,
-                num_workers=self.num_workers,
-                pin_memory=True,
-                drop_last=True,
-                prefetch_factor=10,
-                persistent_workers=True,
-            )
-            
+            self.val_dataset = self.get_eval_dataset(self.datasets_folds_val)
+
             self.val_dloader = DataLoader(
                 self.val_dataset,
-                batch_size=None,  # each instance is a bag
+                batch_size=self.get_eval_batch_size(),
                 shuffle=False,
                 num_workers=self.num_workers,
                 pin_memory=True,
@@ -161,22 +226,11 @@ class WsiDataModule(LightningDataModule):
             )
             
         elif stage == "test":
-            # TODO: allow testing on more patches per slide with batching, currently the bag size is the batch size so this is limited
-            self.test_dataset = SlideStridedDataset(
-                datasets_folds=self.datasets_folds,
-                target=self.target,
-                secondary_target=self.secondary_target,
-                bag_size=self.patches_per_slide_eval,
-                min_tiles=self.min_tiles_eval,
-                transform=self.eval_transforms,
-                datasets_base_dir_path=(
-                    self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
-                ),
-                metadata_file_path=self.metadata_file_path
-            )
+            # without eval_chunk_size the bag size is the batch size, so patches_per_slide_eval is limited by memory
+            self.test_dataset = self.get_eval_dataset(self.datasets_folds)
             self.test_dloader = DataLoader(
                     self.test_dataset,
-                    batch_size=None,  # each instance is a bag
+                    batch_size=self.get_eval_batch_size(),
                     shuffle=False,
                     num_workers=self.num_workers,
                     prefetch_factor=10,
@@ -184,6 +238,7 @@ class WsiDataModule(LightningDataModule):
                 )
             
         elif stage == "predict":
+            predict_slides_manager = self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval)
             self.predict_dataset = SerialPatchDataset(
                 datasets_folds=self.datasets_folds,
                 target=self.target,
@@ -193,20 +248,109 @@ class WsiDataModule(LightningDataModule):
                 datasets_base_dir_path=(
                     self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
                 ),
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                max_open_files=self.max_open_files,
+                max_open_slides=self.max_open_slides,
+                openslide_tile_cache_bytes=self.openslide_tile_cache_bytes,
+                slides_manager=predict_slides_manager,
             )
-            
+
+            # with a resumable FeaturesWriter every rank extracts whole slides, skipping completed ones
+            predict_sampler = None
+            features_writer = self._get_resumable_features_writer()
+            if features_writer is not None:
+                predict_sampler = SlideShardedSampler(
+                    self.predict_dataset,
+                    tile_offsets=predict_slides_manager.tile_offsets,
+                    skip_slides=features_writer.manifest.get_completed(
+                        slide_names=predict_slides_manager.metadata[constants.file_column_name].to_numpy(),
+                        tiles_counts=np.diff(predict_slides_manager.tile_offsets),
+                    ),
+                )
+                print(f"Extracting features of {len(predict_sampler.slides)} slides on this rank")
+
             self.predict_dloader = DataLoader(
                     self.predict_dataset,
                     batch_size=self.batch_size,
+                    sampler=predict_sampler,
                     shuffle=False,
                     num_workers=self.num_workers,
                     prefetch_factor=10,
                     pin_memory=True,
             )
 
+    def get_eval_dataset(self, datasets_folds: dict):
+        kwargs = dict(
+            datasets_folds=datasets_folds,
+            target=self.target,
+            secondary_target=self.secondary_target,
+            min_tiles=self.min_tiles_eval,
+            transform=self.eval_transforms,
+            datasets_base_dir_path=(
+                self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
+            ),
+            metadata_file_path=self.metadata_file_path,
+            max_open_files=self.max_open_files,
+            max_open_slides=self.max_open_slides,
+            openslide_tile_cache_bytes=self.openslide_tile_cache_bytes,
+            slides_manager=self.get_slides_manager(datasets_folds=datasets_folds, min_tiles=self.min_tiles_eval),
+        )
+        if self.eval_chunk_size is not None:
+            return SlideStridedChunksDataset(
+                patches_per_slide=self.patches_per_slide_eval, chunk_size=self.eval_chunk_size, **kwargs
+            )
+        return SlideStridedDataset(bag_size=self.patches_per_slide_eval, **kwargs)
+
+    def get_eval_batch_size(self) -> Optional[int]:
+        if self.eval_chunk_size is None:
+            return None  # each instance is a bag
+        # chunks of many slides fill a batch
+        return max(self.batch_size // self.eval_chunk_size, 1)
+
+    def _get_resumable_features_writer(self) -> Optional[FeaturesWriter]:
+        if self.trainer is None:
+            return None
+        for callback in self.trainer.callbacks:
+            if isinstance(callback, FeaturesWriter) and callback.resumable:
+                return callback
+        return None
+
+    def get_deterministic_train_transform(self) -> Optional[Callable]:
+        """The transform of the training patches if they are deterministic, None otherwise"""
+        if not self.deterministic_train_patches:
+            return None
+        return self.eval_batch_transforms if self.gpu_augment else self.eval_transforms
+
     def train_dataloader(self):
-        return self.train_dloader
+        # built here and not in setup: Lightning records the constructor arguments of a batch
+        # sampler only inside this hook, and needs them to rebuild it around a DistributedSampler
+        if self.slide_affinity:
+            return DataLoader(
+                self.train_dataset,
+                batch_sampler=SlideAwareBatchSampler(
+                    batch_size=self.batch_size,
+                    drop_last=True,
+                    num_slides=self.train_dataset.num_slides,
+                    instances_per_slide=self.patches_per_slide_train,
+                    slides_per_worker=self.slides_per_worker,
+                    rotation_period=self.slide_rotation_period,
+                    num_workers=self.num_workers,
+                ),
+                num_workers=self.num_workers,
+                pin_memory=True,
+                prefetch_factor=10,
+                persistent_workers=True,
+            )
+        return DataLoader(
+            self.train_dataset,
+            batch_size=self.batch_size,
+            shuffle=True,
+            num_workers=self.num_workers,
+            pin_memory=True,
+            drop_last=True,
+            prefetch_factor=10,
+            persistent_workers=True,
+        )
 
     def val_dataloader(self):
         return self.val_dloader
@@ -217,6 +361,57 @@ class WsiDataModule(LightningDataModule):
     def predict_dataloader(self):
         return self.predict_dloader
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        if not self.gpu_augment:
+            return batch
+        training = self.trainer is not None and self.trainer.training and not self.deterministic_train_patches
+        batch_transforms = self.train_batch_transforms if training else self.eval_batch_transforms
+        if "patch" not in batch and "bag" not in batch:
+            # a training batch without patches, all of its embeddings are cached
+            return batch
+        key = "patch" if "patch" in batch else "bag"
+        if batch[key].dim() == 5:
+            # a batch of chunks
+            batch[key] = batch_transforms(batch[key].flatten(0, 1)).unflatten(0, batch[key].shape[:2])
+        else:
+            batch[key] = batch_transforms(batch[key])
+        return batch
+
+    def define_batch_transforms(self):
+        """The recipes of define_transforms for (B, C, H, W) uint8 batches, with per sample random parameters"""
+        normalization = transforms.Normalize(**NORMALIZATIONS[self.normalization])
+        to_float = transforms.ConvertImageDtype(torch.float32)
+
+        train_transforms = [
+            BatchRandomCrop(size=self.img_size),
+            BatchRandomFlip(dim=-1),
+        ]
+        if self.autoaug == "imagenet":
+            train_transforms.append(BatchAutoAugment())
+        train_transforms.append(to_float)
+
+        if self.autoaug == "wsi_ron":
+            color_param = 0.1
+            scale_factor = 0.2
+            train_transforms += [
+                BatchColorJitter(brightness=color_param, contrast=color_param * 2,
+                                 saturation=color_param, hue=color_param),
+                BatchGaussianBlur(3, sigma=(1e-7, 1e-1)),
+                GaussianNoise(sigma=(0, 0.05)),
+                BatchRandomFlip(dim=-2),
+                BatchRandomRot90(),
+                BatchRandomScale(scale=(1, 1 + scale_factor)),
+            ]
+        train_transforms.append(normalization)
+
+        eval_transforms = [
+            transforms.CenterCrop(size=self.img_size),
+            to_float,
+            normalization,
+        ]
+
+        return transforms.Compose(train_transforms), transforms.Compose(eval_transforms)
+
     def define_transforms(self):
         normalization = transforms.Normalize(**NORMALIZATIONS[self.normalization])
 
@@ -241,15 +436,14 @@ class WsiDataModule(LightningDataModule):
                     transforms.ColorJitter(brightness=color_param, contrast=color_param * 2,
                                            saturation=color_param, hue=color_param),
                     transforms.GaussianBlur(3, sigma=(1e-7, 1e-1)),
-                    MyGaussianNoiseTransform(sigma=(0, 0.05)),
+                    # the noise is added to the tensor, the flip, rotation and scale accept tensors
+                    train_transforms[0],
+                    GaussianNoise(sigma=(0, 0.05)),
                     transforms.RandomVerticalFlip(),
                     MyRotation(angles=[0, 90, 180, 270]),
                     transforms.RandomAffine(degrees=0, scale=(1, 1 + scale_factor)),
                 ]
-            train_transforms = [
-                *transform_ron,
-                *train_transforms,
-            ]
+            train_transforms = [*transform_ron, *train_transforms[1:]]
 
         train_transforms = [
             transforms.RandomCrop(size=self.img_size),
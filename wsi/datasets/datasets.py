@@ -1,16 +1,20 @@
+import ctypes
+import multiprocessing
 import socket
 from abc import ABC, abstractmethod
-from typing import List, Optional, Dict
+from typing import List, Optional, Dict, Tuple
 from datetime import datetime
 
+import numpy as np
 import pandas
 import torch
+from PIL import Image
 from torch.utils.data import Dataset
 from torchvision import transforms
-from torchvision.transforms.functional import to_tensor
 
 from .slides_manager import SlidesManager, default_predicate
 from ..core import constants
+from ..core.handle_pools import configure_h5_pool, configure_openslide_pool
 from ..core.wsi import (
     GridPatchExtractor,
     MultiGridPatchExtractor,
@@ -21,6 +25,50 @@ from ..core.wsi import (
     Patch
 )
 
+
+def create_slides_manager(
+    datasets_folds: Dict,
+    target: str = "er_status",
+    secondary_target: str = None,
+    min_tiles: int = 100,
+    tile_size: int = 256,
+    desired_mpp: float = 1.0,
+    metadata_at_magnification: int = 10,
+    metadata_file_path: Optional[str] = None,
+    datasets_base_dir_path: Optional[str] = None,
+    slides_index_dir_path: Optional[str] = constants.slides_index_dir_path,
+    num_loading_workers: int = constants.slides_loading_workers,
+) -> SlidesManager:
+    if datasets_base_dir_path:
+        assert (
+            len(datasets_base_dir_path) > 0
+        ), "Problem with datasets_base_dir_path path"
+        print(f"Overriding datasets_base_dir_path: {datasets_base_dir_path}")
+    else:
+        if socket.gethostname() == "gipdeep10":
+            datasets_base_dir_path = constants.data_root_gipdeep10
+            print("Using gipdeep10 data.")
+        else:
+            datasets_base_dir_path = constants.data_root_netapp
+    if not metadata_file_path:
+        metadata_file_path = constants.main_metadata_csv
+
+    return SlidesManager(
+        datasets_base_dir_path=datasets_base_dir_path,
+        desired_mpp=desired_mpp,
+        tile_size=tile_size,
+        metadata_at_magnification=metadata_at_magnification,
+        metadata_file_path=metadata_file_path,
+        row_predicate=default_predicate,
+        min_tiles=min_tiles,
+        datasets_folds=constants.get_datasets_folds(datasets_folds),
+        target=target,
+        secondary_target=secondary_target,
+        slides_index_dir_path=slides_index_dir_path,
+        num_loading_workers=num_loading_workers,
+    )
+
+
 class WSIDataset(ABC, Dataset):
     def __init__(
         self,
@@ -36,41 +84,39 @@ class WSIDataset(ABC, Dataset):
         transform=transforms.Compose([]),
         datasets_folds: Dict = {"CAT": [2,3,4,5]},
         slides_manager: SlidesManager = None,
+        max_open_files: int = constants.h5_max_open_files,
+        max_open_slides: int = constants.openslide_max_open_files,
+        max_open_slides_bytes: Optional[int] = constants.openslide_max_open_bytes,
+        openslide_tile_cache_bytes: Optional[int] = constants.openslide_tile_cache_bytes,
+        slides_index_dir_path: Optional[str] = constants.slides_index_dir_path,
+        num_loading_workers: int = constants.slides_loading_workers,
         **kw: object,
     ):
         if kw:
             print(kw)
         super().__init__(**kw)
+        self._max_open_files = max_open_files
+        self._max_open_slides = max_open_slides
+        self._max_open_slides_bytes = max_open_slides_bytes
+        self._openslide_tile_cache_bytes = openslide_tile_cache_bytes
+        self._configure_handle_pools()
         self._target = target
         self._secondary_target = secondary_target
+        datasets_folds = constants.get_datasets_folds(datasets_folds)
+        self.datasets_keys = list(datasets_folds.keys())
         if not slides_manager:
-            if datasets_base_dir_path:
-                assert (
-                    len(datasets_base_dir_path) > 0
-                ), "Problem with datasets_base_dir_path path"
-                print(f"Overriding datasets_base_dir_path: {datasets_base_dir_path}")
-            else:
-                if socket.gethostname() == "gipdeep10":
-                    datasets_base_dir_path = constants.data_root_gipdeep10
-                    print("Using gipdeep10 data.")
-                else:
-                    datasets_base_dir_path = constants.data_root_netapp
-            if not metadata_file_path:
-                metadata_file_path = constants.main_metadata_csv
-            datasets_folds = constants.get_datasets_folds(datasets_folds)
-            self.datasets_keys = list(datasets_folds.keys())
-
-            slides_manager = SlidesManager(
-                datasets_base_dir_path=datasets_base_dir_path,
-                desired_mpp=desired_mpp,
+            slides_manager = create_slides_manager(
+                datasets_folds=datasets_folds,
+                target=target,
+                secondary_target=secondary_target,
+                min_tiles=min_tiles,
                 tile_size=tile_size,
+                desired_mpp=desired_mpp,
                 metadata_at_magnification=metadata_at_magnification,
                 metadata_file_path=metadata_file_path,
-                row_predicate=default_predicate,
-                min_tiles=min_tiles,
-                datasets_folds=datasets_folds,
-                target=target,
-                secondary_target=secondary_target
+                datasets_base_dir_path=datasets_base_dir_path,
+                slides_index_dir_path=slides_index_dir_path,
+                num_loading_workers=num_loading_workers,
             )
         self._slides_manager = slides_manager
         self.num_slides = len(slides_manager)
@@ -80,6 +126,19 @@ class WSIDataset(ABC, Dataset):
     def __len__(self):
         return self._dataset_size
 
+    def __setstate__(self, state):
+        # spawned workers import fresh, default configured pools
+        self.__dict__.update(state)
+        self._configure_handle_pools()
+
+    def _configure_handle_pools(self):
+        configure_h5_pool(max_open=self._max_open_files)
+        configure_openslide_pool(
+            max_open=self._max_open_slides,
+            max_bytes=self._max_open_slides_bytes,
+            tile_cache_bytes=self._openslide_tile_cache_bytes,
+        )
+
 
 class RandomPatchDataset(WSIDataset):
     def __init__(
@@ -96,8 +155,10 @@ class RandomPatchDataset(WSIDataset):
         transform=transforms.Compose([]),
         datasets_folds: Dict = {"CAT": [2,3,4,5]},
         slides_manager: SlidesManager = None,
+        deterministic: bool = False,
         **kw: object,
     ):
+        # deterministic: item i of a slide is always the center of the same tile, strided over the slide
         super().__init__(
             instances_per_slide=patches_per_slide,
             slides_manager=slides_manager,
@@ -114,23 +175,65 @@ class RandomPatchDataset(WSIDataset):
             **kw,
         )
         self._transform = transform
+        self._deterministic = deterministic
+        # shared with the DataLoader workers, persistent ones included
+        self._skip_patches = multiprocessing.RawValue(ctypes.c_bool, False)
+
+    @property
+    def tile_size(self) -> int:
+        return self._slides_manager.tile_size
+
+    @property
+    def desired_mpp(self) -> float:
+        return self._slides_manager.desired_mpp
+
+    @property
+    def skips_patches(self) -> bool:
+        return self._skip_patches.value
+
+    def skip_patches(self, skip: bool):
+        """Items of a deterministic dataset without "patch", e.g. once all their embeddings are cached."""
+        if skip and not self._deterministic:
+            raise ValueError("Only the patches of a deterministic dataset can be skipped")
+        self._skip_patches.value = skip
+
+    def _get_deterministic_tile(self, slide, item: int):
+        stride = max(slide.tiles_count // self._instances_per_slide, 1)
+        return slide.get_tile((stride * (item % self._instances_per_slide)) % slide.tiles_count)
+
+    def get_deterministic_items(self) -> Tuple[List[str], np.ndarray]:
+        """The slide names and the (N, 2) center pixels of all items of a deterministic dataset, without reading them."""
+        slide_names, center_pixels = [], []
+        for slide_idx in range(self.num_slides):
+            slide = self._slides_manager.get_slide(slide_idx)
+            for i in range(self._instances_per_slide):
+                slide_names.append(slide.slide_context.image_file_name)
+                center_pixels.append(self._get_deterministic_tile(slide, i).center_pixel)
+        return slide_names, np.array(center_pixels).reshape(-1, 2)
 
     def __getitem__(self, item: int):
         slide = self._slides_manager.get_slide(item // self._instances_per_slide)
 
         slide_name = slide.slide_context.image_file_name
         dataset_id = self.datasets_keys.index(slide.slide_context.dataset_id)
-        patch_extractor = RandomPatchExtractor(slide=slide)
-        patch, center_pixel = patch_extractor.extract_patch(patch_validators=[])
+        patch = None
+        if self._deterministic:
+            center_pixel = self._get_deterministic_tile(slide, item).center_pixel
+            if not self._skip_patches.value:
+                patch = Patch(slide_context=slide.slide_context, center_pixel=center_pixel)
+        else:
+            patch_extractor = RandomPatchExtractor(slide=slide)
+            patch, center_pixel = patch_extractor.extract_patch(patch_validators=[])
         label = slide.slide_context.get_biomarker_value(bio_marker=self._target)
 
         item =  {
-            "patch": self._transform(patch.image),
             "label": label,
             "slide_name": slide_name,
             "dataset_id": dataset_id,
             "center_pixel": center_pixel,
             }
+        if patch is not None:
+            item["patch"] = self._transform(patch.image)
 
         if self._secondary_target:
             secondary_label = slide.slide_context.get_biomarker_value(bio_marker=self._secondary_target)
@@ -201,6 +304,72 @@ class SerialPatchDataset(WSIDataset):
         return item
 
 
+class SlideTileChunksDataset(WSIDataset):
+    """
+    All tiles of every slide, in order, in chunks of up to chunk_size tiles of one slide. Each
+    chunk is read with a single batched read and returned as (n, T, T, 3) uint8 tiles, the
+    transforms are left to the consumer, e.g. on the device. With thumbnail_size the chunk also
+    has the tiles downsampled to (n, thumbnail_size, thumbnail_size, 3).
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 512,
+        thumbnail_size: int = 0,
+        target: str = "er_status",
+        min_tiles: int = 100,
+        metadata_file_path: str = None,
+        datasets_base_dir_path: str = None,
+        datasets_folds: Dict = {"CAT": [2,3,4,5]},
+        slides_manager: SlidesManager = None,
+        **kw: object,
+    ):
+        super().__init__(
+            instances_per_slide=1,  # will not be used
+            slides_manager=slides_manager,
+            target=target,
+            min_tiles=min_tiles,
+            datasets_folds=datasets_folds,
+            metadata_file_path=metadata_file_path,
+            datasets_base_dir_path=datasets_base_dir_path,
+            **kw,
+        )
+        self._chunk_size = chunk_size
+        self._thumbnail_size = thumbnail_size
+        chunks_counts = -(-np.diff(self._slides_manager.tile_offsets) // chunk_size)
+        self._chunk_offsets = np.concatenate(([0], np.cumsum(chunks_counts))).astype(np.int64)
+        self._dataset_size = int(self._chunk_offsets[-1])
+
+    @property
+    def slides_manager(self) -> SlidesManager:
+        return self._slides_manager
+
+    def __getitem__(self, item: int):
+        slide_idx = int(np.searchsorted(self._chunk_offsets, item, side="right")) - 1
+        chunk_idx = item - int(self._chunk_offsets[slide_idx])
+        slide = self._slides_manager.get_slide(slide_idx)
+        slide_context = slide.slide_context
+        top_left_pixels = slide.pixels[chunk_idx * self._chunk_size:(chunk_idx + 1) * self._chunk_size]
+        tiles = slide_context.read_regions(pixels=top_left_pixels + slide_context.zero_level_half_tile_size)
+
+        item = {
+            "tiles": torch.from_numpy(tiles),
+            "locations": torch.from_numpy(slide_context.pixels_to_locations(pixels=top_left_pixels).astype(np.int64)),
+            "slide_idx": slide_idx,
+            "slide_name": slide_context.image_file_name,
+            "chunk_idx": chunk_idx,
+            "chunks_count": int(self._chunk_offsets[slide_idx + 1] - self._chunk_offsets[slide_idx]),
+        }
+        if self._thumbnail_size:
+            n, size = tiles.shape[0], tiles.shape[1]
+            factor = size // self._thumbnail_size
+            thumbnails = tiles[:, :factor * self._thumbnail_size, :factor * self._thumbnail_size].reshape(
+                n, self._thumbnail_size, factor, self._thumbnail_size, factor, 3
+            )
+            item["thumbnails"] = torch.from_numpy(thumbnails.mean(axis=(2, 4)).astype(np.uint8))
+        return item
+
+
 class SlideDataset(WSIDataset):
     def __init__(
         self,
@@ -246,21 +415,20 @@ class SlideDataset(WSIDataset):
         slide_name = slide.slide_context.image_file_name
         dataset_id = self.datasets_keys.index(slide.slide_context.dataset_id)
         self.patch_extractor = self.patch_extractor_constructor(slide=slide)
-        patch, center_pixel = self.patch_extractor.extract_patch(patch_validators=[])
-        bag_item = to_tensor(patch.image)
-        bag_shape = (self._bag_size, *bag_item.shape)
-        bag = torch.zeros(bag_shape)
         center_pixels = []
-        bag[0] = self._transform(patch.image)
-        center_pixels.append(center_pixel)
-        for idx in range(1, self._bag_size):
-            patch, center_pixel = self.patch_extractor.extract_patch(
-                patch_validators=[]
-            )
+        for idx in range(self._bag_size):
+            _, center_pixel = self.patch_extractor.extract_patch(patch_validators=[])
             center_pixels.append(center_pixel)
-            bag_item = self._transform(patch.image)
 
-            bag[idx] = bag_item
+        # a single batched read, each underlying tile is read once for the whole bag
+        regions = slide.slide_context.read_regions(
+            pixels=np.stack([np.asarray(pixel).flatten() for pixel in center_pixels])
+        )
+        bag_item = self._transform(Image.fromarray(regions[0], mode="RGB"))
+        bag = torch.zeros((self._bag_size, *bag_item.shape), dtype=bag_item.dtype)
+        bag[0] = bag_item
+        for idx in range(1, self._bag_size):
+            bag[idx] = self._transform(Image.fromarray(regions[idx], mode="RGB"))
 
         label = slide.slide_context.get_biomarker_value(bio_marker=self._target)
         label = torch.tensor(label)
@@ -365,6 +533,79 @@ class SlideStridedDataset(SlideDataset):
         return StridedPatchExtractor(slide, self._bag_size)
 
 
+class SlideStridedChunksDataset(WSIDataset):
+    """
+    The patches of SlideStridedDataset with patches_per_slide patches, split into chunks of
+    chunk_size patches of one slide, so chunks of many slides are batched together and any
+    number of patches per slide fits in memory. Every chunk has the index of its slide among
+    slides_count slides, slide scores are reduced by it (see models.slide_metrics). The last
+    chunk of a slide is padded, its mask marks the patches of the slide.
+    """
+
+    def __init__(
+        self,
+        patches_per_slide: int = 1000,
+        chunk_size: int = 64,
+        target: str = "er_status",
+        secondary_target: str = None,
+        min_tiles: int = 100,
+        datasets_folds: Dict = {"CAT": [2,3,4,5]},
+        metadata_file_path: str = None,
+        datasets_base_dir_path: str = None,
+        transform=transforms.Compose([]),
+        slides_manager: SlidesManager = None,
+        **kw: object,
+    ):
+        self._chunks_per_slide = -(-patches_per_slide // chunk_size)
+        super().__init__(
+            instances_per_slide=self._chunks_per_slide,
+            slides_manager=slides_manager,
+            target=target,
+            secondary_target=secondary_target,
+            min_tiles=min_tiles,
+            datasets_folds=datasets_folds,
+            metadata_file_path=metadata_file_path,
+            datasets_base_dir_path=datasets_base_dir_path,
+            transform=transform,
+            **kw,
+        )
+        self._transform = transform
+        self._patches_per_slide = patches_per_slide
+        self._chunk_size = chunk_size
+
+    @property
+    def slide_names(self) -> np.ndarray:
+        return self._slides_manager.metadata[constants.file_column_name].to_numpy()
+
+    def __getitem__(self, item: int):
+        slide_idx, chunk_idx = divmod(item, self._chunks_per_slide)
+        slide = self._slides_manager.get_slide(slide_idx)
+        slide_context = slide.slide_context
+        patch_indices = np.arange(chunk_idx * self._chunk_size, (chunk_idx + 1) * self._chunk_size)
+        # the tiles of StridedPatchExtractor, the padding continues the stride
+        stride = max(slide.tiles_count // self._patches_per_slide, 1)
+        tile_indices = (stride * (patch_indices + 1)) % slide.tiles_count
+        regions = slide_context.read_regions(
+            pixels=slide.pixels[tile_indices] + slide_context.zero_level_half_tile_size
+        )
+        bag = torch.stack([self._transform(Image.fromarray(region, mode="RGB")) for region in regions])
+
+        label = torch.tensor(slide_context.get_biomarker_value(bio_marker=self._target))
+        item = {
+            "bag": bag,
+            "label": label.expand((self._chunk_size, *label.shape)).clone(),
+            "mask": torch.from_numpy(patch_indices < self._patches_per_slide),
+            "slide_idx": slide_idx,
+            "slides_count": self.num_slides,
+            "slide_name": slide_context.image_file_name,
+            "dataset_id": self.datasets_keys.index(slide_context.dataset_id),
+        }
+        if self._secondary_target:
+            secondary_label = slide_context.get_biomarker_value(bio_marker=self._secondary_target)
+            item["secondary_label"] = torch.tensor(secondary_label).expand(self._chunk_size).clone()
+        return item
+
+
 class SlideGridDataset(SlideDataset):
     def __init__(
         self,
@@ -1,12 +1,28 @@
-from pathlib import Path
-from os.path import join
 from typing import Optional, Dict
 
-import h5py
 import numpy as np
 import torch
 
 from wsi.datasets.datasets import SlideGridDataset, SlideMultiGridDataset, SlideRandomDataset, SlideStridedDataset
+from wsi.utils.features_store import FeaturesReader, open_features_reader
+
+
+def _allocate_bag(bag_size: int, features_dim: int, quantization) -> np.ndarray:
+    # int8 bags are filled with the zero point, so missing tiles dequantize to zero features
+    if quantization is None:
+        return np.zeros((bag_size, features_dim), dtype="float32")
+    return np.broadcast_to(quantization[1], (bag_size, features_dim)).astype("int8")
+
+
+def _get_quantization_items(quantization) -> Dict:
+    # int8 features are dequantized on the device by the model, see utils.quantization
+    if quantization is None:
+        return {}
+    scale, zero_point = quantization
+    return {
+        "features_scale": torch.from_numpy(np.asarray(scale, dtype="float32")),
+        "features_zero_point": torch.from_numpy(np.asarray(zero_point, dtype="int32")),
+    }
 
 
 class SlideGridFeaturesDataset(SlideGridDataset):
@@ -19,6 +35,7 @@ class SlideGridFeaturesDataset(SlideGridDataset):
         min_tiles: int = 100,
         datasets_folds: Dict = {'CAT':[2,3,4,5]},
         metadata_file_path: str = None,
+        features_reader: Optional[FeaturesReader] = None,
         **kw: object,
     ):
         super().__init__(
@@ -31,40 +48,26 @@ class SlideGridFeaturesDataset(SlideGridDataset):
             **kw,
         )
         self.features_dir = features_dir
+        self._features_reader = (
+            features_reader if features_reader is not None else open_features_reader(features_dir)
+        )
         self._bag_size = (side_length)**2
 
     def get_bag(self, item: int):
         slide = self._slides_manager.get_slide(item // self._instances_per_slide)
         slide_name = slide.slide_context.image_file_name
-        h5_file_name = f"{slide_name}_features.h5"
-
-        with h5py.File(Path(join(self.features_dir, h5_file_name)), "r") as h5_file:
-            slide_features = h5_file["features"][:]
-            slide_coords = h5_file["coords"][:]
-
         patch_extractor = self.patch_extractor_constructor(slide=slide)
         bag_coords = patch_extractor._pixels_to_extract.astype("int32")
 
-        features_dim = slide_features.shape[1]
-        bag = np.zeros((self._bag_size, features_dim), dtype="float32")
-
-        slide_coords_str = np.array([np.array2string(x) for x in slide_coords.astype("int32")])
-        bag_coords_str = np.array([np.array2string(x) for x in bag_coords.astype("int32")])
-
-        existing_features_indices_in_slide = np.where(
-            np.isin(slide_coords_str, bag_coords_str)
-        )[0]
-        existing_features_indices_in_bag = np.where(
-            np.isin(bag_coords_str, slide_coords_str)
-        )[0]
+        # rows of the bag coords in the slide features, in bag order, -1 for tiles without features
+        rows = self._features_reader.lookup(slide_name, bag_coords)
+        missing = rows < 0
 
-        assert len(existing_features_indices_in_slide) == len(
-            existing_features_indices_in_bag
-        ), f"{len(existing_features_indices_in_slide)=} != {len(existing_features_indices_in_bag)=}"
-
-        bag[existing_features_indices_in_bag] = slide_features[
-            existing_features_indices_in_slide
-        ]
+        # only the rows of the bag are read
+        slide_features = self._features_reader.get_features(slide_name, rows[~missing])
+        quantization = self._features_reader.get_quantization(slide_name)
+        bag = _allocate_bag(self._bag_size, slide_features.shape[1], quantization)
+        bag[~missing] = slide_features
 
         bag, bag_coords = torch.from_numpy(bag), torch.from_numpy(bag_coords)
 
@@ -78,8 +81,10 @@ class SlideGridFeaturesDataset(SlideGridDataset):
         return {
             "features": bag,
             "coords": bag_coords,
+            "missing": torch.from_numpy(missing),
             "label": label,
             "slide_name": slide_name,
+            **_get_quantization_items(quantization),
         }
     
 class SlideMultiGridFeaturesDataset(SlideMultiGridDataset):
@@ -93,6 +98,7 @@ class SlideMultiGridFeaturesDataset(SlideMultiGridDataset):
         min_tiles: int = 100,
         datasets_folds: Dict = {'CAT':[2,3,4,5]},
         metadata_file_path: str = None,
+        features_reader: Optional[FeaturesReader] = None,
         **kw: object,
     ):
         super().__init__(
@@ -106,43 +112,26 @@ class SlideMultiGridFeaturesDataset(SlideMultiGridDataset):
             **kw,
         )
         self.features_dir = features_dir
+        self._features_reader = (
+            features_reader if features_reader is not None else open_features_reader(features_dir)
+        )
         self._bag_size = (side_length**2)*num_grids
 
     def get_bag(self, item: int):
         slide = self._slides_manager.get_slide(item // self._instances_per_slide)
         slide_name = slide.slide_context.image_file_name
-        h5_file_name = f"{slide_name}_features.h5"
-
-        with h5py.File(Path(join(self.features_dir, h5_file_name)), "r") as h5_file:
-            slide_features = h5_file["features"][:]
-            slide_coords = h5_file["coords"][:]
-
         patch_extractor = self.patch_extractor_constructor(slide=slide)
         bag_coords = patch_extractor._pixels_to_extract.astype("int32")
 
-        features_dim = slide_features.shape[1]
-        bag = np.zeros((self._bag_size, features_dim), dtype="float32")
-
-        slide_coords_str = np.unique(np.array([np.array2string(x) for x in slide_coords.astype("int32")]))
-        bag_coords_str = np.unique(np.array([np.array2string(x) for x in bag_coords.astype("int32")]))
-        # print(len(slide_coords_str))
-        # print(len(bag_coords_str))
-        # print(bag_coords_str)
-
-        existing_features_indices_in_slide = np.where(
-            np.isin(slide_coords_str, bag_coords_str)
-        )[0]
-        existing_features_indices_in_bag = np.where(
-            np.isin(bag_coords_str, slide_coords_str)
-        )[0]
+        # rows of the bag coords in the slide features, in bag order, -1 for tiles without features
+        rows = self._features_reader.lookup(slide_name, bag_coords)
+        missing = rows < 0
 
-        assert len(existing_features_indices_in_slide) == len(
-            existing_features_indices_in_bag
-        ), f"{len(existing_features_indices_in_slide)=} != {len(existing_features_indices_in_bag)=}"
-
-        bag[existing_features_indices_in_bag] = slide_features[
-            existing_features_indices_in_slide
-        ]
+        # only the rows of the bag are read
+        slide_features = self._features_reader.get_features(slide_name, rows[~missing])
+        quantization = self._features_reader.get_quantization(slide_name)
+        bag = _allocate_bag(self._bag_size, slide_features.shape[1], quantization)
+        bag[~missing] = slide_features
 
         bag = torch.from_numpy(bag)
 
@@ -156,8 +145,10 @@ class SlideMultiGridFeaturesDataset(SlideMultiGridDataset):
         return {
             "features": bag,
             "coords": bag_coords,
+            "missing": torch.from_numpy(missing),
             "label": label,
             "slide_name": slide_name,
+            **_get_quantization_items(quantization),
         }
 
 
@@ -171,6 +162,7 @@ class SlideRandomFeaturesDataset(SlideRandomDataset):
         min_tiles: int = 100,
         datasets_folds: Dict = {'CAT':[2,3,4,5]},
         metadata_file_path: str = None,
+        features_reader: Optional[FeaturesReader] = None,
         **kw: object,
     ):
         super().__init__(
@@ -183,23 +175,19 @@ class SlideRandomFeaturesDataset(SlideRandomDataset):
             **kw,
         )
         self.features_dir = features_dir
+        self._features_reader = (
+            features_reader if features_reader is not None else open_features_reader(features_dir)
+        )
 
     def get_bag(self, item: int):
         slide = self._slides_manager.get_slide(item // self._instances_per_slide)
         slide_name = slide.slide_context.image_file_name
-        h5_file_name = f"{slide_name}_features.h5"
-
-        with h5py.File(Path(join(self.features_dir, h5_file_name)), "r") as h5_file:
-            slide_features = h5_file["features"][:]
-            slide_coords = h5_file["coords"][:]
+        slide_coords = self._features_reader.get_coords(slide_name)
 
-        tile_indecies = np.random.choice(len(slide_features), self._bag_size)
-        bag_coords = np.array([slide_coords[idx] for idx in tile_indecies])
-
-        features_dim = slide_features.shape[1]
-        bag = np.zeros((self._bag_size, features_dim), dtype="float32")
-
-        bag = slide_features[tile_indecies]
+        tile_indecies = np.random.choice(len(slide_coords), self._bag_size)
+        bag_coords = slide_coords[tile_indecies]
+        bag = self._features_reader.get_features(slide_name, tile_indecies)
+        quantization = self._features_reader.get_quantization(slide_name)
 
         bag, bag_coords = torch.from_numpy(bag), torch.from_numpy(bag_coords)
 
@@ -211,6 +199,7 @@ class SlideRandomFeaturesDataset(SlideRandomDataset):
             "coords": bag_coords,
             "label": label,
             "slide_name": slide_name,
+            **_get_quantization_items(quantization),
         }
 
 
@@ -223,6 +212,7 @@ class SlideStridedFeaturesDataset(SlideStridedDataset):
         min_tiles: int = 100,
         datasets_folds: Dict = {'CAT':[2,3,4,5]},
         metadata_file_path: str = None,
+        features_reader: Optional[FeaturesReader] = None,
         **kw: object,
     ):
         super().__init__(
@@ -235,24 +225,20 @@ class SlideStridedFeaturesDataset(SlideStridedDataset):
         )
         print(features_dir)
         self.features_dir = features_dir
+        self._features_reader = (
+            features_reader if features_reader is not None else open_features_reader(features_dir)
+        )
 
     def get_bag(self, item: int):
         slide = self._slides_manager.get_slide(item // self._instances_per_slide)
         slide_name = slide.slide_context.image_file_name
-        h5_file_name = f"{slide_name}_features.h5"
-
-        with h5py.File(Path(join(self.features_dir, h5_file_name)), "r") as h5_file:
-            slide_features = h5_file["features"][:]
-            slide_coords = h5_file["coords"][:]
+        slide_coords = self._features_reader.get_coords(slide_name)
 
         stride = self.patch_extractor_constructor(slide)._stride
-        tile_indecies = [(stride * i) % slide.tiles_count for i in range(self._bag_size)]
-        bag_coords = np.array([slide_coords[idx] for idx in tile_indecies])
-
-        features_dim = slide_features.shape[1]
-        bag = np.zeros((self._bag_size, features_dim), dtype="float32")
-
-        bag = slide_features[tile_indecies]
+        tile_indecies = (stride * np.arange(self._bag_size)) % slide.tiles_count
+        bag_coords = slide_coords[tile_indecies]
+        bag = self._features_reader.get_features(slide_name, tile_indecies)
+        quantization = self._features_reader.get_quantization(slide_name)
 
         bag, bag_coords = torch.from_numpy(bag), torch.from_numpy(bag_coords)
 
@@ -264,4 +250,5 @@ class SlideStridedFeaturesDataset(SlideStridedDataset):
             "coords": bag_coords,
             "label": label,
             "slide_name": slide_name,
+            **_get_quantization_items(quantization),
         }
\ No newline at end of file
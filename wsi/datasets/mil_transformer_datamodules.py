@@ -3,10 +3,13 @@ from typing import Literal, Optional, Dict, Tuple, Callable
 from pytorch_lightning import LightningDataModule
 from torch.utils.data import DataLoader
 
-from wsi.datasets.datasets import SlideGridDataset
+from wsi.core import constants
+from wsi.datasets.datasets import SlideGridDataset, create_slides_manager
+from wsi.datasets.slides_manager import SlidesManager, merge_datasets_folds
 from wsi.datasets.features_datasets import SlideGridFeaturesDataset, SlideRandomFeaturesDataset, SlideStridedFeaturesDataset, SlideMultiGridFeaturesDataset
+from wsi.utils.features_store import FeaturesReader, open_features_reader
 from torchvision import transforms
-from wsi.datasets.transformations import MyGaussianNoiseTransform, MyRotation
+from wsi.datasets.transformations import GaussianNoise, MyRotation
 from wsi.datasets.datamodules import NORMALIZATIONS
 
 class WsiMILDataModule(LightningDataModule):
@@ -21,6 +24,10 @@ class WsiMILDataModule(LightningDataModule):
         batch_size: int,
         num_workers: int,
         metadata_file_path = None,
+        slides_index_dir_path: Optional[str] = constants.slides_index_dir_path,
+        num_loading_workers: int = constants.slides_loading_workers,
+        features_cache_bytes: int = 0,
+        features_cache_dir_path: str = constants.features_cache_dir_path,
         **kwargs
     ):
         """
@@ -33,6 +40,10 @@ class WsiMILDataModule(LightningDataModule):
             min_tiles_eval: Minimum number of tiles per slide during validation and testing
             batch_size: Batch size for the DataLoader
             num_workers: Number of DataLoader workers
+            slides_index_dir_path: Directory of the on-disk slides index shared by all datasets and ranks, None to build it in memory
+            num_loading_workers: Number of processes used to build the slides index
+            features_cache_bytes: Size of the node wide in-RAM cache of slide features shared by all workers, ranks and features dirs cached in features_cache_dir_path, 0 to read the features from disk every time
+            features_cache_dir_path: Directory of the features cache, should be on a RAM backed file system such as /dev/shm
         """
         super().__init__()
 
@@ -47,10 +58,45 @@ class WsiMILDataModule(LightningDataModule):
         self.min_tiles_eval = min_tiles_eval
         self.batch_size = batch_size
         self.num_workers = num_workers
+        self.slides_index_dir_path = slides_index_dir_path
+        self.num_loading_workers = num_loading_workers
+        self.features_cache_bytes = features_cache_bytes
+        self.features_cache_dir_path = features_cache_dir_path
+        self._slides_manager = None
+
+    @property
+    def datasets_base_dir_path(self) -> Optional[str]:
+        return None
 
     def prepare_data(self, *args, **kwargs):
         """Any preparations to be done once before the data is loaded"""
-        pass
+        # builds and saves the slides index once per node, setup on every rank then maps it
+        if self.slides_index_dir_path is not None:
+            self._create_slides_manager()
+
+    def _create_slides_manager(self) -> SlidesManager:
+        return create_slides_manager(
+            datasets_folds=merge_datasets_folds(self.datasets_folds, self.datasets_folds_val),
+            target=self.target,
+            min_tiles=min(self.min_tiles_train, self.min_tiles_eval),
+            metadata_file_path=self.metadata_file_path,
+            datasets_base_dir_path=self.datasets_base_dir_path,
+            slides_index_dir_path=self.slides_index_dir_path,
+            num_loading_workers=self.num_loading_workers,
+        )
+
+    def get_slides_manager(self, datasets_folds: Dict, min_tiles: int) -> SlidesManager:
+        """A view of the slides manager shared by all the datasets of this datamodule"""
+        if self._slides_manager is None:
+            self._slides_manager = self._create_slides_manager()
+        return self._slides_manager.view(datasets_folds=datasets_folds, min_tiles=min_tiles)
+
+    def get_features_reader(self, features_dir: str) -> FeaturesReader:
+        return open_features_reader(
+            features_dir,
+            cache_bytes=self.features_cache_bytes,
+            cache_dir_path=self.features_cache_dir_path,
+        )
 
     def train_dataloader(self):
         return DataLoader(
@@ -123,7 +169,8 @@ class WsiFeaturesDataModule(WsiMILDataModule):
             min_tiles_eval = min_tiles_eval,
             batch_size = batch_size,
             metadata_file_path = metadata_file_path,
-            num_workers = num_workers
+            num_workers = num_workers,
+            **kwargs
         )
 
         self.save_hyperparameters()
@@ -141,30 +188,36 @@ class WsiFeaturesDataModule(WsiMILDataModule):
         if stage == "fit":
             self.train_dataset = SlideGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_train,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_train),
             )
 
             self.val_dataset = SlideGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds_val,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds_val, min_tiles=self.min_tiles_eval),
             )
         elif stage == "test":
             self.test_dataset = SlideGridFeaturesDataset(
                 features_dir=self.test_features_dir,
+                features_reader=self.get_features_reader(self.test_features_dir),
                 bags_per_slide=self.bags_per_slide,
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval),
             )
 
 class WsiGridFeaturesDataModule(WsiMILDataModule):
@@ -210,7 +263,8 @@ class WsiGridFeaturesDataModule(WsiMILDataModule):
             min_tiles_eval = min_tiles_eval,
             batch_size = batch_size,
             metadata_file_path = metadata_file_path,
-            num_workers = num_workers
+            num_workers = num_workers,
+            **kwargs
         )
 
         self.save_hyperparameters()
@@ -228,30 +282,36 @@ class WsiGridFeaturesDataModule(WsiMILDataModule):
         if stage == "fit":
             self.train_dataset = SlideGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_train,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_train),
             )
 
             self.val_dataset = SlideGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds_val,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds_val, min_tiles=self.min_tiles_eval),
             )
         elif stage == "test":
             self.test_dataset = SlideGridFeaturesDataset(
                 features_dir=self.test_features_dir,
+                features_reader=self.get_features_reader(self.test_features_dir),
                 bags_per_slide=self.bags_per_slide,
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval),
             )
 
 class WsiMultiGridFeaturesDataModule(WsiMILDataModule):
@@ -296,7 +356,8 @@ class WsiMultiGridFeaturesDataModule(WsiMILDataModule):
             min_tiles_eval = min_tiles_eval,
             batch_size = batch_size,
             metadata_file_path = metadata_file_path,
-            num_workers = num_workers
+            num_workers = num_workers,
+            **kwargs
         )
 
         self.save_hyperparameters()
@@ -315,32 +376,38 @@ class WsiMultiGridFeaturesDataModule(WsiMILDataModule):
         if stage == "fit":
             self.train_dataset = SlideMultiGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 num_grids=self.num_grids,
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_train,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_train),
             )
 
             self.val_dataset = SlideMultiGridFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 num_grids=self.num_grids,
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds_val,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds_val, min_tiles=self.min_tiles_eval),
             )
         elif stage == "test":
             self.test_dataset = SlideMultiGridFeaturesDataset(
                 features_dir=self.test_features_dir,
+                features_reader=self.get_features_reader(self.test_features_dir),
                 num_grids=self.num_grids,
                 side_length=self.grid_side_length,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval),
             )
 
 
@@ -384,7 +451,8 @@ class WsiRandomFeaturesDataModule(WsiMILDataModule):
             min_tiles_eval = min_tiles_eval,
             batch_size = batch_size,
             num_workers = num_workers,
-            metadata_file_path = metadata_file_path
+            metadata_file_path = metadata_file_path,
+            **kwargs
         )
 
         self.save_hyperparameters()
@@ -399,31 +467,37 @@ class WsiRandomFeaturesDataModule(WsiMILDataModule):
         if stage == "fit":
             self.train_dataset = SlideRandomFeaturesDataset(
                 features_dir=self.features_dir,
+                features_reader=self.get_features_reader(self.features_dir),
                 bag_size=self.bag_size,
                 target=self.target,
                 min_tiles=self.min_tiles_train,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_train),
             )
 
             self.val_dataset = SlideRandomFeaturesDataset(
                 bags_per_slide=self.bags_per_slide,
                 features_dir=self.test_features_dir,
+                features_reader=self.get_features_reader(self.test_features_dir),
                 bag_size=self.bag_size,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds_val,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds_val, min_tiles=self.min_tiles_eval),
             )
         elif stage == "test":
             self.test_dataset = SlideRandomFeaturesDataset(
                 features_dir=self.test_features_dir,
+                features_reader=self.get_features_reader(self.test_features_dir),
                 bags_per_slide=self.bags_per_slide,
                 bag_size=self.bag_size,
                 target=self.target,
                 min_tiles=self.min_tiles_eval,
                 datasets_folds=self.datasets_folds,
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval),
             )
 
 class WsiGridDataModule(WsiMILDataModule):
@@ -472,7 +546,8 @@ class WsiGridDataModule(WsiMILDataModule):
             min_tiles_eval = min_tiles_eval,
             batch_size = batch_size,
             num_workers = num_workers,
-            metadata_file_path = metadata_file_path
+            metadata_file_path = metadata_file_path,
+            **kwargs
         )
         
         self.save_hyperparameters()
@@ -497,6 +572,10 @@ class WsiGridDataModule(WsiMILDataModule):
             self.define_transforms() if transforms is None else transforms
         )
 
+    @property
+    def datasets_base_dir_path(self) -> Optional[str]:
+        return self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
+
     def setup(self, stage=None):
         """Initialize datasets / splits and transforms, called on every process in ddp"""
 
@@ -510,7 +589,8 @@ class WsiGridDataModule(WsiMILDataModule):
                 datasets_base_dir_path=(
                     self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
                 ),
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_train),
             )
 
             self.val_dataset = SlideGridDataset(
@@ -523,7 +603,8 @@ class WsiGridDataModule(WsiMILDataModule):
                 datasets_base_dir_path=(
                     self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
                 ),
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds_val, min_tiles=self.min_tiles_eval),
             )
         elif stage == "test":
             self.test_dataset = SlideGridDataset(
@@ -536,7 +617,8 @@ class WsiGridDataModule(WsiMILDataModule):
                 datasets_base_dir_path=(
                     self.GIPDEEP10_OPENSLIDE_ROOT if self.openslide else self.GIPDEEP10_H5_ROOT
                 ),
-                metadata_file_path=self.metadata_file_path
+                metadata_file_path=self.metadata_file_path,
+                slides_manager=self.get_slides_manager(datasets_folds=self.datasets_folds, min_tiles=self.min_tiles_eval),
             )
 
     def define_transforms(self):
@@ -563,15 +645,14 @@ class WsiGridDataModule(WsiMILDataModule):
                     transforms.ColorJitter(brightness=color_param, contrast=color_param * 2,
                                            saturation=color_param, hue=color_param),
                     transforms.GaussianBlur(3, sigma=(1e-7, 1e-1)),
-                    MyGaussianNoiseTransform(sigma=(0, 0.05)),
+                    # the noise is added to the tensor, the flip, rotation and scale accept tensors
+                    train_transforms[0],
+                    GaussianNoise(sigma=(0, 0.05)),
                     transforms.RandomVerticalFlip(),
                     MyRotation(angles=[0, 90, 180, 270]),
                     transforms.RandomAffine(degrees=0, scale=(1, 1 + scale_factor)),
                 ]
-            train_transforms = [
-                *transform_ron,
-                *train_transforms,
-            ]
+            train_transforms = [*transform_ron, *train_transforms[1:]]
 
         train_transforms = [
             transforms.RandomCrop(size=self.img_size),
@@ -0,0 +1,202 @@
+from collections import deque
+from typing import Iterator, List, Optional
+
+import numpy as np
+import torch.distributed as dist
+from torch.utils.data import BatchSampler, DistributedSampler, Sampler, SequentialSampler
+
+
+class SlideAwareBatchSampler(BatchSampler):
+    """
+    Batch sampler for datasets whose item i belongs to slide i // instances_per_slide
+    (e.g. RandomPatchDataset) that keeps every DataLoader worker on a few slides at a time.
+
+    Each epoch every item is sampled exactly once, as with shuffle=True. Items are split
+    into one stream per worker, each stream over its own share of the slides. A stream
+    draws its batches from slides_per_worker active slides, in proportion to the items
+    they have left. A slide leaves the active set when it runs out of items or after
+    rotation_period batches, in which case its remaining items go back to the end of the
+    stream's queue. Batches are emitted round-robin over the streams, matching the
+    round-robin assignment of batches to DataLoader workers, so each worker keeps
+    reading from the same small set of slides. A batch needs at least
+    batch_size / instances_per_slide slides, so that is the effective lower bound of
+    slides_per_worker.
+
+    Under DDP the slides (not the items) are split across ranks, so ranks see disjoint
+    slides. Every rank gets the same number of slides (the last slides of the
+    permutation are repeated if needed). When Lightning replaces the sampler with a
+    DistributedSampler, the rank and world size are taken from it, otherwise from
+    torch.distributed if it is initialized. Lightning rebuilds the batch sampler with its
+    original arguments only if it was created inside a *_dataloader hook, so it must be
+    created there, not in setup.
+    """
+
+    def __init__(
+        self,
+        sampler: Optional[Sampler] = None,
+        batch_size: int = 256,
+        drop_last: bool = True,
+        num_slides: int = 0,
+        instances_per_slide: int = 1,
+        slides_per_worker: int = 4,
+        rotation_period: int = 8,
+        num_workers: int = 0,
+        seed: int = 0,
+    ):
+        if sampler is None:
+            sampler = SequentialSampler(range(num_slides * instances_per_slide))
+        super().__init__(sampler=sampler, batch_size=batch_size, drop_last=drop_last)
+        self._num_slides = num_slides
+        self._instances_per_slide = instances_per_slide
+        self._slides_per_worker = max(slides_per_worker, 1)
+        self._rotation_period = max(rotation_period, 1)
+        self._num_streams = max(num_workers, 1)
+        self._seed = seed
+        self._epoch = 0
+        self._rank, self._world_size = self._get_distributed_info(sampler)
+
+    @staticmethod
+    def _get_distributed_info(sampler: Sampler):
+        if isinstance(sampler, DistributedSampler):
+            return sampler.rank, sampler.num_replicas
+        if dist.is_available() and dist.is_initialized():
+            return dist.get_rank(), dist.get_world_size()
+        return 0, 1
+
+    @property
+    def slides_per_rank(self) -> int:
+        return -(-self._num_slides // self._world_size)
+
+    @property
+    def samples_per_rank(self) -> int:
+        return self.slides_per_rank * self._instances_per_slide
+
+    def set_epoch(self, epoch: int):
+        self._epoch = epoch
+
+    def __len__(self) -> int:
+        if self.drop_last:
+            return self.samples_per_rank // self.batch_size
+        return -(-self.samples_per_rank // self.batch_size)
+
+    def __iter__(self) -> Iterator[List[int]]:
+        # the slide permutation must be the same on all ranks, the rest may differ
+        permutation = np.random.default_rng((self._seed, self._epoch)).permutation(self._num_slides)
+        padding = self.slides_per_rank * self._world_size - self._num_slides
+        if padding > 0:
+            permutation = np.concatenate((permutation, permutation[:padding]))
+        rank_slides = permutation[self._rank::self._world_size]
+
+        rng = np.random.default_rng((self._seed, self._epoch, self._rank))
+        streams = [
+            self._stream_batches(slides=rank_slides[i::self._num_streams], rng=rng)
+            for i in range(self._num_streams)
+        ]
+
+        # full batches round-robin over the streams, the partial last batches of all streams are merged at the end
+        leftovers = []
+        active_streams = list(streams)
+        while active_streams:
+            for stream in list(active_streams):
+                batch = next(stream, None)
+                if batch is None:
+                    active_streams.remove(stream)
+                elif len(batch) < self.batch_size:
+                    leftovers.extend(batch)
+                    active_streams.remove(stream)
+                else:
+                    yield batch
+
+        for start in range(0, len(leftovers), self.batch_size):
+            batch = leftovers[start:start + self.batch_size]
+            if len(batch) == self.batch_size or not self.drop_last:
+                yield batch
+
+    def _stream_batches(self, slides: np.ndarray, rng: np.random.Generator) -> Iterator[List[int]]:
+        queue = deque(
+            rng.permutation(self._instances_per_slide) + slide * self._instances_per_slide
+            for slide in slides
+        )
+        active = []  # [items left, batches spent in the active set]
+        while queue or active:
+            batch = []
+            while len(batch) < self.batch_size and (queue or active):
+                while queue and len(active) < self._slides_per_worker:
+                    active.append([queue.popleft(), 0])
+
+                remaining = np.array([len(items) for items, _ in active])
+                n = min(self.batch_size - len(batch), int(remaining.sum()))
+                counts = np.minimum(rng.multinomial(n, remaining / remaining.sum()), remaining)
+                for i in np.argsort(counts - remaining):
+                    # draws above what a slide has left are moved to the slides with items to spare
+                    missing = n - int(counts.sum())
+                    if missing == 0:
+                        break
+                    counts[i] += min(missing, remaining[i] - counts[i])
+
+                for entry, count in zip(active, counts):
+                    batch.extend(entry[0][:count].tolist())
+                    entry[0] = entry[0][count:]
+                active = [entry for entry in active if len(entry[0]) > 0]
+
+            next_active = []
+            for items, batches in active:
+                if batches + 1 >= self._rotation_period and queue:
+                    queue.append(items)
+                else:
+                    next_active.append([items, batches + 1])
+            active = next_active
+
+            rng.shuffle(batch)
+            yield batch
+
+
+class SlideShardedSampler(DistributedSampler):
+    """
+    Sampler of tile datasets (e.g. SerialPatchDataset) for feature extraction, that gives
+    every rank whole slides, balanced by their tiles counts, and yields the tiles of each
+    slide in order and in one piece. Slides marked in skip_slides (e.g. completed by an
+    earlier run) are left out. It is a DistributedSampler so Lightning does not replace it.
+    """
+
+    def __init__(
+        self,
+        dataset,
+        tile_offsets: np.ndarray,
+        skip_slides: Optional[np.ndarray] = None,
+        num_replicas: Optional[int] = None,
+        rank: Optional[int] = None,
+    ):
+        if num_replicas is None or rank is None:
+            distributed = dist.is_available() and dist.is_initialized()
+            num_replicas = dist.get_world_size() if distributed else 1
+            rank = dist.get_rank() if distributed else 0
+        super().__init__(dataset, num_replicas=num_replicas, rank=rank, shuffle=False)
+        tiles_counts = np.diff(tile_offsets)
+        slides = np.arange(tiles_counts.shape[0])
+        if skip_slides is not None:
+            slides = slides[~skip_slides]
+
+        # largest slides first, each to the rank with the fewest tiles so far
+        loads = np.zeros(num_replicas, dtype=np.int64)
+        rank_slides = []
+        for slide in slides[np.argsort(-tiles_counts[slides], kind="stable")]:
+            slide_rank = int(np.argmin(loads))
+            loads[slide_rank] += tiles_counts[slide]
+            if slide_rank == rank:
+                rank_slides.append(slide)
+        self._slides = np.sort(np.array(rank_slides, dtype=np.int64))
+        self._tile_offsets = tile_offsets
+        self.num_samples = int(loads[rank])
+        self.total_size = int(loads.sum())
+
+    @property
+    def slides(self) -> np.ndarray:
+        return self._slides
+
+    def __iter__(self) -> Iterator[int]:
+        for slide in self._slides:
+            yield from range(int(self._tile_offsets[slide]), int(self._tile_offsets[slide + 1]))
+
+    def __len__(self) -> int:
+        return self.num_samples
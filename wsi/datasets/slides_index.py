@@ -0,0 +1,264 @@
+import hashlib
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+import pandas
+from tqdm import tqdm
+
+from ..core import constants, utils
+from ..core.wsi import Slide, SlideContext
+
+# bump when the content or the layout of the index changes
+slides_index_version = 1
+
+_index_columns = [
+    constants.file_column_name,
+    constants.dataset_id_column_name,
+    constants.mpp_column_name,
+    constants.magnification_column_name,
+]
+
+
+class SlidesIndex:
+    """
+    Per slide data needed to build Slide objects without opening the slides: the tiles of
+    all slides in one (tiles_count, 2) int32 table, where the tiles of slide i are rows
+    tile_offsets[i]:tile_offsets[i + 1], and the OpenSlide level and level downsample
+    (-1 and nan for h5 slides).
+    """
+
+    _arrays = ("tile_pixels", "tile_offsets", "levels", "level_downsamples")
+
+    def __init__(
+        self,
+        tile_pixels: np.ndarray,
+        tile_offsets: np.ndarray,
+        levels: np.ndarray,
+        level_downsamples: np.ndarray,
+        index_dir_path: Optional[Path] = None,
+    ):
+        self._index_dir_path = index_dir_path
+        self._tile_pixels = tile_pixels
+        self._tile_offsets = tile_offsets
+        self._levels = levels
+        self._level_downsamples = level_downsamples
+
+    @property
+    def tile_pixels(self) -> np.ndarray:
+        return self._tile_pixels
+
+    @property
+    def tile_offsets(self) -> np.ndarray:
+        return self._tile_offsets
+
+    @property
+    def slides_count(self) -> int:
+        return self._tile_offsets.shape[0] - 1
+
+    @property
+    def tiles_counts(self) -> np.ndarray:
+        return np.diff(self._tile_offsets)
+
+    def get_pixels(self, slide_idx: int) -> np.ndarray:
+        return self._tile_pixels[self._tile_offsets[slide_idx]:self._tile_offsets[slide_idx + 1]]
+
+    def get_level(self, slide_idx: int) -> Tuple[Optional[int], Optional[float]]:
+        level = int(self._levels[slide_idx])
+        if level < 0:
+            return None, None
+        level_downsample = float(self._level_downsamples[slide_idx])
+        if level_downsample.is_integer():
+            level_downsample = int(level_downsample)
+        return level, level_downsample
+
+    def save(self, index_dir_path: Path):
+        """Writes the index to a temporary directory and renames it into place, so readers never see a partial index."""
+        index_dir_path = Path(index_dir_path)
+        index_dir_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_dir_path = index_dir_path.with_name(f"{index_dir_path.name}.tmp-{os.getpid()}")
+        tmp_dir_path.mkdir(parents=True, exist_ok=True)
+        for name in SlidesIndex._arrays:
+            np.save(tmp_dir_path / f"{name}.npy", getattr(self, f"_{name}"))
+        try:
+            os.replace(tmp_dir_path, index_dir_path)
+        except OSError:
+            # another process (e.g. a different DDP rank) saved the same index first
+            shutil.rmtree(tmp_dir_path, ignore_errors=True)
+
+    @staticmethod
+    def load(index_dir_path: Path, mmap: bool = True) -> "SlidesIndex":
+        mmap_mode = "r" if mmap else None
+        arrays = {
+            name: np.load(Path(index_dir_path) / f"{name}.npy", mmap_mode=mmap_mode)
+            for name in SlidesIndex._arrays
+        }
+        return SlidesIndex(**arrays, index_dir_path=Path(index_dir_path) if mmap else None)
+
+    def __getstate__(self):
+        # pickling a memory-mapped array copies it, a stored index is mapped again instead
+        if self._index_dir_path is not None:
+            return {"_index_dir_path": self._index_dir_path}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if set(state.keys()) == {"_index_dir_path"}:
+            state = SlidesIndex.load(state["_index_dir_path"]).__dict__
+        self.__dict__.update(state)
+
+
+def _get_tiles_file_path(row: Dict, dataset_paths: Dict[str, Path], desired_mpp: float, tile_size: int) -> Path:
+    # the file the tiles of a slide are loaded from, see TilesManager._load_pixels
+    dataset_path = dataset_paths[row[constants.dataset_id_column_name]]
+    image_file_path = dataset_path / row[constants.file_column_name]
+    if "/h5" in str(dataset_path):
+        return Path(f"{image_file_path}.h5")
+    return utils.build_segmentation_data_path(
+        dataset_path=dataset_path,
+        desired_magnification=round((desired_mpp**-1.0) * 10),
+        image_file_name_stem=image_file_path.stem,
+        tile_size=tile_size,
+    )
+
+
+def _get_tiles_files_stats(
+    metadata: pandas.DataFrame, dataset_paths: Dict[str, Path], desired_mpp: float, tile_size: int
+) -> np.ndarray:
+    # (slides_count, 2) size and mtime of the tiles file of every slide, -1 for missing files
+    stats = np.full((len(metadata), 2), -1, dtype=np.int64)
+    for i, row in enumerate(metadata[[constants.dataset_id_column_name, constants.file_column_name]].to_dict("records")):
+        try:
+            stat = os.stat(_get_tiles_file_path(row, dataset_paths, desired_mpp, tile_size))
+        except (OSError, KeyError):
+            continue
+        stats[i] = stat.st_size, stat.st_mtime_ns
+    return stats
+
+
+def get_slides_index_key(
+    metadata: pandas.DataFrame,
+    dataset_paths: Dict[str, Path],
+    datasets_base_dir_path: Path,
+    tile_size: int,
+    desired_mpp: float,
+) -> str:
+    """
+    The key of the index of the metadata rows, tile_size and mpp. It includes the size and mtime
+    of the grid data or h5 file of every slide, so re-running segmentation or tiling rebuilds it.
+    """
+    columns = [column for column in _index_columns if column in metadata.columns]
+    rows_hash = pandas.util.hash_pandas_object(
+        metadata[columns].astype(str), index=False
+    ).to_numpy()
+    key = hashlib.sha1(rows_hash.tobytes())
+    key.update(_get_tiles_files_stats(metadata, dataset_paths, desired_mpp, tile_size).tobytes())
+    key.update(
+        f"{datasets_base_dir_path}|{tile_size}|{desired_mpp}|{slides_index_version}".encode()
+    )
+    return key.hexdigest()
+
+
+def _load_slide_entry(
+    args: Tuple[pandas.DataFrame, Dict[str, Path], float, int]
+) -> Tuple[np.ndarray, int, float]:
+    row, dataset_paths, desired_mpp, tile_size = args
+    slide_context = SlideContext(
+        row_index=0,
+        metadata=row,
+        dataset_paths=dataset_paths,
+        desired_mpp=desired_mpp,
+        tile_size=tile_size,
+    )
+    slide = Slide(slide_context=slide_context)
+    level, level_downsample = slide_context.level, slide_context.level_downsample
+    return (
+        slide.pixels,
+        -1 if level is None else level,
+        np.nan if level_downsample is None else level_downsample,
+    )
+
+
+def build_slides_index(
+    metadata: pandas.DataFrame,
+    dataset_paths: Dict[str, Path],
+    desired_mpp: float,
+    tile_size: int,
+    num_workers: int = 0,
+) -> SlidesIndex:
+    """Loads the segmentation pixels and OpenSlide levels of every metadata row, using a process pool when num_workers > 0."""
+    tasks = (
+        (metadata.iloc[[i]], dataset_paths, desired_mpp, tile_size)
+        for i in range(len(metadata))
+    )
+    if num_workers > 0:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            entries = list(
+                tqdm(
+                    executor.map(_load_slide_entry, tasks, chunksize=16),
+                    total=len(metadata),
+                    desc="Loading slides",
+                )
+            )
+    else:
+        entries = [
+            _load_slide_entry(task)
+            for task in tqdm(tasks, total=len(metadata), desc="Loading slides")
+        ]
+
+    counts = np.array([entry[0].shape[0] for entry in entries], dtype=np.int64)
+    return SlidesIndex(
+        tile_pixels=(
+            np.concatenate([entry[0] for entry in entries])
+            if entries
+            else np.zeros((0, 2), dtype=np.int32)
+        ),
+        tile_offsets=np.concatenate(([0], np.cumsum(counts))).astype(np.int64),
+        levels=np.array([entry[1] for entry in entries], dtype=np.int32),
+        level_downsamples=np.array([entry[2] for entry in entries], dtype=np.float64),
+    )
+
+
+def load_or_build_slides_index(
+    metadata: pandas.DataFrame,
+    dataset_paths: Dict[str, Path],
+    datasets_base_dir_path: Path,
+    desired_mpp: float,
+    tile_size: int,
+    slides_index_dir_path: Optional[Path] = None,
+    num_workers: int = 0,
+) -> SlidesIndex:
+    """
+    Returns the memory-mapped index stored in slides_index_dir_path under a key of the metadata
+    rows, tile_size, mpp and tiles files (see get_slides_index_key), building and saving it first if needed. Without a
+    slides_index_dir_path the index is built in memory.
+    """
+    if slides_index_dir_path is None:
+        return build_slides_index(
+            metadata=metadata,
+            dataset_paths=dataset_paths,
+            desired_mpp=desired_mpp,
+            tile_size=tile_size,
+            num_workers=num_workers,
+        )
+
+    index_dir_path = Path(slides_index_dir_path) / get_slides_index_key(
+        metadata=metadata,
+        dataset_paths=dataset_paths,
+        datasets_base_dir_path=datasets_base_dir_path,
+        tile_size=tile_size,
+        desired_mpp=desired_mpp,
+    )
+    if not index_dir_path.is_dir():
+        build_slides_index(
+            metadata=metadata,
+            dataset_paths=dataset_paths,
+            desired_mpp=desired_mpp,
+            tile_size=tile_size,
+            num_workers=num_workers,
+        ).save(index_dir_path)
+    else:
+        print(f"Using slides index {index_dir_path}")
+    return SlidesIndex.load(index_dir_path)
@@ -1,13 +1,14 @@
+import copy
 from pathlib import Path
 from typing import Callable, Dict, List, Optional, Tuple
 
 import pandas
 import numpy as np
-from tqdm import tqdm
 
 from ..core import constants
 from ..core.metadata import MetadataBase
-from ..core.wsi import Slide, SlideContext, Tile, TilesManager
+from ..core.wsi import Slide, SlideContext, Tile
+from .slides_index import load_or_build_slides_index
 
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import QuantileTransformer, OrdinalEncoder
@@ -65,15 +66,18 @@ class SlidesManager(MetadataBase):
         metadata_file_path: Path,
         target: str,
         row_predicate: Callable = default_predicate,  # [[pandas.DataFrame, ...], pandas.Index] somehow causes a bug, I have no idea why
+        slides_index_dir_path: Optional[Path] = None,
+        num_loading_workers: int = 0,
         # use_taular_data: bool = False,
         # tabular_transform_pipeline: Callable = None,
         **predicate_args,
     ):
         self._desired_mpp = desired_mpp
+        self._slides_index_dir_path = slides_index_dir_path
+        self._num_loading_workers = num_loading_workers
         self._metadata_file_path = metadata_file_path
         self.target = target
         self._slides = []
-        self._current_slides = []
         # self._tile_to_slide_dict = self._create_tile_to_slide_dict()
         MetadataBase.__init__(
             self,
@@ -85,55 +89,101 @@ class SlidesManager(MetadataBase):
         
         self._df[self.target] = self.make_target_column()
         self._df = self._df.iloc[row_predicate(self._df, target=target, **predicate_args)].reset_index()
-        self._current_slides = self._create_slides()
-        self._tiles_df = self._create_tiles_df()
+        self._slides_index = load_or_build_slides_index(
+            metadata=self._df,
+            dataset_paths=self._dataset_paths,
+            datasets_base_dir_path=datasets_base_dir_path,
+            desired_mpp=self._desired_mpp,
+            tile_size=self._tile_size,
+            slides_index_dir_path=self._slides_index_dir_path,
+            num_workers=self._num_loading_workers,
+        )
+        self._set_slide_indices(np.arange(len(self._df)))
+        self._file_name_to_slide = self._create_file_name_to_slide_dict()
 
         # self.tabular_transform_pipeline = tabular_transform_pipeline if tabular_transform_pipeline else self._create_transform_pipeline()
 
     def __len__(self) -> int:
-        return len(self._df)
+        return self._slide_indices.shape[0]
 
-    def _create_tiles_df(self) -> pandas.DataFrame:
-        tiles_dfs = [slide._tiles_df.assign(slide_idx=idx).drop(columns=[TilesManager.tile_index,]) for idx, slide in enumerate(self._current_slides)]
-        tiles_df = pandas.concat(tiles_dfs) if len(tiles_dfs)>1 else tiles_dfs[0]
-        return tiles_df
-    
-    def _create_slides(self) -> List[Slide]:
-        slides = []
-        row_index = 0
-        for idx in tqdm(self._df.index, desc="Loading slides"):
-            slide_context = SlideContext(
-                row_index=row_index,
-                metadata=self._df,
-                dataset_paths=self._dataset_paths,
-                desired_mpp=self._desired_mpp,
-                tile_size=self._tile_size,
-            )
-            slide = Slide(slide_context=slide_context)
-            slides.append(slide)
-            row_index += 1
+    def __getstate__(self):
+        # slides are rebuilt lazily by every worker from the memory-mapped index
+        d = dict(self.__dict__)
+        d["_slides_cache"] = {}
+        return d
 
-        self._file_name_to_slide = self._create_file_name_to_slide_dict()
+    def view(
+        self,
+        datasets_folds: Dict,
+        min_tiles: int,
+        secondary_target: Optional[str] = None,
+        row_predicate: Callable = default_predicate,
+    ) -> "SlidesManager":
+        """
+        Returns a SlidesManager over the slides of this one matching the predicate. Views
+        share the metadata and the slides index instead of loading their own copies.
+        """
+        selected = row_predicate(
+            self._df,
+            target=self.target,
+            min_tiles=min_tiles,
+            datasets_folds=constants.get_datasets_folds(datasets_folds),
+            secondary_target=secondary_target,
+        )
+        view = copy.copy(self)
+        view._set_slide_indices(np.sort(np.asarray(selected, dtype=np.int64)))
+        return view
+
+    def _set_slide_indices(self, slide_indices: np.ndarray):
+        # slide_indices are the rows of the metadata (and of the slides index) in this manager
+        self._slide_indices = slide_indices
+        tiles_counts = self._slides_index.tiles_counts[slide_indices]
+        self._tile_offsets = np.concatenate(([0], np.cumsum(tiles_counts))).astype(np.int64)
+        self._slides_cache: Dict[int, Slide] = {}
 
-        return slides
+    def _create_slide(self, row_index: int) -> Slide:
+        # slides are views into the index, nothing is read from the slide files here
+        level, level_downsample = self._slides_index.get_level(row_index)
+        slide_context = SlideContext(
+            row_index=row_index,
+            metadata=self._df,
+            dataset_paths=self._dataset_paths,
+            desired_mpp=self._desired_mpp,
+            tile_size=self._tile_size,
+            level=level,
+            level_downsample=level_downsample,
+        )
+        return Slide(
+            slide_context=slide_context,
+            pixels=self._slides_index.get_pixels(row_index),
+        )
     
     # def _create_transform_pipeline():
 
 
     @property
     def metadata(self) -> pandas.DataFrame:
-        return self._df
+        return self._df.iloc[self._slide_indices]
+
+    @property
+    def tile_size(self) -> int:
+        return self._tile_size
+
+    @property
+    def desired_mpp(self) -> float:
+        return self._desired_mpp
 
     @property
     def slides_count(self) -> int:
-        return self._df.shape[0]
+        return self._slide_indices.shape[0]
     
     @property
     def tiles_count(self) -> int:
-        n_tiles = 0
-        for slide in self._current_slides:
-            n_tiles += slide.tiles_count
-        return n_tiles
+        return int(self._tile_offsets[-1])
+
+    @property
+    def tile_offsets(self) -> np.ndarray:
+        return self._tile_offsets
 
     def binarize_dfs(self, years: int) -> pandas.Series:
         bm_ret = self._df["dfs"].copy()
@@ -150,14 +200,19 @@ class SlidesManager(MetadataBase):
     #         bm_ret[(self._df["dfs"] <= t) & (self._df["typefdfs"] != "death without another event reported")] = 0
 
     def get_slide(self, slide_idx: int) -> Slide:
-        return self._current_slides[slide_idx]
+        row_index = int(self._slide_indices[slide_idx])
+        slide = self._slides_cache.get(row_index)
+        if slide is None:
+            slide = self._create_slide(row_index)
+            self._slides_cache[row_index] = slide
+        return slide
     
-    def get_tile(self, tile_idx: int) -> Tuple[Slide, int]:
-        row = self._tiles_df.iloc[[tile_idx]]
-        slide_idx = row["slide_idx"].item()
-        slide = self._current_slides[slide_idx]
-        top_left_pixel = row[[TilesManager.pixel_x, TilesManager.pixel_y]].to_numpy()
-        return Tile(slide.slide_context, top_left_pixel)
+    def get_slide_idx(self, tile_idx: int) -> int:
+        return int(np.searchsorted(self._tile_offsets, tile_idx, side="right")) - 1
+
+    def get_tile(self, tile_idx: int) -> Tile:
+        slide_idx = self.get_slide_idx(tile_idx)
+        return self.get_slide(slide_idx).get_tile(tile_idx - self._tile_offsets[slide_idx])
 
     def get_random_slide(self) -> Slide:
         index = np.random.randint(low=0, high=self._df.shape[0])
@@ -210,3 +265,12 @@ class SlidesManager(MetadataBase):
             return pandas.Series([1]*len(self._df))
         else:
             return self.binary_label_str_to_int()
+
+
+def merge_datasets_folds(*datasets_folds: Dict) -> Dict:
+    """Union of several datasets_folds dicts, e.g. to build one SlidesManager for train, val and test."""
+    merged = {}
+    for folds in datasets_folds:
+        for dataset_id, dataset_folds in constants.get_datasets_folds(folds).items():
+            merged[dataset_id] = sorted(set(merged.get(dataset_id, [])) | set(dataset_folds), key=str)
+    return merged
@@ -88,6 +88,56 @@ class MyGaussianNoiseTransform:
         return x
 
 
+class GaussianNoise:
+    """
+    Tensor version of MyGaussianNoiseTransform for a (C, H, W) image or a (B, C, H, W) batch.
+    Every image gets its own sigma, drawn uniformly from the sigma range (relative to the
+    [0, 1] intensity range, as in MyGaussianNoiseTransform). Float images are expected in
+    [0, 1] and uint8 images in [0, 255]; the noise is added in place and the result is clipped.
+    With a seed, every DataLoader worker draws from its own seeded generator.
+    """
+
+    def __init__(self, sigma, seed=None):
+        self.sigma = sigma
+        self.seed = seed
+        self._generators = {}
+
+    def _get_generator(self, device):
+        if self.seed is None:
+            return None
+        generator = self._generators.get(device)
+        if generator is None:
+            worker_info = torch.utils.data.get_worker_info()
+            worker_id = 0 if worker_info is None else worker_info.id
+            generator = torch.Generator(device=device)
+            generator.manual_seed(self.seed + worker_id)
+            self._generators[device] = generator
+        return generator
+
+    def __getstate__(self):
+        # generators are created again (and seeded per worker) by every process
+        state = dict(self.__dict__)
+        state["_generators"] = {}
+        return state
+
+    def __call__(self, x):
+        batch = x if x.dim() == 4 else x.unsqueeze(0)
+        generator = self._get_generator(x.device)
+        noise_dtype = torch.float32 if x.dtype == torch.uint8 else x.dtype
+        stdev = self.sigma[0] + (self.sigma[1] - self.sigma[0]) * torch.rand(
+            batch.shape[0], generator=generator, device=x.device, dtype=noise_dtype
+        )
+        noise = torch.randn(batch.shape, generator=generator, device=x.device, dtype=noise_dtype)
+        noise.mul_(stdev.view(-1, 1, 1, 1))
+
+        if x.dtype == torch.uint8:
+            noise.mul_(255).add_(batch).round_().clamp_(0, 255)
+            batch.copy_(noise)
+        else:
+            batch.add_(noise).clamp_(0, 1)
+        return x
+
+
 class MyMeanPixelRegularization:
     """replace patch with single pixel value"""
 
@@ -0,0 +1,140 @@
+import copy
+import json
+from pathlib import Path
+from typing import Dict, Literal, Optional
+
+import numpy as np
+import torch
+from torch import nn
+from torch.fx.experimental.optimization import fuse as fx_fuse
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+from .models.preact_resnet import PreActBottleneck_Ron, PreActResNet_Ron
+from .models.resnet_custom import Bottleneck_Baseline, ResNet_Baseline
+from .runtime import PatchRuntime, get_metadata_path
+
+
+class PatchScorer(nn.Module):
+    """
+    A backbone and its head as one module of (N, H, W, 3) uint8 patches, as read from the
+    slides, to (N, C) scores: softmax probabilities of a classifier, raw outputs of a regressor.
+    The normalization of the datamodule is part of the module.
+    """
+
+    def __init__(self, backbone: nn.Module, head: nn.Module, mean, std, softmax: bool):
+        super().__init__()
+        self.backbone = backbone
+        self.head = head
+        self.register_buffer("mean", torch.tensor(mean, dtype=torch.float32).view(1, 3, 1, 1))
+        self.register_buffer("std", torch.tensor(std, dtype=torch.float32).view(1, 3, 1, 1))
+        self.softmax = softmax
+
+    def forward(self, patches: torch.Tensor) -> torch.Tensor:
+        x = (patches.permute(0, 3, 1, 2).float() / 255 - self.mean) / self.std
+        scores = self.head(self.backbone(x))
+        return scores.softmax(1) if self.softmax else scores
+
+
+def _fold(module: nn.Module, conv_name: str, bn_name: str):
+    setattr(module, conv_name, fuse_conv_bn_eval(getattr(module, conv_name), getattr(module, bn_name)))
+    setattr(module, bn_name, nn.Identity())
+
+
+def fold_conv_bn(backbone: nn.Module) -> nn.Module:
+    """
+    Returns an eval mode copy of the backbone with every batch norm that directly follows a
+    convolution folded into it. In PreActResNet50 the batch norm at the start of each block
+    follows a residual addition, only the two inside it follow a convolution. Other backbones
+    (timm) are folded by torch.fx when they can be traced, left as they are otherwise.
+    """
+    backbone = copy.deepcopy(backbone).eval()
+    if isinstance(backbone, PreActResNet_Ron):
+        for block in backbone.modules():
+            if isinstance(block, PreActBottleneck_Ron):
+                _fold(block, "conv1", "bn2")
+                _fold(block, "conv2", "bn3")
+    elif isinstance(backbone, ResNet_Baseline):
+        _fold(backbone, "conv1", "bn1")
+        for block in backbone.modules():
+            if isinstance(block, Bottleneck_Baseline):
+                _fold(block, "conv1", "bn1")
+                _fold(block, "conv2", "bn2")
+                _fold(block, "conv3", "bn3")
+                if block.downsample is not None:
+                    _fold(block.downsample, "0", "1")
+    else:
+        try:
+            backbone = fx_fuse(backbone)
+        except Exception as e:
+            print(f"WARNING: could not fold the batch norms of {type(backbone).__name__}, exporting it unfolded: {e}")
+    return backbone
+
+
+@torch.no_grad()
+def export_patch_scorer(
+    backbone: nn.Module,
+    head: nn.Module,
+    output_path,
+    mean,
+    std,
+    img_size: int,
+    softmax: bool,
+    export_format: Literal["torchscript", "onnx"] = "torchscript",
+    fold: bool = True,
+    metadata: Optional[Dict] = None,
+    parity_batch_size: int = 8,
+    atol: float = 1e-3,
+) -> Dict:
+    """
+    Exports a backbone and its head as a PatchScorer, with folded batch norms, to a TorchScript
+    or ONNX artifact at output_path, with its metadata next to it (see runtime.get_metadata_path).
+    The artifact is then loaded by a PatchRuntime and its scores are checked against the ones
+    of the original modules on random patches. Returns the metadata with the parity results.
+    """
+    output_path = Path(output_path)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    reference = PatchScorer(copy.deepcopy(backbone), copy.deepcopy(head), mean, std, softmax).cpu().eval()
+    scorer = PatchScorer(
+        fold_conv_bn(reference.backbone) if fold else reference.backbone, reference.head, mean, std, softmax
+    ).eval()
+    example = torch.randint(0, 256, (parity_batch_size, img_size, img_size, 3), dtype=torch.uint8)
+
+    if export_format == "torchscript":
+        traced = torch.jit.trace(scorer, example)
+        torch.jit.save(torch.jit.freeze(traced), str(output_path))
+    elif export_format == "onnx":
+        torch.onnx.export(
+            scorer,
+            example,
+            str(output_path),
+            input_names=["patches"],
+            output_names=["scores"],
+            dynamic_axes={"patches": {0: "batch"}, "scores": {0: "batch"}},
+            opset_version=13,
+        )
+    else:
+        raise ValueError(f"Unknown export format {export_format}, expected torchscript or onnx")
+
+    expected = reference(example).numpy()
+    metadata = {
+        **(metadata or {}),
+        "format": export_format,
+        "img_size": img_size,
+        "num_outputs": int(expected.shape[1]),
+        "softmax": softmax,
+        "folded": fold,
+    }
+    with open(get_metadata_path(output_path), "w") as file:
+        json.dump(metadata, file, indent=2)
+
+    actual = PatchRuntime(output_path).score(example.numpy())
+    max_abs_diff = float(np.abs(actual - expected).max())
+    metadata["parity_max_abs_diff"] = max_abs_diff
+    with open(get_metadata_path(output_path), "w") as file:
+        json.dump(metadata, file, indent=2)
+    print(f"Exported {output_path}, max |score difference| from the original model {max_abs_diff:.2e}")
+    if max_abs_diff > atol:
+        raise RuntimeError(
+            f"The exported model scores differ from the original model by up to {max_abs_diff:.2e} > {atol:.0e}"
+        )
+    return metadata
@@ -0,0 +1,243 @@
+import json
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+from pathlib import Path
+from typing import Dict, Iterator, List, Literal, Optional
+
+import h5py
+import numpy as np
+import torch
+from matplotlib import colormaps
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from .datasets.datasets import SlideTileChunksDataset
+from .datasets.slides_manager import SlidesManager
+
+
+def get_score_grid(locations: np.ndarray, scores: np.ndarray):
+    """
+    Places (N, C) tile scores at their (N, 2) tile grid locations, returns the (H, W, C) grid,
+    NaN where the slide has no tile, and the location of grid[0, 0].
+    """
+    origin = locations.min(axis=0)
+    shape = locations.max(axis=0) - origin + 1
+    grid = np.full((int(shape[0]), int(shape[1]), scores.shape[1]), np.nan, dtype=np.float32)
+    grid[locations[:, 0] - origin[0], locations[:, 1] - origin[1]] = scores
+    return grid, origin
+
+
+def get_overlay(
+    locations: np.ndarray,
+    scores: np.ndarray,
+    thumbnails: np.ndarray,
+    alpha: float = 0.4,
+    colormap: str = "jet",
+) -> np.ndarray:
+    """The tiles thumbnails on a white background blended with the colormap of the (N,) scores, (H * t, W * t, 3) uint8."""
+    origin = locations.min(axis=0)
+    shape = locations.max(axis=0) - origin + 1
+    size = thumbnails.shape[1]
+    overlay = np.full((int(shape[0]) * size, int(shape[1]) * size, 3), 255, dtype=np.uint8)
+    colors = colormaps[colormap](np.clip(scores, 0, 1))[:, :3] * 255
+    blended = ((1 - alpha) * thumbnails + alpha * colors[:, None, None, :]).astype(np.uint8)
+    for (row, col), tile in zip(locations - origin, blended):
+        overlay[row * size:(row + 1) * size, col * size:(col + 1) * size] = tile
+    return overlay
+
+
+def _write_slide_scores(
+    output_dir: Path,
+    slide_name: str,
+    locations: np.ndarray,
+    scores: np.ndarray,
+    zero_level_tile_size: int,
+    file_format: str,
+    thumbnails: Optional[np.ndarray],
+    overlay_class: int,
+):
+    # runs on the writer threads
+    grid, origin = get_score_grid(locations, scores)
+    attrs = {
+        "slide_name": slide_name,
+        "origin": origin.tolist(),  # tile grid location of scores[0, 0]
+        "zero_level_tile_size": int(zero_level_tile_size),
+    }
+    if file_format == "h5":
+        with h5py.File(output_dir / f"{slide_name}_scores.h5", "w") as file:
+            file.create_dataset("scores", data=grid)
+            file.create_dataset("locations", data=locations)
+            file.create_dataset("tile_scores", data=scores)
+            for key, val in attrs.items():
+                file.attrs[key] = val
+    else:
+        np.save(output_dir / f"{slide_name}_scores.npy", grid)
+        with open(output_dir / f"{slide_name}_scores.json", "w") as file:
+            json.dump(attrs, file)
+    if thumbnails is not None:
+        overlay = get_overlay(locations, scores[:, overlay_class], thumbnails)
+        Image.fromarray(overlay).save(output_dir / f"{slide_name}_overlay.png")
+
+
+def _prefetch_to_device(loader: DataLoader, device: torch.device) -> Iterator[Dict]:
+    # the tiles of the next chunk are copied on a side stream while the current one is computed
+    stream = torch.cuda.Stream(device=device) if device.type == "cuda" else None
+    next_batch = None
+    for batch in loader:
+        with torch.cuda.stream(stream) if stream is not None else nullcontext():
+            batch["tiles"] = batch["tiles"].to(device, non_blocking=True)
+        if next_batch is not None:
+            yield next_batch
+        if stream is not None:
+            torch.cuda.current_stream(device).wait_stream(stream)
+            batch["tiles"].record_stream(torch.cuda.current_stream(device))
+        next_batch = batch
+    if next_batch is not None:
+        yield next_batch
+
+
+class SlideInference:
+    """
+    Scores every tile of every slide of a slides manager with a trained WsiClassifier and
+    writes a score grid per slide, aligned to the tile grid, to output_dir:
+        {slide}_scores.h5  the (H, W, num_classes) scores dataset, NaN where there is no tile,
+                           the tile_scores and locations datasets and the origin attr, the
+                           tile grid location of scores[0, 0]
+    or with file_format="npy" {slide}_scores.npy and the attrs in {slide}_scores.json.
+    With overlay=True also {slide}_overlay.png, the tiles downsampled to thumbnail_size pixels
+    blended with the scores of overlay_class.
+
+    The tiles are read by num_workers dataloader workers in chunks of chunk_size tiles of a
+    slide, normalized on the device and scored in chunks under autocast. Finished slides are
+    written by writer threads while the next slides are scored.
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        mean,
+        std,
+        img_size: int = 256,
+        chunk_size: int = 512,
+        num_workers: int = 8,
+        prefetch_factor: int = 4,
+        file_format: Literal["h5", "npy"] = "h5",
+        overlay: bool = False,
+        thumbnail_size: int = 8,
+        overlay_class: int = 1,
+        writer_threads: int = 4,
+        device=None,
+        autocast: bool = True,
+    ):
+        if file_format not in ("h5", "npy"):
+            raise ValueError(f"Unknown file format {file_format}, expected h5 or npy")
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.model = model.to(self.device).eval()
+        if self.device.type == "cuda":
+            self.model = self.model.to(memory_format=torch.channels_last)
+        self._mean = torch.tensor(mean, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+        self._std = torch.tensor(std, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+        self.img_size = img_size
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers
+        self.prefetch_factor = prefetch_factor
+        self.file_format = file_format
+        self.overlay = overlay
+        self.thumbnail_size = thumbnail_size
+        self.overlay_class = overlay_class
+        self.writer_threads = writer_threads
+        self.autocast = autocast and self.device.type == "cuda"
+
+    def _transform(self, tiles: torch.Tensor) -> torch.Tensor:
+        # (n, T, T, 3) uint8 -> normalized (n, 3, img_size, img_size), channels last
+        x = tiles.permute(0, 3, 1, 2)
+        offset = (x.shape[-1] - self.img_size) // 2
+        if offset > 0:
+            x = x[..., offset:offset + self.img_size, offset:offset + self.img_size]
+        return (x.float() / 255 - self._mean) / self._std
+
+    @torch.inference_mode()
+    def run(self, slides_manager: SlidesManager, output_dir) -> Dict:
+        """Scores all slides, returns the tiles count, the time and the throughput in tiles/s, overall and per slide."""
+        output_dir = Path(output_dir)
+        output_dir.mkdir(parents=True, exist_ok=True)
+        dataset = SlideTileChunksDataset(
+            chunk_size=self.chunk_size,
+            thumbnail_size=self.thumbnail_size if self.overlay else 0,
+            slides_manager=slides_manager,
+            datasets_folds={},  # the slides are the ones of the slides manager
+        )
+        loader_kwargs = {"prefetch_factor": self.prefetch_factor} if self.num_workers > 0 else {}
+        loader = DataLoader(
+            dataset,
+            batch_size=None,  # each instance is a chunk
+            shuffle=False,
+            num_workers=self.num_workers,
+            pin_memory=self.device.type == "cuda",
+            **loader_kwargs,
+        )
+
+        executor = ThreadPoolExecutor(max_workers=self.writer_threads)
+        pending: List[Future] = []
+        # slide idx -> locations, scores and thumbnails chunks, start time
+        slides: Dict[int, Dict] = {}
+        slides_stats = {}
+        start_time = time.perf_counter()
+        tiles_count = 0
+        for batch in _prefetch_to_device(loader, self.device):
+            slide_idx = batch["slide_idx"]
+            slide = slides.setdefault(
+                slide_idx, {"locations": [], "scores": [], "thumbnails": [], "start": time.perf_counter()}
+            )
+            with torch.autocast(device_type=self.device.type, enabled=self.autocast):
+                logits = self.model(self._transform(batch["tiles"]))
+            slide["scores"].append(logits.float().softmax(1).cpu().numpy())
+            slide["locations"].append(batch["locations"].numpy())
+            if self.overlay:
+                slide["thumbnails"].append(batch["thumbnails"].numpy())
+            tiles_count += batch["tiles"].shape[0]
+
+            if batch["chunk_idx"] == batch["chunks_count"] - 1:
+                del slides[slide_idx]
+                slide_name = batch["slide_name"]
+                locations, scores = np.concatenate(slide["locations"]), np.concatenate(slide["scores"])
+                elapsed = time.perf_counter() - slide["start"]
+                slides_stats[slide_name] = {
+                    "tiles": locations.shape[0],
+                    "tiles_per_second": locations.shape[0] / max(elapsed, 1e-9),
+                }
+                print(
+                    f"{slide_name}: {locations.shape[0]} tiles, {slides_stats[slide_name]['tiles_per_second']:.0f} tiles/s"
+                )
+                zero_level_tile_size = slides_manager.get_slide(slide_idx).slide_context.zero_level_tile_size
+                # at most two writes per writer thread are queued, the scores wait for the disk above that
+                while len(pending) >= 2 * self.writer_threads or (pending and pending[0].done()):
+                    pending.pop(0).result()  # raises the errors of the writers
+                pending.append(
+                    executor.submit(
+                        _write_slide_scores,
+                        output_dir,
+                        slide_name,
+                        locations,
+                        scores,
+                        zero_level_tile_size,
+                        self.file_format,
+                        np.concatenate(slide["thumbnails"]) if self.overlay else None,
+                        self.overlay_class,
+                    )
+                )
+
+        for future in pending:
+            future.result()  # raises the errors of the writers
+        executor.shutdown(wait=True)
+        elapsed = time.perf_counter() - start_time
+        stats = {
+            "slides": len(slides_stats),
+            "tiles": tiles_count,
+            "seconds": elapsed,
+            "tiles_per_second": tiles_count / max(elapsed, 1e-9),
+            "per_slide": slides_stats,
+        }
+        print(f"Scored {tiles_count} tiles of {len(slides_stats)} slides in {elapsed:.1f}s, {stats['tiles_per_second']:.0f} tiles/s")
+        return stats
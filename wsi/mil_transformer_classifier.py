@@ -12,7 +12,9 @@ from torch import optim
 from torch.nn import functional as F
 from torchmetrics.functional import auroc
 
+from wsi.models.feature_extraction import ChunkedFeatureExtractor
 from wsi.models.mil_transformer import MilTransformer
+from wsi.utils.quantization import dequantize_features
 from wsi.wsi_classifier import WsiClassifier
 
 
@@ -37,6 +39,9 @@ class MilTransformerClassifier(LightningModule):
         feature_extractor_ckpt: Optional[str] = None,
         feature_extractor_backbone: Optional[str] = None,
         batch_size: int = 128,
+        feature_extraction_micro_batch_size: int = 512,
+        feature_extraction_autocast: bool = True,
+        auroc_thresholds: Optional[int] = 200,
         **kwargs,
     ):
         """
@@ -57,6 +62,9 @@ class MilTransformerClassifier(LightningModule):
             feature_extractor_ckpt: path to pretrained WsiClassifier checkpoint for online feature extraction
             feature_extractor_backbone: name of feature extractor backbone in feature extractor checkpoint
             batch_size: batch size
+            feature_extraction_micro_batch_size: number of images per forward of the online feature extractor
+            feature_extraction_autocast: whether the online feature extractor runs under autocast
+            auroc_thresholds: number of thresholds of the binned training slide AUROC, None for the exact AUROC
         """
         super().__init__()
 
@@ -72,6 +80,9 @@ class MilTransformerClassifier(LightningModule):
                 feature_extractor_backbone, feature_extractor_ckpt
             )
             self.use_features = False
+            self._chunked_extractor = ChunkedFeatureExtractor(
+                micro_batch_size=feature_extraction_micro_batch_size, autocast=feature_extraction_autocast
+            )
         self.num_classes = num_classes
 
         self.model = MilTransformer(
@@ -94,6 +105,10 @@ class MilTransformerClassifier(LightningModule):
             task="multiclass", num_classes=num_classes
         )
         self.val_acc = torchmetrics.Accuracy(task="multiclass", num_classes=num_classes)
+        # slide AUCs accumulated over the steps, the training one binned with a fixed size state
+        auroc_task = {"task": "binary"} if num_classes == 2 else {"task": "multiclass", "num_classes": num_classes}
+        self.train_auroc = torchmetrics.AUROC(**auroc_task, thresholds=auroc_thresholds)
+        self.val_auroc = torchmetrics.AUROC(**auroc_task)
 
     def training_step(self, batch, batch_idx):
         loss, preds, scores, y = self.shared_step(batch)
@@ -110,27 +125,14 @@ class MilTransformerClassifier(LightningModule):
             prog_bar=False,
             logger=True,
         )
+        self._update_auroc(self.train_auroc, scores, y)
+        self.log("train/slide_auc", self.train_auroc, on_step=False, on_epoch=True, prog_bar=True, logger=True)
 
-        return {"loss": loss, "scores": scores, "y": y}
-
-    def training_epoch_end(self, outputs):
-        scores = torch.cat([x["scores"] for x in outputs], dim=0).detach().cpu()
-        y = torch.cat([x["y"] for x in outputs], dim=0).cpu()
+        return loss
 
-        if self.num_classes == 2:
-            self.log(
-                "train/slide_auc",
-                auroc(scores[:, 1], y, task="binary"),
-                prog_bar=True,
-                logger=True,
-            )
-        else:
-            self.log(
-                "train/slide_auc",
-                auroc(scores, y, task="multiclass"),
-                prog_bar=True,
-                logger=True,
-            )
+    def _update_auroc(self, metric: torchmetrics.AUROC, scores, y):
+        scores = scores.detach()
+        metric.update(scores[:, 1] if self.num_classes == 2 else scores, y)
 
     def validation_step(self, batch, batch_idx):
         loss, preds, scores, y = self.shared_step(batch)
@@ -152,27 +154,8 @@ class MilTransformerClassifier(LightningModule):
             logger=True,
             batch_size=self.hparams.batch_size,
         )
-
-        return {"loss": loss, "scores": scores, "y": y}
-
-    def validation_epoch_end(self, outputs):
-        scores = torch.cat([x["scores"] for x in outputs], dim=0).detach().cpu()
-        y = torch.cat([x["y"] for x in outputs], dim=0).cpu()
-
-        if self.num_classes == 2:
-            self.log(
-                "val/slide_auc",
-                auroc(scores[:, 1], y, task="binary"),
-                prog_bar=True,
-                logger=True,
-            )
-        else:
-            self.log(
-                "val/slide_auc",
-                auroc(scores, y, task="multiclass"),
-                prog_bar=True,
-                logger=True,
-            )
+        self._update_auroc(self.val_auroc, scores, y)
+        self.log("val/slide_auc", self.val_auroc, on_step=False, on_epoch=True, prog_bar=True, logger=True)
 
     def test_step(self, batch, batch_idx):
         _, _, scores, y = self.shared_step(batch)
@@ -247,15 +230,18 @@ class MilTransformerClassifier(LightningModule):
         if self.use_features:
             x = batch["features"]
             y = batch["label"]
+            if "features_scale" in batch:
+                # int8 features are moved to the device as they are and dequantized here
+                x = dequantize_features(x, batch["features_scale"], batch["features_zero_point"])
             # patch_coords = batch["coords"]
         else:
             bag = batch["bag"]
             y = batch["label"]
             # patch_coords = batch["center_pixel"]
-            with torch.no_grad():
-                bag = rearrange(bag, "b1 b2 c h w -> (b1 b2) c h w")
-                x = self.feature_extractor.forward_features(bag)
-                x = rearrange(x, "(b1 b2) e -> b1 b2 e", b2=self.hparams.bag_size)
+            # the bag is still on the host, see transfer_batch_to_device
+            bag = rearrange(bag, "b1 b2 c h w -> (b1 b2) c h w")
+            x = self._chunked_extractor(self.feature_extractor.forward_features, bag, self.device)
+            x = rearrange(x, "(b1 b2) e -> b1 b2 e", b2=self.hparams.bag_size)
 
         logits = self.model(x)
 
@@ -268,6 +254,15 @@ class MilTransformerClassifier(LightningModule):
     def forward(self, x):
         return self.model(x)
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        if self.use_features or "bag" not in batch:
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+        # online extraction moves the images of the bags to the device one micro batch at a time
+        bag = batch.pop("bag")
+        batch = super().transfer_batch_to_device(batch, device, dataloader_idx)
+        batch["bag"] = bag
+        return batch
+
     def configure_optimizers(self):
         optimizer = torch.optim.AdamW(
             params=[p for p in self.parameters() if p.requires_grad],
@@ -13,11 +13,13 @@ from torch.nn import functional as F
 from torch import nn
 from torchmetrics.functional.regression import r2_score, mse, mean_absolute_error
 from torchmetrics.functional.classification import auroc
-from .models.metrics import c_index
+from .models.metrics import c_index_bootstrap
 
 from .models.loss import CoxPHLoss, DeepHitLoss, NaiveCensoredPinballLoss
 
+from wsi.models.feature_extraction import ChunkedFeatureExtractor
 from wsi.models.mil_transformer import MilTransformer
+from wsi.utils.quantization import dequantize_features
 from wsi.wsi_regressor import WsiRegressor
 
 
@@ -43,6 +45,8 @@ class MilTransformerRegressor(LightningModule):
         feature_extractor_ckpt: Optional[str] = None,
         feature_extractor_backbone: Optional[str] = None,
         batch_size: int = 128,
+        feature_extraction_micro_batch_size: int = 512,
+        feature_extraction_autocast: bool = True,
         **kwargs,
     ):
         """
@@ -62,6 +66,8 @@ class MilTransformerRegressor(LightningModule):
             feature_extractor_ckpt: path to pretrained WsiRegressor checkpoint for online feature extraction
             feature_extractor_backbone: name of feature extractor backbone in feature extractor checkpoint
             batch_size: batch size
+            feature_extraction_micro_batch_size: number of images per forward of the online feature extractor
+            feature_extraction_autocast: whether the online feature extractor runs under autocast
         """
         super().__init__()
 
@@ -77,6 +83,9 @@ class MilTransformerRegressor(LightningModule):
                 feature_extractor_backbone, feature_extractor_ckpt
             )
             self.use_features = False
+            self._chunked_extractor = ChunkedFeatureExtractor(
+                micro_batch_size=feature_extraction_micro_batch_size, autocast=feature_extraction_autocast
+            )
 
         self.model = MilTransformer(
             variant=variant,
@@ -95,6 +104,12 @@ class MilTransformerRegressor(LightningModule):
 
         self.loss = self.init_loss(loss, quantile_to_predict)
 
+        # epoch metrics, accumulated over the training steps with fixed size states
+        self.train_loss = torchmetrics.MeanMetric()
+        self.train_r2 = torchmetrics.R2Score()
+        self.train_mse = torchmetrics.MeanSquaredError()
+        self.train_mae = torchmetrics.MeanAbsoluteError()
+
     def init_loss(self, loss, quantile_to_predict):
         if loss == "MSE":
             _loss = nn.MSELoss()
@@ -124,50 +139,18 @@ class MilTransformerRegressor(LightningModule):
             sync_dist=True,
         )
 
-        return {"loss": loss, "preds": preds, "labels": labels}
+        self.train_loss.update(loss.detach())
+        self.log("train/loss", self.train_loss, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        if not self.hparams.survival:
+            preds, labels = preds.detach().flatten(), labels.flatten()
+            self.train_r2.update(preds, labels)
+            self.train_mse.update(preds, labels)
+            self.train_mae.update(preds, labels)
+            self.log("train/r2_score", self.train_r2, on_step=False, on_epoch=True, logger=True)
+            self.log("train/MSE", self.train_mse, on_step=False, on_epoch=True, logger=True)
+            self.log("train/mean_absolute_error", self.train_mae, on_step=False, on_epoch=True, logger=True)
 
-    def training_epoch_end(self, outputs):
-        preds = torch.cat([x["preds"] for x in outputs], dim=0).detach().cpu()
-        loss = torch.cat([x["loss"].reshape(1) for x in outputs], dim=0).detach().cpu()
-        labels = torch.cat([x["labels"] for x in outputs], dim=0).cpu()
-            
-        self.log(
-            "train/loss",
-            loss.mean(),
-            prog_bar=True,
-            logger=True,
-            sync_dist=True,
-        )
-        if self.hparams.survival:
-            pass
-        else:
-            self.log(
-                "train/r2_score",
-                r2_score(preds, labels),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
-            self.log(
-                "train/MSE",
-                mse(preds, labels),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
-            self.log(
-                "train/mean_absolute_error",
-                mean_absolute_error(preds, labels),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
+        return loss
 
     def validation_step(self, batch, batch_idx):
         labels = batch["label"]
@@ -263,14 +246,10 @@ class MilTransformerRegressor(LightningModule):
         slide_labels = torch.vstack([x["label"] for x in outputs]).cpu()
 
         if self.hparams.survival:
-            self.log(
-                "test/c_index",
-                c_index(
-                    slide_preds,
-                    slide_labels
-                ),
-                logger=True,
-            )
+            c_index_value, c_index_lower, c_index_upper = c_index_bootstrap(slide_preds, slide_labels)
+            self.log("test/c_index", c_index_value, logger=True)
+            self.log("test/c_index_ci_lower", c_index_lower, logger=True)
+            self.log("test/c_index_ci_upper", c_index_upper, logger=True)
 
         else:
             self.log(
@@ -333,13 +312,16 @@ class MilTransformerRegressor(LightningModule):
         if self.use_features:
             x = batch["features"]
             y = batch["label"]
+            if "features_scale" in batch:
+                # int8 features are moved to the device as they are and dequantized here
+                x = dequantize_features(x, batch["features_scale"], batch["features_zero_point"])
         else:
             bag = batch["bag"]
             y = batch["label"]
-            with torch.no_grad():
-                bag = rearrange(bag, "b1 b2 c h w -> (b1 b2) c h w")
-                x = self.feature_extractor.forward_features(bag)
-                x = rearrange(x, "(b1 b2) e -> b1 b2 e", b2=self.hparams.bag_size)
+            # the bag is still on the host, see transfer_batch_to_device
+            bag = rearrange(bag, "b1 b2 c h w -> (b1 b2) c h w")
+            x = self._chunked_extractor(self.feature_extractor.forward_features, bag, self.device)
+            x = rearrange(x, "(b1 b2) e -> b1 b2 e", b2=self.hparams.bag_size)
 
         preds = self.model(x)
 
@@ -347,6 +329,15 @@ class MilTransformerRegressor(LightningModule):
 
         return loss, preds
 
+    def transfer_batch_to_device(self, batch, device, dataloader_idx):
+        if self.use_features or "bag" not in batch:
+            return super().transfer_batch_to_device(batch, device, dataloader_idx)
+        # online extraction moves the images of the bags to the device one micro batch at a time
+        bag = batch.pop("bag")
+        batch = super().transfer_batch_to_device(batch, device, dataloader_idx)
+        batch["bag"] = bag
+        return batch
+
     def configure_optimizers(self):
         optimizer = optim.AdamW(
             self.model.parameters(), lr=self.hparams.lr, weight_decay=self.hparams.weight_decay
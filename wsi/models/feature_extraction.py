@@ -0,0 +1,77 @@
+from typing import Callable, List, Optional
+
+import torch
+
+
+class ChunkedFeatureExtractor:
+    """
+    Runs a feature extractor over a large batch of images in micro batches of micro_batch_size,
+    so the activations of only one micro batch are alive at a time.
+
+    The images may stay in (pinned) host memory: on CUDA every micro batch is copied to one of
+    two preallocated device buffers on a side stream, while the previous micro batch is computed.
+    The features are written to a preallocated output buffer, reused by the next call, so the
+    returned tensor is only valid until then.
+    """
+
+    def __init__(self, micro_batch_size: int = 512, autocast: bool = True):
+        self.micro_batch_size = micro_batch_size
+        self.autocast = autocast
+        self._out: Optional[torch.Tensor] = None
+        self._inputs: List[torch.Tensor] = []
+        self._copy_stream: Optional[torch.cuda.Stream] = None
+
+    def _get_out(self, rows: int, features: torch.Tensor) -> torch.Tensor:
+        shape = (rows,) + features.shape[1:]
+        if (
+            self._out is None
+            or self._out.shape[0] < rows
+            or self._out.shape[1:] != shape[1:]
+            or self._out.device != features.device
+        ):
+            self._out = torch.empty(shape, dtype=torch.float32, device=features.device)
+        return self._out[:rows]
+
+    def _get_input(self, slot: int, chunk: torch.Tensor, device: torch.device) -> torch.Tensor:
+        shape = (self.micro_batch_size,) + chunk.shape[1:]
+        if len(self._inputs) <= slot:
+            self._inputs.append(None)
+        buffer = self._inputs[slot]
+        if buffer is None or buffer.shape != shape or buffer.dtype != chunk.dtype or buffer.device != device:
+            buffer = self._inputs[slot] = torch.empty(shape, dtype=chunk.dtype, device=device)
+        return buffer[: chunk.shape[0]]
+
+    @torch.no_grad()
+    def __call__(self, forward: Callable[[torch.Tensor], torch.Tensor], images: torch.Tensor, device) -> torch.Tensor:
+        """Returns the (N, ...) float32 features of the (N, C, H, W) images on device."""
+        device = torch.device(device)
+        chunks = torch.split(images, self.micro_batch_size)
+        overlap = device.type == "cuda" and images.device.type == "cpu"
+        if overlap and self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device=device)
+        compute_stream = torch.cuda.current_stream(device) if overlap else None
+
+        def copy_chunk(i):
+            # the copy of chunk i waits for the compute of chunk i - 2, the previous user of its buffer
+            with torch.cuda.stream(self._copy_stream):
+                self._copy_stream.wait_stream(compute_stream)
+                return self._get_input(i % 2, chunks[i], device).copy_(chunks[i], non_blocking=True)
+
+        out = None
+        next_chunk = copy_chunk(0) if overlap else None
+        start = 0
+        for i, chunk in enumerate(chunks):
+            if overlap:
+                compute_stream.wait_stream(self._copy_stream)
+                chunk = next_chunk
+                if i + 1 < len(chunks):
+                    next_chunk = copy_chunk(i + 1)
+            else:
+                chunk = chunk.to(device, non_blocking=True)
+            with torch.autocast(device_type=device.type, enabled=self.autocast and device.type == "cuda"):
+                features = forward(chunk)
+            if out is None:
+                out = self._get_out(images.shape[0], features)
+            out[start:start + features.shape[0]] = features
+            start += features.shape[0]
+        return out
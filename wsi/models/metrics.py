@@ -1,55 +1,96 @@
 import torch
 
-def R_set(x):
-	'''Create an indicator matrix of risk sets, where T_j >= T_i.
-	Note that the input data have been sorted in descending order.
+
+def _dense_rank(x):
+	'''Dense ranks (0, 1, ...) of the values of every row of a (B, n) tensor, equal values have equal ranks.'''
+	sorted_x, order = x.sort(dim=1)
+	new_value = torch.ones_like(sorted_x, dtype=torch.long)
+	new_value[:, 1:] = (sorted_x[:, 1:] != sorted_x[:, :-1]).long()
+	return torch.empty_like(new_value).scatter_(1, order, new_value.cumsum(1) - 1)
+
+
+def concordance_counts(pred, ytime, yevent, tau=None):
+	'''Harrell's concordance counts of every row of (B, n) predictions, times and events.
+	A pair is comparable when the earlier time is an event: T_i < T_j with event i, or
+	T_i == T_j with event i and censored j (the censored sample is considered to live longer).
+	It is concordant when the earlier sample has the higher prediction (risk), and counts 0.5
+	when the predictions are tied. With tau only pairs with the earlier event before tau are
+	comparable (time-truncated C).
+
+	Every sample counts the later samples with a lower / equal prediction in a bottom-up merge
+	sort over the samples ordered by time, each level of the merge done for all rows at once by
+	a sort, so the memory is O(B n) and the time O(B n log^2 n).
 	Input:
-		x: a PyTorch tensor that the number of rows is equal to the number of samples.
+		pred, ytime, yevent: (B, n) tensors, yevent 1 for an event, 0 for censoring.
+		tau: optional truncation time.
 	Output:
-		indicator_matrix: an indicator matrix (which is a lower traiangular portions of matrix).
+		concordant, tied, comparable: (B,) float64 tensors, the number of concordant pairs, of
+		comparable pairs with tied predictions and of comparable pairs.
 	'''
-	n_sample = x.size(0)
-	matrix_ones = torch.ones(n_sample, n_sample)
-	indicator_matrix = torch.tril(matrix_ones)
+	batch_size, n_sample = pred.shape
+	event = yevent.bool()
+	# later (longer living) samples come first, the censored ones before the events of the same time
+	key = 2 * _dense_rank(ytime) + (~event).long()
+	group = _dense_rank(-key)
+	rank = _dense_rank(pred)
+	anchor = event if tau is None else event & (ytime < tau)
+
+	rows = torch.arange(batch_size, device=pred.device).unsqueeze(1).expand(-1, n_sample)
+	concordant = torch.zeros(batch_size, dtype=torch.float64, device=pred.device)
+	tied = torch.zeros_like(concordant)
+	comparable = torch.zeros_like(concordant)
+	levels = max(int(group.max()).bit_length(), 1) if group.numel() else 0
+	for level in range(levels):
+		# samples of the second half of every block of 2^(level + 1) groups count the ones of the first half
+		second_half = ((group >> level) & 1).bool()
+		block = (rows * (n_sample + 1) + (group >> (level + 1))) * (n_sample + 1)
+		first_half_keys = (block + rank)[~second_half].sort().values
+		query = second_half & anchor
+		query_block, query_rank = block[query], rank[query]
+		block_start = torch.searchsorted(first_half_keys, query_block)
+		lower = torch.searchsorted(first_half_keys, query_block + query_rank) - block_start
+		lower_or_equal = torch.searchsorted(first_half_keys, query_block + query_rank, right=True) - block_start
+		total = torch.searchsorted(first_half_keys, query_block + n_sample + 1) - block_start
+		query_rows = rows[query]
+		concordant.index_add_(0, query_rows, lower.double())
+		tied.index_add_(0, query_rows, (lower_or_equal - lower).double())
+		comparable.index_add_(0, query_rows, total.double())
+	return concordant, tied, comparable
 
-	return(indicator_matrix)
 
-def c_index(pred, y):
-	'''Calculate concordance index to evaluate models.
-	From https://github.com/tomcat123a/survival_loss_criteria/
+def c_index(pred, y, tau=None):
+	'''Calculate Harrell's concordance index to evaluate models, see concordance_counts.
 	Input:
-		pred: linear predictors from trained model.
-		ytime: true survival time.
-		yevent: true censoring status. Here 1 is noncensored.
+		pred: (n,) or (n, 1) risk predictions from the trained model, higher for a shorter survival.
+		y: (n, 3) ytime, yevent (1 is noncensored) and an unused column.
+		tau: optional truncation time, only events before tau are compared.
+	Output:
+		concordance_index: c-index (between 0 and 1), NaN without comparable pairs.
+	'''
+	ytime, yevent, _ = y.T
+	concordant, tied, comparable = concordance_counts(
+		pred.detach().reshape(1, -1), ytime.reshape(1, -1).to(pred.device), yevent.reshape(1, -1).to(pred.device), tau=tau
+	)
+	return ((concordant + 0.5 * tied) / comparable)[0].float()
+
+
+def c_index_bootstrap(pred, y, n_bootstrap=1000, alpha=0.05, tau=None, batch_size=256, seed=0):
+	'''Harrell's C with a percentile bootstrap confidence interval, the resamples are computed in batches of batch_size.
 	Output:
-		concordance_index: c-index (between 0 and 1).
+		concordance_index, lower, upper: the c-index of the samples and the alpha / 2 and 1 - alpha / 2
+		quantiles of the c-index of n_bootstrap resamples (resamples without comparable pairs are dropped).
 	'''
 	ytime, yevent, _ = y.T
-	n_sample = len(ytime)
-	ytime_indicator = R_set(ytime)
-	ytime_matrix = ytime_indicator - torch.diag(torch.diag(ytime_indicator))
-	###T_i is uncensored
-	censor_idx = yevent.nonzero()
-	zeros = torch.zeros(n_sample)
-	ytime_matrix[censor_idx, :] = zeros
-	###1 if pred_i < pred_j; 0.5 if pred_i = pred_j
-	pred_matrix = torch.zeros_like(ytime_matrix)
-	for j in range(n_sample):
-		for i in range(n_sample):
-			if pred[i] < pred[j]:
-				pred_matrix[j, i]  = 1
-			elif pred[i] == pred[j]: 
-				pred_matrix[j, i] = 0.5
-	
-	concord_matrix = pred_matrix.mul(ytime_matrix)
-	###numerator
-	concord = torch.sum(concord_matrix)
-	###denominator
-	epsilon = torch.sum(ytime_matrix)
-	###c-index = numerator/denominator
-	concordance_index = torch.div(concord, epsilon)
-	###if gpu is being used
-	if torch.cuda.is_available():
-		concordance_index = concordance_index.cuda()
-	###
-	return(concordance_index)
\ No newline at end of file
+	pred, ytime, yevent = pred.detach().reshape(-1), ytime.to(pred.device), yevent.to(pred.device)
+	generator = torch.Generator(device=pred.device).manual_seed(seed)
+	resampled = []
+	for start in range(0, n_bootstrap, batch_size):
+		indices = torch.randint(
+			len(pred), (min(batch_size, n_bootstrap - start), len(pred)), generator=generator, device=pred.device
+		)
+		concordant, tied, comparable = concordance_counts(pred[indices], ytime[indices], yevent[indices], tau=tau)
+		resampled.append((concordant + 0.5 * tied) / comparable)
+	resampled = torch.cat(resampled)
+	resampled = resampled[~resampled.isnan()]
+	lower, upper = torch.quantile(resampled, torch.tensor([alpha / 2, 1 - alpha / 2], dtype=resampled.dtype, device=resampled.device))
+	return c_index(pred, y, tau=tau), lower.float(), upper.float()
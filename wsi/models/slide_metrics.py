@@ -0,0 +1,48 @@
+from typing import Tuple
+
+import torch
+from torchmetrics import Metric
+
+
+class SlideMeanScores(Metric):
+    """
+    Mean patch scores per slide, a segment mean of (N, C) patch scores keyed by (N,) slide
+    indices among slides_count slides, with the target of every slide. The states are per
+    slide sums and counts, allocated on the first update, so the DDP sync is a single sum
+    over (slides_count, C) tensors whatever the number of patches. Every rank must update
+    at least once before compute.
+    """
+
+    full_state_update = False
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.add_state("sums", default=torch.zeros(0), dist_reduce_fx="sum")
+        self.add_state("counts", default=torch.zeros(0), dist_reduce_fx="sum")
+        # targets are >= 0, a slide without patches keeps -1
+        self.add_state("targets", default=torch.zeros(0), dist_reduce_fx="max")
+
+    @property
+    def empty(self) -> bool:
+        return self.sums.numel() == 0
+
+    def update(self, scores: torch.Tensor, slide_idx: torch.Tensor, targets: torch.Tensor, slides_count: int):
+        scores = scores.detach().float().reshape(scores.shape[0], -1)
+        if self.sums.numel() == 0:
+            self.sums = torch.zeros((slides_count, scores.shape[1]), device=scores.device)
+            self.counts = torch.zeros(slides_count, device=scores.device)
+            self.targets = torch.full((slides_count,), -1.0, device=scores.device)
+        slide_idx = slide_idx.to(scores.device, torch.long)
+        self.sums.index_add_(0, slide_idx, scores)
+        self.counts.index_add_(0, slide_idx, torch.ones_like(slide_idx, dtype=torch.float))
+        self.targets.scatter_(0, slide_idx, targets.detach().to(scores.device, torch.float))
+
+    def compute(self) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """Returns the (S,) indices, (S, C) mean scores, (S,) targets and (S,) patch counts of the S slides with patches."""
+        present = self.counts > 0
+        return (
+            torch.nonzero(present).flatten(),
+            self.sums[present] / self.counts[present].unsqueeze(1),
+            self.targets[present],
+            self.counts[present],
+        )
@@ -0,0 +1,71 @@
+import copy
+from typing import Iterable
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch import nn
+from torch.ao.quantization import get_default_qconfig
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+from torch.utils.data import DataLoader, Dataset, Subset
+
+from .preact_resnet import PreActResNet_Ron
+
+
+class _PreActResNetFeatures(nn.Module):
+    # the path of PreActResNet_Ron.forward to its output, without the data dependent branches
+    # (5D bags, heatmaps, NaN debugging) that torch.fx cannot trace
+
+    def __init__(self, backbone: PreActResNet_Ron):
+        super().__init__()
+        self.backbone = backbone
+
+    def forward(self, x):
+        out = self.backbone.conv1(x)
+        out = self.backbone.layer1(out)
+        out = self.backbone.layer2(out)
+        out = self.backbone.layer3(out)
+        out = self.backbone.layer4(out)
+        # the same as avg_pool2d(out, out.shape[3]) on the square feature maps
+        out = F.adaptive_avg_pool2d(out, 1).flatten(1)
+        return self.backbone.linear(out)
+
+
+def get_calibration_loader(
+    dataset: Dataset, num_patches: int = 256, batch_size: int = 64, num_workers: int = 0, seed: int = 0
+) -> DataLoader:
+    """A loader of num_patches patches drawn at random from all tiles of a patch dataset, e.g. SerialPatchDataset."""
+    rng = np.random.default_rng(seed)
+    # sorted, so the patches of a slide are read together
+    indices = np.sort(rng.choice(len(dataset), size=min(num_patches, len(dataset)), replace=False))
+    return DataLoader(
+        Subset(dataset, indices.tolist()), batch_size=batch_size, shuffle=False, num_workers=num_workers
+    )
+
+
+@torch.no_grad()
+def quantize_static_int8(
+    backbone: nn.Module, calibration_batches: Iterable, backend: str = "fbgemm"
+) -> torch.fx.GraphModule:
+    """
+    Static post-training int8 quantization of a backbone with torch.fx: observers are inserted
+    (batch norms folded, conv-relu fused), the activation ranges are calibrated on the "patch"
+    of the calibration batches and the backbone is converted to int8 kernels of the backend,
+    fbgemm on x86, qnnpack on ARM. The result runs on CPU only, the backbone is not modified.
+    """
+    torch.backends.quantized.engine = backend
+    backbone = copy.deepcopy(backbone).cpu().eval()
+    if isinstance(backbone, PreActResNet_Ron):
+        backbone = _PreActResNetFeatures(backbone)
+    prepared = None
+    patches_count = 0
+    for batch in calibration_batches:
+        patches = batch["patch"].cpu()
+        if prepared is None:
+            prepared = prepare_fx(backbone, {"": get_default_qconfig(backend)}, example_inputs=(patches,))
+        prepared(patches)
+        patches_count += patches.shape[0]
+    if prepared is None:
+        raise ValueError("No calibration patches")
+    print(f"Calibrated static int8 quantization ({backend}) on {patches_count} patches")
+    return convert_fx(prepared)
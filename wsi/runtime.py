@@ -0,0 +1,92 @@
+import json
+import os
+import time
+from pathlib import Path
+from typing import Dict, Optional
+
+import numpy as np
+import torch
+
+# A CPU runtime for patch scorers exported by wsi.export, with no Lightning, timm or wandb. It only
+# imports torch and numpy, onnxruntime for ONNX artifacts, so it can be copied to scoring nodes.
+
+
+def get_metadata_path(artifact_path) -> Path:
+    """The json metadata of an exported artifact: img_size, num_outputs, softmax, format, ..."""
+    artifact_path = Path(artifact_path)
+    return artifact_path.with_name(artifact_path.name + ".json")
+
+
+class PatchRuntime:
+    """
+    Scores (N, H, W, 3) uint8 patches with an exported patch scorer on CPU, in batches of
+    batch_size, using num_threads intra-op threads (all cores by default). Patches larger
+    than the img_size of the artifact are center cropped.
+    """
+
+    def __init__(self, artifact_path, num_threads: Optional[int] = None, batch_size: int = 256):
+        self.artifact_path = Path(artifact_path)
+        with open(get_metadata_path(self.artifact_path)) as file:
+            self.metadata = json.load(file)
+        self.img_size = self.metadata["img_size"]
+        self.batch_size = batch_size
+        self.num_threads = num_threads if num_threads is not None else os.cpu_count()
+
+        if self.metadata["format"] == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            options.intra_op_num_threads = self.num_threads
+            options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._session = onnxruntime.InferenceSession(
+                str(self.artifact_path), options, providers=["CPUExecutionProvider"]
+            )
+            self._model = None
+        else:
+            torch.set_num_threads(self.num_threads)
+            self._model = torch.jit.load(str(self.artifact_path), map_location="cpu").eval()
+            self._session = None
+
+    def _score_batch(self, patches: np.ndarray) -> np.ndarray:
+        if self._session is not None:
+            return self._session.run(None, {"patches": patches})[0]
+        with torch.inference_mode():
+            return self._model(torch.from_numpy(patches)).numpy()
+
+    def score(self, patches: np.ndarray) -> np.ndarray:
+        """Returns the (N, num_outputs) float32 scores of (N, H, W, 3) uint8 patches."""
+        offset = (patches.shape[1] - self.img_size) // 2
+        if offset > 0:
+            patches = patches[:, offset:offset + self.img_size, offset:offset + self.img_size]
+        scores = np.empty((patches.shape[0], self.metadata["num_outputs"]), dtype=np.float32)
+        for start in range(0, patches.shape[0], self.batch_size):
+            batch = np.ascontiguousarray(patches[start:start + self.batch_size], dtype=np.uint8)
+            scores[start:start + batch.shape[0]] = self._score_batch(batch)
+        return scores
+
+    def benchmark(self, batches: int = 20, warmup: int = 3, seed: int = 0) -> Dict:
+        """The throughput in tiles/s and the mean batch latency on random patches of batch_size."""
+        rng = np.random.default_rng(seed)
+        patches = rng.integers(0, 256, (self.batch_size, self.img_size, self.img_size, 3), dtype=np.uint8)
+        for _ in range(warmup):
+            self._score_batch(patches)
+        latencies = []
+        for _ in range(batches):
+            start_time = time.perf_counter()
+            self._score_batch(patches)
+            latencies.append(time.perf_counter() - start_time)
+        elapsed = sum(latencies)
+        stats = {
+            "format": self.metadata["format"],
+            "num_threads": self.num_threads,
+            "batch_size": self.batch_size,
+            "tiles": batches * self.batch_size,
+            "seconds": elapsed,
+            "tiles_per_second": batches * self.batch_size / max(elapsed, 1e-9),
+            "batch_latency_ms": 1000 * float(np.mean(latencies)),
+        }
+        print(
+            f"{self.artifact_path.name}: {stats['tiles_per_second']:.1f} tiles/s, {stats['batch_latency_ms']:.0f} ms per "
+            f"batch of {self.batch_size}, {self.num_threads} threads"
+        )
+        return stats
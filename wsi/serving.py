@@ -0,0 +1,378 @@
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+
+from .core import constants
+from .datasets.slides_manager import SlidesManager
+from .mil_transformer_classifier import MilTransformerClassifier
+
+
+class _LatencyCounter:
+    # the latencies of the last window events, for percentiles
+
+    def __init__(self, window: int = 1000):
+        self._latencies: Deque[float] = deque(maxlen=window)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds: float):
+        with self._lock:
+            self._latencies.append(seconds)
+            self._count += 1
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            latencies = np.array(self._latencies)
+            count = self._count
+        if latencies.size == 0:
+            return {"count": count, "p50_ms": None, "p99_ms": None}
+        p50, p99 = np.percentile(latencies, [50, 99]) * 1000
+        return {"count": count, "p50_ms": float(p50), "p99_ms": float(p99)}
+
+
+class _WorkItem:
+    def __init__(self, patches: torch.Tensor):
+        self.patches = patches
+        self.future: Future = Future()
+        self.enqueue_time = time.perf_counter()
+
+
+class DynamicBatcher:
+    """
+    Merges the patches of concurrent work items into model batches on a worker thread. A batch
+    is run once it has max_batch_size patches, or once the oldest of its patches has waited
+    max_latency_ms, whichever comes first. Work items are never split, so an item may have at
+    most max_batch_size patches. submit returns a future of the (n, ...) float32 CPU outputs
+    of the item.
+    """
+
+    def __init__(
+        self, forward: Callable[[torch.Tensor], torch.Tensor], max_batch_size: int = 256, max_latency_ms: float = 20
+    ):
+        self.forward = forward
+        self.max_batch_size = max_batch_size
+        self.max_latency_ms = max_latency_ms
+        self._queue: "queue.Queue[Optional[_WorkItem]]" = queue.Queue()
+        self._carry: Optional[_WorkItem] = None  # did not fit the previous batch
+        self._queued_patches = 0
+        self._lock = threading.Lock()
+        self._batch_latency = _LatencyCounter()
+        self._wait_latency = _LatencyCounter()
+        self._batches = 0
+        self._batched_patches = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, patches: torch.Tensor) -> Future:
+        if patches.shape[0] > self.max_batch_size:
+            raise ValueError(f"A work item has {patches.shape[0]} patches, more than max_batch_size {self.max_batch_size}")
+        item = _WorkItem(patches)
+        with self._lock:
+            self._queued_patches += patches.shape[0]
+        self._queue.put(item)
+        return item.future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            queued_patches = self._queued_patches
+            batches = self._batches
+            batched_patches = self._batched_patches
+        return {
+            "queue_depth": self._queue.qsize() + (self._carry is not None),
+            "queued_patches": queued_patches,
+            "batches": batches,
+            "mean_batch_size": batched_patches / max(batches, 1),
+            "batch_latency": self._batch_latency.get_stats(),
+            "queue_wait": self._wait_latency.get_stats(),
+        }
+
+    def _next_batch(self) -> Optional[List[_WorkItem]]:
+        item = self._carry if self._carry is not None else self._queue.get()
+        self._carry = None
+        if item is None:
+            return None
+        items = [item]
+        patches_count = item.patches.shape[0]
+        deadline = item.enqueue_time + self.max_latency_ms / 1000
+        while patches_count < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None or patches_count + item.patches.shape[0] > self.max_batch_size:
+                self._carry = item
+                break
+            items.append(item)
+            patches_count += item.patches.shape[0]
+        return items
+
+    def _run(self):
+        while True:
+            items = self._next_batch()
+            if items is None:
+                return
+            start_time = time.perf_counter()
+            sizes = [item.patches.shape[0] for item in items]
+            with self._lock:
+                self._queued_patches -= sum(sizes)
+            for item in items:
+                self._wait_latency.record(start_time - item.enqueue_time)
+            try:
+                # grad mode is per thread
+                with torch.inference_mode():
+                    outputs = self.forward(torch.cat([item.patches for item in items])).float().cpu()
+            except Exception as e:
+                for item in items:
+                    item.future.set_exception(e)
+                continue
+            for item, item_outputs in zip(items, torch.split(outputs, sizes)):
+                item.future.set_result(item_outputs)
+            with self._lock:
+                self._batches += 1
+                self._batched_patches += sum(sizes)
+            self._batch_latency.record(time.perf_counter() - start_time)
+
+
+def get_grid_bags(locations: np.ndarray, side_length: int, min_fill: float = 0.5) -> Tuple[np.ndarray, np.ndarray, int]:
+    """
+    Splits the tiles of a slide into bags of the side_length x side_length windows of the tile
+    grid that have at least min_fill of their tiles, the fullest windows when none has. Returns
+    the bag of every tile (-1 for tiles of dropped windows), its position in the bag and the
+    number of bags.
+    """
+    windows = locations // side_length
+    _, window_idx, counts = np.unique(windows, axis=0, return_inverse=True, return_counts=True)
+    window_idx = window_idx.reshape(-1)
+    keep = counts >= min_fill * side_length ** 2
+    if not keep.any():
+        keep = counts == counts.max()
+    bag_idx = np.full(counts.shape[0], -1, dtype=np.int64)
+    bag_idx[keep] = np.arange(int(keep.sum()))
+    offsets = locations - windows * side_length
+    positions = offsets[:, 0] * side_length + offsets[:, 1]
+    return bag_idx[window_idx], positions, int(keep.sum())
+
+
+class SlideScoringService:
+    """
+    Scores slides of a slides manager by name with a loaded WsiClassifier or
+    MilTransformerClassifier. The tiles of a slide are read by reader threads in work items of
+    work_item_size tiles and the work items of all requests are batched together by a
+    DynamicBatcher on the device. At most max_inflight_items work items of a request are in
+    flight, so the tiles of a large slide are not all in memory at once.
+
+    A WsiClassifier scores every tile, the slide scores are the mean tile scores. For a
+    MilTransformerClassifier the batcher extracts the tile features with its online feature
+    extractor (or feature_extractor), the tile grid is split into bags of bag_size tiles (see
+    get_grid_bags) and the slide scores are the mean bag scores, the tile scores the scores of
+    their bag (NaN for tiles of no bag).
+    """
+
+    def __init__(
+        self,
+        model: torch.nn.Module,
+        slides_manager: SlidesManager,
+        mean,
+        std,
+        img_size: int = 256,
+        max_batch_size: int = 256,
+        max_latency_ms: float = 20,
+        work_item_size: int = 64,
+        max_inflight_items: int = 16,
+        reader_threads: int = 8,
+        device=None,
+        autocast: bool = True,
+        feature_extractor: Optional[torch.nn.Module] = None,
+        min_bag_fill: float = 0.5,
+    ):
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.model = model.to(self.device).eval()
+        self.slides_manager = slides_manager
+        self.img_size = img_size
+        self.work_item_size = min(work_item_size, max_batch_size)
+        self.max_inflight_items = max_inflight_items
+        self.autocast = autocast and self.device.type == "cuda"
+        self.min_bag_fill = min_bag_fill
+        self._mean = torch.tensor(mean, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+        self._std = torch.tensor(std, dtype=torch.float32, device=self.device).view(1, 3, 1, 1)
+        self._slide_indices = {
+            name: i for i, name in enumerate(slides_manager.metadata[constants.file_column_name])
+        }
+
+        self.mil = isinstance(model, MilTransformerClassifier)
+        if self.mil:
+            feature_extractor = feature_extractor if feature_extractor is not None else model.feature_extractor
+            if feature_extractor is None:
+                raise ValueError("A MilTransformerClassifier without an online feature extractor needs a feature_extractor")
+            if model.hparams.num_grids_pos_encode != 1:
+                raise ValueError("Scoring bags of several grids is not supported")
+            self._feature_extractor = feature_extractor.to(self.device).eval()
+            self._side_length = int(round(model.hparams.bag_size ** 0.5))
+            batch_forward = self._extract_features
+        else:
+            batch_forward = self._score_tiles
+        self._batcher = DynamicBatcher(batch_forward, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms)
+        self._readers = ThreadPoolExecutor(max_workers=reader_threads)
+        self._request_latency = _LatencyCounter()
+        self._active_requests = 0
+        self._lock = threading.Lock()
+
+    def _transform(self, tiles: torch.Tensor) -> torch.Tensor:
+        # (n, T, T, 3) uint8 -> normalized (n, 3, img_size, img_size)
+        x = tiles.to(self.device, non_blocking=True).permute(0, 3, 1, 2)
+        offset = (x.shape[-1] - self.img_size) // 2
+        if offset > 0:
+            x = x[..., offset:offset + self.img_size, offset:offset + self.img_size]
+        return (x.float() / 255 - self._mean) / self._std
+
+    def _score_tiles(self, tiles: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device_type=self.device.type, enabled=self.autocast):
+            return self.model(self._transform(tiles)).float().softmax(1)
+
+    def _extract_features(self, tiles: torch.Tensor) -> torch.Tensor:
+        with torch.autocast(device_type=self.device.type, enabled=self.autocast):
+            return self._feature_extractor.forward_features(self._transform(tiles))
+
+    def _read_work_item(self, slide, start: int) -> Tuple[np.ndarray, Future]:
+        slide_context = slide.slide_context
+        top_left_pixels = slide.pixels[start:start + self.work_item_size]
+        tiles = slide_context.read_regions(pixels=top_left_pixels + slide_context.zero_level_half_tile_size)
+        locations = slide_context.pixels_to_locations(pixels=top_left_pixels).astype(np.int64)
+        return locations, self._batcher.submit(torch.from_numpy(tiles))
+
+    def _score_bags(self, locations: np.ndarray, features: torch.Tensor) -> Tuple[np.ndarray, np.ndarray]:
+        tile_bags, positions, bags_count = get_grid_bags(locations, self._side_length, self.min_bag_fill)
+        in_bag = tile_bags >= 0
+        bags = torch.zeros((bags_count, self._side_length ** 2, features.shape[1]), dtype=torch.float32)
+        bags[torch.from_numpy(tile_bags[in_bag]), torch.from_numpy(positions[in_bag])] = features[torch.from_numpy(in_bag)]
+        with torch.inference_mode():
+            bag_scores = self.model(bags.to(self.device)).float().softmax(1).cpu().numpy()
+        tile_scores = np.full((locations.shape[0], bag_scores.shape[1]), np.nan, dtype=np.float32)
+        tile_scores[in_bag] = bag_scores[tile_bags[in_bag]]
+        return bag_scores.mean(axis=0), tile_scores
+
+    def score_slide(self, slide_name: str, return_tiles: bool = True) -> Dict:
+        """Returns the slide scores and, with return_tiles, the tile grid locations and scores of all tiles of the slide."""
+        if slide_name not in self._slide_indices:
+            raise KeyError(f"Unknown slide {slide_name}")
+        start_time = time.perf_counter()
+        with self._lock:
+            self._active_requests += 1
+        try:
+            slide = self.slides_manager.get_slide(self._slide_indices[slide_name])
+            # at most max_inflight_items work items of the request are read or queued at a time
+            reads: Deque[Future] = deque()
+            slide_locations, slide_outputs = [], []
+            starts = iter(range(0, slide.tiles_count, self.work_item_size))
+            for start in starts:
+                reads.append(self._readers.submit(self._read_work_item, slide, start))
+                if len(reads) == self.max_inflight_items:
+                    break
+            while reads:
+                item_locations, future = reads.popleft().result()
+                slide_locations.append(item_locations)
+                slide_outputs.append(future.result())
+                start = next(starts, None)
+                if start is not None:
+                    reads.append(self._readers.submit(self._read_work_item, slide, start))
+            locations = np.concatenate(slide_locations)
+            outputs = torch.cat(slide_outputs)
+            if self.mil:
+                slide_scores, tile_scores = self._score_bags(locations, outputs)
+            else:
+                tile_scores = outputs.numpy()
+                slide_scores = tile_scores.mean(axis=0)
+        finally:
+            with self._lock:
+                self._active_requests -= 1
+        latency = time.perf_counter() - start_time
+        self._request_latency.record(latency)
+
+        result = {
+            "slide_name": slide_name,
+            "tiles_count": int(locations.shape[0]),
+            "slide_scores": slide_scores.tolist(),
+            "latency_ms": latency * 1000,
+        }
+        if return_tiles:
+            result["tile_locations"] = locations.tolist()
+            # NaN is not valid json
+            result["tile_scores"] = [[None if np.isnan(s) else float(s) for s in scores] for scores in tile_scores]
+        return result
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            active_requests = self._active_requests
+        return {
+            "active_requests": active_requests,
+            "request_latency": self._request_latency.get_stats(),
+            **self._batcher.get_stats(),
+        }
+
+    def close(self):
+        self._readers.shutdown(wait=True)
+        self._batcher.close()
+
+
+def create_server(service: SlideScoringService, host: str = "127.0.0.1", port: int = 8000) -> ThreadingHTTPServer:
+    """
+    A json HTTP server of a scoring service, every request on its own thread:
+        POST /score {"slide_name": ..., "tile_scores": true}  the result of score_slide
+        GET  /stats                                            queue depth, batches, p50/p99 latencies
+        GET  /health
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status: int, body: Dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                self._send(200, service.get_stats())
+            elif self.path == "/health":
+                self._send(200, {"status": "ok"})
+            else:
+                self._send(404, {"error": f"Unknown path {self.path}"})
+
+        def do_POST(self):
+            if self.path != "/score":
+                self._send(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                slide_name = request["slide_name"]
+            except (ValueError, KeyError) as e:
+                self._send(400, {"error": f"Bad request, expected {{\"slide_name\": ...}}: {e}"})
+                return
+            try:
+                self._send(200, service.score_slide(slide_name, return_tiles=request.get("tile_scores", True)))
+            except KeyError as e:
+                self._send(404, {"error": str(e)})
+            except Exception as e:
+                self._send(500, {"error": repr(e)})
+
+        def log_message(self, format, *args):
+            # the latencies are in /stats, not in a line per request
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
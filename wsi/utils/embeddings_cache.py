@@ -0,0 +1,172 @@
+import hashlib
+import os
+import uuid
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Set, Tuple
+
+import h5py
+import numpy as np
+import torch
+
+from .features_writer import get_state_dict_hash
+from ..core import utils
+
+# An embeddings cache directory, {cache_dir}/{key}, holds the backbone outputs of training patches
+# of a frozen backbone, keyed by slide name and center pixel. The key identifies the weights of the
+# backbone, the transform of the patches and their tile size and mpp. Every rank saves the embeddings it computed in an epoch
+# to its own file:
+#   slide_names  (slides_count,) str
+#   slide_ids    (N,) int32, the slide of every embedding
+#   coords_keys  (N,) int64, the packed center pixel of every embedding
+#   embeddings   (N, features_dim) float32
+
+
+def get_embeddings_cache_key(backbone: torch.nn.Module, transform, tile_size: int, desired_mpp: float) -> str:
+    """The cache key of the outputs of a backbone on patches of a deterministic transform."""
+    sha = hashlib.sha1(get_state_dict_hash(backbone).encode())
+    sha.update(repr(transform).encode())
+    sha.update(f"|tile_size={tile_size}|desired_mpp={float(desired_mpp)}".encode())
+    return sha.hexdigest()
+
+
+class EmbeddingsCache:
+    """
+    Backbone embeddings of patches by slide name and center pixel, loaded from and saved to an
+    embeddings cache directory (see above). Embeddings added since the last save are saved in a
+    new file of the rank, load reads the files it did not read yet, of all ranks.
+    """
+
+    def __init__(self, cache_dir_path, key: str):
+        self._dir = Path(cache_dir_path) / key
+        self._embeddings: Dict[str, Dict[int, np.ndarray]] = {}
+        self._unsaved: List[Tuple[str, int, np.ndarray]] = []
+        self._loaded_files: Set[str] = set()
+
+    def __len__(self):
+        return sum(len(slide_embeddings) for slide_embeddings in self._embeddings.values())
+
+    def load(self):
+        if not self._dir.is_dir():
+            return
+        for path in sorted(self._dir.glob("*.h5")):
+            if path.name in self._loaded_files:
+                continue
+            with h5py.File(path, "r") as file:
+                slide_names = file["slide_names"].asstr()[:]
+                slide_ids = file["slide_ids"][:]
+                coords_keys = file["coords_keys"][:]
+                embeddings = file["embeddings"][:]
+            for slide_id, coords_key, embedding in zip(slide_ids, coords_keys, embeddings):
+                self._embeddings.setdefault(slide_names[slide_id], {})[int(coords_key)] = embedding
+            self._loaded_files.add(path.name)
+
+    def save(self, rank: int = 0):
+        if not self._unsaved:
+            return
+        self._dir.mkdir(parents=True, exist_ok=True)
+        slide_names, slide_ids = np.unique([slide_name for slide_name, _, _ in self._unsaved], return_inverse=True)
+        name = f"rank{rank}-{uuid.uuid4().hex}.h5"
+        tmp_path = self._dir / f".{name}.tmp"
+        with h5py.File(tmp_path, "w") as file:
+            file.create_dataset("slide_names", data=slide_names.astype(object), dtype=h5py.string_dtype())
+            file.create_dataset("slide_ids", data=slide_ids.astype(np.int32))
+            file.create_dataset("coords_keys", data=np.array([key for _, key, _ in self._unsaved], dtype=np.int64))
+            file.create_dataset("embeddings", data=np.stack([embedding for _, _, embedding in self._unsaved]))
+        os.replace(tmp_path, self._dir / name)
+        self._loaded_files.add(name)
+        self._unsaved = []
+
+    def lookup(self, slide_names: Sequence[str], center_pixels: np.ndarray) -> Tuple[List, np.ndarray]:
+        """Returns the embeddings of the patches (None where missing) and the mask of the found ones."""
+        keys = utils.pack_coords(np.asarray(center_pixels).reshape(-1, 2))
+        embeddings = [
+            self._embeddings.get(slide_name, {}).get(int(key)) for slide_name, key in zip(slide_names, keys)
+        ]
+        return embeddings, np.array([embedding is not None for embedding in embeddings], dtype=bool)
+
+    def add(self, slide_names: Sequence[str], center_pixels: np.ndarray, embeddings: np.ndarray):
+        keys = utils.pack_coords(np.asarray(center_pixels).reshape(-1, 2))
+        for slide_name, key, embedding in zip(slide_names, keys, np.asarray(embeddings, dtype=np.float32)):
+            self._embeddings.setdefault(slide_name, {})[int(key)] = embedding
+            self._unsaved.append((slide_name, int(key), embedding))
+
+    def get_embeddings(self, backbone: torch.nn.Module, batch: Dict) -> torch.Tensor:
+        """
+        The embeddings of a batch of patches, the backbone runs only on the patches that are not
+        cached yet and their embeddings are added. A batch without "patch" must be all cached.
+        """
+        slide_names = batch["slide_name"]
+        center_pixels = batch["center_pixel"].cpu().numpy()
+        embeddings, found = self.lookup(slide_names, center_pixels)
+        if not found.all():
+            if "patch" not in batch:
+                raise ValueError(f"{int((~found).sum())} patches of a batch without patches are not cached")
+            missing = np.flatnonzero(~found)
+            with torch.no_grad():
+                computed = backbone(batch["patch"][torch.from_numpy(missing).to(batch["patch"].device)])
+            computed = computed.float().cpu().numpy()
+            self.add([slide_names[i] for i in missing], center_pixels[missing], computed)
+            for i, embedding in zip(missing, computed):
+                embeddings[i] = embedding
+        return torch.from_numpy(np.stack(embeddings)).to(batch["label"].device)
+
+
+class EmbeddingsCacheMixin:
+    """
+    The embeddings cache of a LightningModule with a backbone, trained on the datamodule train
+    dataset (a deterministic RandomPatchDataset), with hparams cache_embeddings and
+    embeddings_cache_dir_path. The module sets self._embeddings_cache = self._create_embeddings_cache()
+    in on_fit_start and gets the embeddings of its training batches from it. Once every training
+    patch is cached the dataset stops reading patches, the batches then have no "patch".
+    """
+
+    _embeddings_cache: Optional[EmbeddingsCache] = None
+
+    def _create_embeddings_cache(self) -> Optional[EmbeddingsCache]:
+        frozen = not any(param.requires_grad for param in self.backbone.parameters())
+        datamodule = self.trainer.datamodule
+        get_transform = getattr(datamodule, "get_deterministic_train_transform", None)
+        transform = get_transform() if get_transform is not None else None
+        if not frozen or transform is None:
+            print("WARNING: embeddings are cached only for a frozen backbone and deterministic_train_patches, not caching")
+            return None
+        # the backbone runs in eval mode from now on, see train
+        self.backbone.eval()
+        dataset = datamodule.train_dataset
+        cache = EmbeddingsCache(
+            self.hparams.embeddings_cache_dir_path,
+            get_embeddings_cache_key(
+                self.backbone, transform, tile_size=dataset.tile_size, desired_mpp=dataset.desired_mpp
+            ),
+        )
+        cache.load()
+        print(f"Caching backbone embeddings, {len(cache)} cached")
+        self._train_items = dataset.get_deterministic_items()
+        self._skip_cached_patches(cache)
+        return cache
+
+    def _skip_cached_patches(self, cache: EmbeddingsCache):
+        dataset = self.trainer.datamodule.train_dataset
+        if dataset.skips_patches:
+            return
+        _, found = cache.lookup(*self._train_items)
+        if found.all():
+            # the workers are persistent, the dataset shares the flag with them
+            dataset.skip_patches(True)
+            print("All training embeddings are cached, training patches are no longer read")
+
+    def train(self, mode: bool = True):
+        super().train(mode)
+        # cached embeddings are of the backbone in eval mode, batch norm statistics stay as loaded
+        if self._embeddings_cache is not None:
+            self.backbone.eval()
+        return self
+
+    def on_train_epoch_end(self):
+        if self._embeddings_cache is None:
+            return
+        # every rank saves its new embeddings, then reads the ones of the other ranks
+        self._embeddings_cache.save(rank=self.global_rank)
+        self.trainer.strategy.barrier()
+        self._embeddings_cache.load()
+        self._skip_cached_patches(self._embeddings_cache)
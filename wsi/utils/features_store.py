@@ -0,0 +1,483 @@
+import hashlib
+import os
+import shutil
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+from ..core import utils
+from ..core.handle_pools import get_h5_pool
+from ..core.h5_tiles import TileIndex
+
+# A features store is a directory with the features of all tiles of a cohort in one matrix:
+#   features.npy      (tiles_count, features_dim) float16 / float32
+#   coords.npy        (tiles_count, 2) int32, the center pixels of the tiles
+#   slide_offsets.npy (slides_count + 1,) int64, the rows of slide i are slide_offsets[i]:slide_offsets[i + 1]
+#   slide_names.npy   (slides_count,) str
+#   coords_keys.npy   (tiles_count,) int64, the packed coords of every slide, sorted within the slide
+#   coords_order.npy  (tiles_count,) int32, the row in its slide of every key
+# and for int8 features (see utils.quantization) the per slide quantization parameters:
+#   features_scale.npy      (slides_count, features_dim) float32
+#   features_zero_point.npy (slides_count, features_dim) int32
+# The matrices are memory-mapped, so reading a bag touches only the rows of the bag.
+features_file_suffix = "_features.h5"
+_store_arrays = ("features", "coords", "slide_offsets", "slide_names")
+_coords_index_arrays = ("coords_keys", "coords_order")
+_quantization_arrays = ("features_scale", "features_zero_point")
+
+
+def build_coords_index(coords: np.ndarray, slide_offsets: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the coords_keys and coords_order arrays of a features store, see above."""
+    counts = np.diff(slide_offsets)
+    slide_ids = np.repeat(np.arange(counts.shape[0]), counts)
+    keys = utils.pack_coords(coords)
+    order = np.lexsort((keys, slide_ids))
+    local_order = order - np.repeat(slide_offsets[:-1], counts)
+    return keys[order], local_order.astype(np.int32)
+
+
+class FeaturesReader(ABC):
+    """Reads the features and the coords of the tiles of a slide, by slide name."""
+
+    @abstractmethod
+    def get_slide_size(self, slide_name: str) -> int:
+        pass
+
+    @abstractmethod
+    def get_coords(self, slide_name: str) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def get_features(self, slide_name: str, rows: np.ndarray) -> np.ndarray:
+        pass
+
+    @abstractmethod
+    def get_coords_index(self, slide_name: str) -> TileIndex:
+        pass
+
+    def get_quantization(self, slide_name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        """The (scale, zero_point) of int8 features, None for float features."""
+        return None
+
+    def lookup(self, slide_name: str, coords: np.ndarray) -> np.ndarray:
+        """Returns the row of every (x, y) in coords, -1 for coords without features, in the order of coords."""
+        return self.get_coords_index(slide_name).lookup(np.asarray(coords).astype(np.int32))
+
+
+class H5FeaturesReader(FeaturesReader):
+    """
+    Reader of a directory of {slide_name}_features.h5 files, as written by FeaturesWriter. The
+    files are read through the process h5 handle pool, so reading a bag does not open its file.
+    """
+
+    def __init__(self, features_dir: Union[str, Path]):
+        self._features_dir = Path(features_dir)
+        self._coords_indices: Dict[str, TileIndex] = {}
+        self._quantizations: Dict[str, Optional[Tuple[np.ndarray, np.ndarray]]] = {}
+
+    def _get_path(self, slide_name: str) -> Path:
+        return self._features_dir / f"{slide_name}{features_file_suffix}"
+
+    def get_slide_size(self, slide_name: str) -> int:
+        with get_h5_pool().acquire(self._get_path(slide_name)) as h5_file:
+            return h5_file["features"].shape[0]
+
+    def get_coords(self, slide_name: str) -> np.ndarray:
+        with get_h5_pool().acquire(self._get_path(slide_name)) as h5_file:
+            return h5_file["coords"][:]
+
+    def get_features(self, slide_name: str, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        with get_h5_pool().acquire(self._get_path(slide_name)) as h5_file:
+            dataset = h5_file["features"]
+            if rows.shape[0] == 0:
+                return np.zeros((0,) + dataset.shape[1:], dtype=dataset.dtype)
+            # h5py reads only increasing indices
+            unique_rows, inverse = np.unique(rows, return_inverse=True)
+            return dataset[unique_rows][inverse]
+
+    def get_quantization(self, slide_name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        # read once per slide, like the coords index
+        if slide_name not in self._quantizations:
+            with get_h5_pool().acquire(self._get_path(slide_name)) as h5_file:
+                attrs = h5_file["metadata"].attrs if "metadata" in h5_file else {}
+                self._quantizations[slide_name] = (
+                    (np.asarray(attrs["features_scale"]), np.asarray(attrs["features_zero_point"]))
+                    if "features_scale" in attrs
+                    else None
+                )
+        return self._quantizations[slide_name]
+
+    def get_coords_index(self, slide_name: str) -> TileIndex:
+        # built on the first access to the slide, then kept for the lifetime of the reader
+        coords_index = self._coords_indices.get(slide_name)
+        if coords_index is None:
+            coords_index = TileIndex(self.get_coords(slide_name))
+            self._coords_indices[slide_name] = coords_index
+        return coords_index
+
+
+class FeaturesStore(FeaturesReader):
+    """Reader of a features store directory, see convert_h5_features."""
+
+    def __init__(self, store_dir: Union[str, Path]):
+        self._store_dir = Path(store_dir)
+        arrays = {
+            name: np.load(self._store_dir / f"{name}.npy", mmap_mode="r")
+            for name in _store_arrays
+        }
+        self._features = arrays["features"]
+        self._coords = arrays["coords"]
+        self._slide_offsets = np.asarray(arrays["slide_offsets"])
+        self._slide_names = np.asarray(arrays["slide_names"])
+        self._slide_name_to_idx = {name: i for i, name in enumerate(self._slide_names.tolist())}
+        if all((self._store_dir / f"{name}.npy").is_file() for name in _coords_index_arrays):
+            self._coords_keys = np.load(self._store_dir / "coords_keys.npy", mmap_mode="r")
+            self._coords_order = np.load(self._store_dir / "coords_order.npy", mmap_mode="r")
+        else:
+            self._coords_keys, self._coords_order = build_coords_index(
+                np.asarray(self._coords), self._slide_offsets
+            )
+        self._features_scale = self._features_zero_point = None
+        if all((self._store_dir / f"{name}.npy").is_file() for name in _quantization_arrays):
+            self._features_scale = np.load(self._store_dir / "features_scale.npy")
+            self._features_zero_point = np.load(self._store_dir / "features_zero_point.npy")
+
+    @staticmethod
+    def is_store(features_dir: Union[str, Path]) -> bool:
+        return all((Path(features_dir) / f"{name}.npy").is_file() for name in _store_arrays)
+
+    @property
+    def features(self) -> np.ndarray:
+        return self._features
+
+    @property
+    def coords(self) -> np.ndarray:
+        return self._coords
+
+    @property
+    def slide_names(self) -> np.ndarray:
+        return self._slide_names
+
+    @property
+    def features_dim(self) -> int:
+        return self._features.shape[1]
+
+    def get_slide_rows(self, slide_name: str) -> Tuple[int, int]:
+        """Returns the (offset, count) of the rows of the slide."""
+        slide_idx = self._slide_name_to_idx[slide_name]
+        offset = int(self._slide_offsets[slide_idx])
+        return offset, int(self._slide_offsets[slide_idx + 1]) - offset
+
+    def get_slide_size(self, slide_name: str) -> int:
+        return self.get_slide_rows(slide_name)[1]
+
+    def get_coords(self, slide_name: str) -> np.ndarray:
+        offset, count = self.get_slide_rows(slide_name)
+        return np.asarray(self._coords[offset:offset + count])
+
+    def get_features(self, slide_name: str, rows: np.ndarray) -> np.ndarray:
+        offset, count = self.get_slide_rows(slide_name)
+        rows = np.asarray(rows, dtype=np.int64)
+        if rows.shape[0] > 0 and (rows.min() < 0 or rows.max() >= count):
+            raise IndexError(f"rows out of range for slide {slide_name} with {count} tiles")
+        return self._features[offset + rows]
+
+    def get_quantization(self, slide_name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        if self._features_scale is None:
+            return None
+        slide_idx = self._slide_name_to_idx[slide_name]
+        return self._features_scale[slide_idx], self._features_zero_point[slide_idx]
+
+    def get_coords_index(self, slide_name: str) -> TileIndex:
+        offset, count = self.get_slide_rows(slide_name)
+        return TileIndex.from_sorted_keys(
+            keys=self._coords_keys[offset:offset + count],
+            order=self._coords_order[offset:offset + count],
+        )
+
+    def __getstate__(self):
+        # pickling a memory-mapped array copies it, the store is mapped again instead
+        return {"_store_dir": self._store_dir}
+
+    def __setstate__(self, state):
+        self.__init__(state["_store_dir"])
+
+
+class CachedFeaturesReader(FeaturesReader):
+    """
+    Keeps whole slides of another reader in cache_dir_path, normally on /dev/shm, so the
+    DataLoader workers and the ranks of a node share one copy of every slide in RAM and
+    only the first access to a slide reads it from disk. Every cached slide is a directory
+    with its features (float features in the given dtype, returned as float32, int8
+    features as they are, with their quantization), coords and coords index,
+    written to a temporary directory and renamed into place by whichever process gets to
+    it first. The slides of every reader are in a namespace directory of cache_dir_path and
+    all of cache_dir_path is bounded by max_bytes, evicting the least recently used slides
+    of any namespace.
+
+    Every process keeps the mapped arrays of the slides it read, so reading a slide again
+    costs no system calls. The mtime of a slide, its last access for eviction, is touched
+    at most every touch_interval_seconds per process, which is also when a slide evicted
+    by another process is found and mapped (or filled) again.
+    """
+
+    _arrays = ("features", "coords", "coords_keys", "coords_order")
+    touch_interval_seconds = 60
+    max_mapped_slides = 1024
+
+    def __init__(
+        self,
+        reader: FeaturesReader,
+        cache_dir_path: Union[str, Path],
+        max_bytes: int,
+        namespace: str,
+        dtype: str = "float16",
+    ):
+        self._reader = reader
+        self._cache_root_path = Path(cache_dir_path)
+        self._cache_dir_path = self._cache_root_path / namespace
+        self._cache_dir_path.mkdir(parents=True, exist_ok=True)
+        self._max_bytes = max_bytes
+        self._dtype = np.dtype(dtype)
+        self._reset_mapped()
+
+    def _reset_mapped(self):
+        # slide name -> (mapped arrays, time of the last touch), of this process only
+        self._mapped: "OrderedDict[str, Tuple[Dict[str, np.ndarray], float]]" = OrderedDict()
+        self._pid = os.getpid()
+
+    def get_slide_size(self, slide_name: str) -> int:
+        return self._load_slide(slide_name)["coords"].shape[0]
+
+    def get_coords(self, slide_name: str) -> np.ndarray:
+        return np.asarray(self._load_slide(slide_name)["coords"])
+
+    def get_features(self, slide_name: str, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        features = self._load_slide(slide_name)["features"][rows]
+        return features if features.dtype == np.int8 else features.astype(np.float32)
+
+    def get_quantization(self, slide_name: str) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+        arrays = self._load_slide(slide_name)
+        if "features_scale" not in arrays:
+            return None
+        return np.asarray(arrays["features_scale"]), np.asarray(arrays["features_zero_point"])
+
+    def get_coords_index(self, slide_name: str) -> TileIndex:
+        arrays = self._load_slide(slide_name)
+        return TileIndex.from_sorted_keys(keys=arrays["coords_keys"], order=arrays["coords_order"])
+
+    def _load_slide(self, slide_name: str) -> Dict[str, np.ndarray]:
+        if self._pid != os.getpid():
+            self._reset_mapped()
+        entry_path = self._cache_dir_path / slide_name
+        now = time.monotonic()
+        mapped = self._mapped.get(slide_name)
+        if mapped is not None:
+            arrays, touch_time = mapped
+            self._mapped.move_to_end(slide_name)
+            if now - touch_time < self.touch_interval_seconds:
+                return arrays
+            try:
+                os.utime(entry_path)  # the mtime of an entry is its last access
+                self._mapped[slide_name] = (arrays, now)
+                return arrays
+            except FileNotFoundError:
+                # evicted, the mapping is dropped so its memory can be freed
+                del self._mapped[slide_name]
+
+        try:
+            arrays = CachedFeaturesReader._map_arrays(entry_path)
+            os.utime(entry_path)
+        except FileNotFoundError:
+            # not cached yet, or evicted
+            arrays = self._fill(slide_name)
+        self._mapped[slide_name] = (arrays, now)
+        if len(self._mapped) > self.max_mapped_slides:
+            self._mapped.popitem(last=False)
+        return arrays
+
+    @staticmethod
+    def _map_arrays(path: Path) -> Dict[str, np.ndarray]:
+        arrays = {
+            name: np.load(path / f"{name}.npy", mmap_mode="r")
+            for name in CachedFeaturesReader._arrays
+        }
+        if (path / "features_scale.npy").is_file():
+            arrays.update({name: np.load(path / f"{name}.npy") for name in _quantization_arrays})
+        return arrays
+
+    def _fill(self, slide_name: str) -> Dict[str, np.ndarray]:
+        coords = np.asarray(self._reader.get_coords(slide_name)).astype(np.int32)
+        features = self._reader.get_features(slide_name, np.arange(coords.shape[0]))
+        coords_keys, coords_order = build_coords_index(coords, np.array([0, coords.shape[0]]))
+        quantization = self._reader.get_quantization(slide_name)
+        arrays = {
+            "features": features if quantization is not None else features.astype(self._dtype),
+            "coords": coords,
+            "coords_keys": coords_keys,
+            "coords_order": coords_order,
+        }
+        if quantization is not None:
+            arrays.update(zip(_quantization_arrays, quantization))
+
+        entry_path = self._cache_dir_path / slide_name
+        tmp_path = self._cache_dir_path / f".{slide_name}.tmp-{os.getpid()}"
+        tmp_path.mkdir(parents=True, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(tmp_path / f"{name}.npy", array)
+        # mapped before the rename, the mapping stays valid even if the entry is evicted right away
+        mapped_arrays = CachedFeaturesReader._map_arrays(tmp_path)
+        try:
+            os.replace(tmp_path, entry_path)
+        except OSError:
+            # another process cached the slide first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self._evict(keep=entry_path)
+        return mapped_arrays
+
+    def _evict(self, keep: Path):
+        # the slides of all namespaces share the budget
+        entries = []
+        for namespace in os.scandir(self._cache_root_path):
+            if namespace.name.startswith(".") or not namespace.is_dir():
+                continue
+            try:
+                namespace_entries = list(os.scandir(namespace.path))
+            except FileNotFoundError:
+                continue
+            for entry in namespace_entries:
+                if entry.name.startswith(".") or not entry.is_dir():
+                    continue
+                try:
+                    size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                    entries.append((entry.stat().st_mtime, size, Path(entry.path)))
+                except FileNotFoundError:
+                    continue
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_bytes <= self._max_bytes:
+                break
+            if path == keep:
+                continue
+            # processes that mapped the slide keep reading it, the memory is freed when they are done
+            shutil.rmtree(path, ignore_errors=True)
+            total_bytes -= size
+
+    def __getstate__(self):
+        # pickling a memory-mapped array copies it, the slides are mapped again instead
+        state = dict(self.__dict__)
+        state["_mapped"] = OrderedDict()
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._pid = os.getpid()
+
+
+def open_features_reader(
+    features_dir: Union[str, Path],
+    cache_bytes: int = 0,
+    cache_dir_path: Optional[Union[str, Path]] = None,
+    cache_dtype: str = "float16",
+) -> FeaturesReader:
+    """
+    Returns a FeaturesStore if features_dir is a features store, otherwise an h5 files reader.
+    With cache_bytes > 0 the h5 files reader is wrapped in a CachedFeaturesReader in
+    cache_dir_path, cache_bytes bounding all the features cached there. A store is not cached, its memory-mapped pages are already shared
+    through the page cache.
+    """
+    if FeaturesStore.is_store(features_dir):
+        return FeaturesStore(features_dir)
+    reader = H5FeaturesReader(features_dir)
+    if cache_bytes > 0 and cache_dir_path is not None:
+        namespace = hashlib.sha1(
+            f"{Path(features_dir).resolve()}|{np.dtype(cache_dtype).name}".encode()
+        ).hexdigest()[:16]
+        reader = CachedFeaturesReader(
+            reader=reader,
+            cache_dir_path=cache_dir_path,
+            max_bytes=cache_bytes,
+            namespace=namespace,
+            dtype=cache_dtype,
+        )
+    return reader
+
+
+def convert_h5_features(
+    features_dir: Union[str, Path],
+    store_dir: Union[str, Path],
+    dtype: Optional[str] = None,
+) -> FeaturesStore:
+    """
+    Copies the {slide_name}_features.h5 files of features_dir into a features store in
+    store_dir, with features of the given dtype (the dtype of the h5 files by default).
+    int8 files are copied as they are, with their quantization parameters.
+    The store is written to a temporary directory and renamed into place.
+    """
+    paths = sorted(Path(features_dir).glob(f"*{features_file_suffix}"))
+    if not paths:
+        raise FileNotFoundError(f"No *{features_file_suffix} files in {features_dir}")
+
+    slide_names = [path.name[: -len(features_file_suffix)] for path in paths]
+    counts = []
+    features_shape: Dict[Tuple, np.dtype] = {}
+    for path in paths:
+        with h5py.File(path, "r") as h5_file:
+            counts.append(h5_file["features"].shape[0])
+            features_shape.setdefault(h5_file["features"].shape[1:], h5_file["features"].dtype)
+    if len(features_shape) != 1:
+        raise ValueError(f"The h5 files have different features shapes: {list(features_shape)}")
+    (features_dim_shape, source_dtype), = features_shape.items()
+    quantized = source_dtype == np.int8
+    if quantized and dtype is not None and np.dtype(dtype) != np.int8:
+        raise ValueError("int8 features are copied as they are, dtype cannot be changed")
+    slide_offsets = np.concatenate(([0], np.cumsum(counts))).astype(np.int64)
+
+    store_dir = Path(store_dir)
+    if store_dir.exists() and not FeaturesStore.is_store(store_dir):
+        raise FileExistsError(f"{store_dir} exists and is not a features store")
+    store_dir.parent.mkdir(parents=True, exist_ok=True)
+    tmp_dir = store_dir.with_name(f"{store_dir.name}.tmp-{os.getpid()}")
+    tmp_dir.mkdir(parents=True, exist_ok=True)
+    features = np.lib.format.open_memmap(
+        tmp_dir / "features.npy",
+        mode="w+",
+        dtype=np.dtype(dtype) if dtype is not None else source_dtype,
+        shape=(int(slide_offsets[-1]),) + features_dim_shape,
+    )
+    coords = np.lib.format.open_memmap(
+        tmp_dir / "coords.npy", mode="w+", dtype=np.int32, shape=(int(slide_offsets[-1]), 2)
+    )
+    features_scale = np.ones((len(paths),) + features_dim_shape, dtype=np.float32)
+    features_zero_point = np.zeros((len(paths),) + features_dim_shape, dtype=np.int32)
+    for i, path in enumerate(tqdm(paths, desc="Converting features")):
+        with h5py.File(path, "r") as h5_file:
+            features[slide_offsets[i]:slide_offsets[i + 1]] = h5_file["features"][:]
+            coords[slide_offsets[i]:slide_offsets[i + 1]] = h5_file["coords"][:]
+            if quantized:
+                features_scale[i] = h5_file["metadata"].attrs["features_scale"]
+                features_zero_point[i] = h5_file["metadata"].attrs["features_zero_point"]
+    features.flush()
+    coords.flush()
+    coords_keys, coords_order = build_coords_index(np.asarray(coords), slide_offsets)
+    del features, coords
+    np.save(tmp_dir / "slide_offsets.npy", slide_offsets)
+    np.save(tmp_dir / "coords_keys.npy", coords_keys)
+    np.save(tmp_dir / "coords_order.npy", coords_order)
+    np.save(tmp_dir / "slide_names.npy", np.array(slide_names))
+    if quantized:
+        np.save(tmp_dir / "features_scale.npy", features_scale)
+        np.save(tmp_dir / "features_zero_point.npy", features_zero_point)
+
+    if store_dir.exists():
+        shutil.rmtree(store_dir)
+    os.replace(tmp_dir, store_dir)
+    return FeaturesStore(store_dir)
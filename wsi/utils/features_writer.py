@@ -1,26 +1,250 @@
+import hashlib
+import json
+import os
+from collections import deque
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
 from pathlib import Path
+from typing import Deque, Dict, List, Optional, Tuple
 
 import h5py
 import numpy as np
+import torch
 from pytorch_lightning.callbacks import BasePredictionWriter
 
+from .quantization import dequantize_int8, quantize_int8
+
+
+def _get_chunk_rows(row_bytes: int, chunk_bytes: int, rows: int) -> int:
+    return int(max(1, min(rows, chunk_bytes // max(row_bytes, 1))))
+
+
+def get_state_dict_hash(module: torch.nn.Module) -> str:
+    """sha1 of the names and values of the state dict of a module, identifies the weights features were extracted with."""
+    sha = hashlib.sha1()
+    for name, tensor in module.state_dict().items():
+        sha.update(name.encode())
+        sha.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    return sha.hexdigest()
+
+
+class FeaturesManifest:
+    """
+    Completion records of the slides of a resumable extraction, one {slide_name}.json file
+    per slide in {output_dir}/manifest, with the tiles count, the sha1 of the features and
+    of the coords and the hash of the weights. A slide has a record only once its features
+    file is complete.
+    """
+
+    def __init__(self, output_dir):
+        self._manifest_dir = Path(output_dir) / "manifest"
+
+    def _get_path(self, slide_name: str) -> Path:
+        return self._manifest_dir / f"{slide_name}.json"
+
+    def get_entry(self, slide_name: str) -> Optional[Dict]:
+        try:
+            with open(self._get_path(slide_name)) as file:
+                return json.load(file)
+        except FileNotFoundError:
+            return None
+
+    def get_entries(self) -> Dict[str, Dict]:
+        if not self._manifest_dir.is_dir():
+            return {}
+        entries = {}
+        for path in self._manifest_dir.glob("*.json"):
+            with open(path) as file:
+                entry = json.load(file)
+            entries[entry["slide_name"]] = entry
+        return entries
+
+    def write_entry(self, entry: Dict):
+        self._manifest_dir.mkdir(parents=True, exist_ok=True)
+        path = self._get_path(entry["slide_name"])
+        tmp_path = path.with_name(f".{path.name}.tmp-{os.getpid()}")
+        with open(tmp_path, "w") as file:
+            json.dump(entry, file)
+        os.replace(tmp_path, path)
+
+    def get_completed(self, slide_names: np.ndarray, tiles_counts: np.ndarray) -> np.ndarray:
+        """Boolean mask of the slides with a record of the expected tiles count."""
+        entries = self.get_entries()
+        return np.array(
+            [
+                name in entries and entries[name]["tiles_count"] == count
+                for name, count in zip(slide_names, tiles_counts)
+            ],
+            dtype=bool,
+        )
+
+
+def _create_dataset(file: h5py.File, key: str, val: np.ndarray, chunk_bytes: int, compression: Optional[str]):
+    row_bytes = val.dtype.itemsize * int(np.prod(val.shape[1:]))
+    file.create_dataset(
+        key,
+        data=val,
+        maxshape=(None,) + val.shape[1:],
+        chunks=(_get_chunk_rows(row_bytes, chunk_bytes, val.shape[0]),) + val.shape[1:],
+        compression=compression,
+    )
+
+
+def _read_float_features(file: h5py.File) -> np.ndarray:
+    features = file["features"][:]
+    if features.dtype == np.int8:
+        metadata = file["metadata"].attrs
+        features = dequantize_int8(features, metadata["features_scale"], metadata["features_zero_point"])
+    return features
+
+
+def _write_slide_h5(
+    path: Path,
+    asset_dict: Dict[str, np.ndarray],
+    attr_dict: Dict,
+    chunk_bytes: int,
+    compression: Optional[str],
+    truncate: bool = False,
+    quantization_axis: Optional[str] = None,
+    final_path: Optional[Path] = None,
+    manifest: Optional[FeaturesManifest] = None,
+    manifest_entry: Optional[Dict] = None,
+):
+    # runs on the writer thread or process, appends if the file already has the datasets.
+    # With quantization_axis the slide is complete and its features are quantized to int8 as a whole.
+    with h5py.File(path, "w" if truncate else "a") as file:
+        metadata = file.require_group("metadata")
+        for key, val in attr_dict.items():
+            metadata.attrs[key] = val
+        asset_dict = dict(asset_dict)
+        features = asset_dict.pop("features", None)
+        for key, val in asset_dict.items():
+            if key not in file:
+                _create_dataset(file, key, val, chunk_bytes, compression)
+            else:
+                dset = file[key]
+                dset.resize(len(dset) + val.shape[0], axis=0)
+                dset[-val.shape[0]:] = val
+
+        if features is not None and "features" in file:
+            if quantization_axis is not None or file["features"].dtype == np.int8:
+                # rows of a slide written in parts (or by an earlier run) are joined before quantization
+                features = np.concatenate([_read_float_features(file), features.astype(np.float32)])
+                del file["features"]
+            else:
+                dset = file["features"]
+                dset.resize(len(dset) + features.shape[0], axis=0)
+                dset[-features.shape[0]:] = features
+                features = None
+        elif features is None and quantization_axis is not None and "features" in file:
+            features = _read_float_features(file)
+            del file["features"]
+        if features is not None:
+            if quantization_axis is not None:
+                features, scale, zero_point = quantize_int8(features, axis=quantization_axis)
+                metadata.attrs["features_scale"] = scale
+                metadata.attrs["features_zero_point"] = zero_point
+            _create_dataset(file, "features", features, chunk_bytes, compression)
+
+        if manifest is not None:
+            manifest_entry = dict(
+                manifest_entry,
+                tiles_count=int(file["features"].shape[0]),
+                features_sha1=hashlib.sha1(np.ascontiguousarray(file["features"][:]).tobytes()).hexdigest(),
+                coords_sha1=hashlib.sha1(np.ascontiguousarray(file["coords"][:]).tobytes()).hexdigest(),
+                dtype=file["features"].dtype.name,
+            )
+
+    # resumable extraction, the complete file replaces any older one and only then is recorded
+    if final_path is not None:
+        os.replace(path, final_path)
+    if manifest is not None:
+        manifest.write_entry(manifest_entry)
+
 
 class FeaturesWriter(BasePredictionWriter):
-    """Callback to save extracted features from the model in h5 format"""
+    """
+    Callback to save extracted features from the model in h5 format, one {slide}_features.h5
+    file per slide.
 
-    def __init__(self, output_dir="./features", half_precision=False):
+    Features and coords are buffered per slide and a slide is written once, in one piece,
+    when a batch without it arrives (the prediction dataloader goes over the slides in
+    order) or on predict end. The writes run on a background thread, or a process with
+    writer_process=True, so the prediction loop does not wait on the disk. The buffered and
+    the queued features are bounded by max_buffer_bytes: above it the largest buffered
+    slides are written early (and appended to later), and the writer waits for queued writes.
+    Datasets are chunked in chunks of about chunk_bytes, optionally compressed.
+
+    With resumable=True a slide is written to a temporary file that replaces its features
+    file once the slide is complete, and is then recorded in a FeaturesManifest. Together
+    with SlideShardedSampler, which WsiDataModule uses for predict when it finds a resumable
+    writer, completed slides are skipped on restart and the other slides are rewritten.
+    This needs the tiles of every slide to arrive in order, in one piece.
+
+    With quantization="int8" features are stored as int8 with a float32 scale and an int32
+    zero point per slide, for every dimension or for the whole slide (quantization_axis), in
+    the features_scale and features_zero_point metadata attrs. Quantization runs on the
+    writer once a slide is complete, a slide written in several parts is kept in float
+    until then.
+    """
+
+    def __init__(
+        self,
+        output_dir="./features",
+        half_precision=False,
+        max_buffer_bytes: int = 1 << 30,
+        chunk_bytes: int = 1 << 20,
+        compression: Optional[str] = None,
+        writer_process: bool = False,
+        resumable: bool = False,
+        quantization: Optional[str] = None,
+        quantization_axis: str = "dimension",
+    ):
         super().__init__(write_interval="batch")
 
         self._slide_num = 0
         self.half_precision = half_precision
+        self.max_buffer_bytes = max_buffer_bytes
+        self.chunk_bytes = chunk_bytes
+        self.compression = compression
+        self.writer_process = writer_process
+        self.resumable = resumable
+        if quantization not in (None, "int8"):
+            raise ValueError(f"Unknown quantization {quantization}, expected None or int8")
+        self.quantization = quantization
+        self.quantization_axis = quantization_axis
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
-        if any(self.output_dir.iterdir()):
+        self.manifest = FeaturesManifest(self.output_dir) if resumable else None
+        if resumable:
+            print(
+                f"Resumable extraction, {len(self.manifest.get_entries())} slides in {self.output_dir} are complete"
+            )
+        elif any(self.output_dir.iterdir()):
             print(
                 "WARNING: features output directory is not empty, features from slides with existing files will be appended"
             )
         print(f"Using FeaturesWriter, saving features to {self.output_dir}")
 
+        # slide name -> (coords chunks, features chunks, attrs)
+        self._buffers: Dict[str, Tuple[List[np.ndarray], List[np.ndarray], Dict]] = {}
+        self._buffered_bytes = 0
+        self._pending: Deque[Tuple[Future, int]] = deque()
+        self._pending_bytes = 0
+        self._written_slides = set()
+        self._executor: Optional[Executor] = None
+        self._open_slides: Dict[str, None] = {}  # written or buffered, not complete yet, in order
+        # resumable extraction
+        self._rank = 0
+        self._checkpoint_hash = None
+        self._completed_slides = set()
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            executor_class = ProcessPoolExecutor if self.writer_process else ThreadPoolExecutor
+            # a single writer keeps the appends to a slide in order
+            self._executor = executor_class(max_workers=1)
+        return self._executor
+
     def write_on_batch_end(
         self,
         trainer,
@@ -47,49 +271,114 @@ class FeaturesWriter(BasePredictionWriter):
         slide_switch_indices = np.insert(slide_switch_indices, 0, 0)
         slide_switch_indices = np.append(slide_switch_indices, [len(slide_names_np)])
 
+        batch_slides = set(slide_names)
+        if self.resumable and not batch_slides.isdisjoint(self._completed_slides):
+            raise RuntimeError(
+                "A slide came back after it was completed, resumable extraction needs the tiles of every slide in order, see SlideShardedSampler"
+            )
+        for slide_name in [name for name in self._open_slides if name not in batch_slides]:
+            self._flush_slide(slide_name)
+
         for i in range(len(slide_switch_indices) - 1):
+            start, end = slide_switch_indices[i], slide_switch_indices[i + 1]
+            slide_name = slide_names[start]
+            slide_coords, slide_features, _ = self._buffers.setdefault(
+                slide_name, ([], [], {"name": slide_name, "label": labels[start]})
+            )
+            self._open_slides[slide_name] = None
+            slide_coords.append(coords[start:end])
+            slide_features.append(features[start:end])
+            self._buffered_bytes += coords[start:end].nbytes + features[start:end].nbytes
+
+        while self._buffered_bytes > self.max_buffer_bytes and self._buffers:
+            self._flush_slide(
+                max(self._buffers, key=lambda name: sum(x.nbytes for x in self._buffers[name][1])),
+                complete=False,
+            )
+
+    def on_predict_start(self, trainer, pl_module):
+        if not self.resumable:
+            return
+        self._rank = trainer.global_rank
+        self._checkpoint_hash = get_state_dict_hash(pl_module)
+        if getattr(pl_module, "hparams", {}).get("static_quantization"):
+            # features of the int8 quantized backbone are not interchangeable with the float ones
+            self._checkpoint_hash += "-static-int8"
+        other_checkpoints = {
+            entry["checkpoint_hash"]
+            for entry in self.manifest.get_entries().values()
+            if entry["checkpoint_hash"] != self._checkpoint_hash
+        }
+        if other_checkpoints:
+            raise ValueError(
+                f"{self.output_dir} has features extracted with other weights ({other_checkpoints}), use a new output_dir"
+            )
+
+    def on_predict_end(self, trainer, pl_module):
+        self.flush()
+
+    def flush(self):
+        """Writes all buffered slides and waits for the queued writes."""
+        for slide_name in list(self._open_slides):
+            self._flush_slide(slide_name)
+        while self._pending:
+            self._wait_oldest()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _flush_slide(self, slide_name: str, complete: bool = True):
+        """Writes the buffered rows of a slide, complete=False when more rows of the slide may follow."""
+        # a slide may have no rows left to write, only to be completed
+        slide_coords, slide_features, attr_dict = self._buffers.pop(slide_name, ([], [], {}))
+        asset_dict = {}
+        nbytes = 0
+        if slide_features:
             asset_dict = {
-                "coords": coords[slide_switch_indices[i] : slide_switch_indices[i + 1]],
-                "features": features[
-                    slide_switch_indices[i] : slide_switch_indices[i + 1]
-                ],
+                "coords": np.concatenate(slide_coords),
+                "features": np.concatenate(slide_features),
             }
-            attr_dict = {
-                "name": slide_names[slide_switch_indices[i]],
-                "label": labels[slide_switch_indices[i]],
-            }
-            self._save_hdf5(slide_names[slide_switch_indices[i]], asset_dict, attr_dict)
-
-    def _save_hdf5(self, slide_name, asset_dict, attr_dict=None):
-        file_name = slide_name + "_features.h5"
-        path = self.output_dir / file_name
-
-        mode = "a" if path.exists() else "w"
-        if mode == "w":  # new file
-            print(f"Saving slide features in h5 file: {path}")
-            self._slide_num += 1
-
-        file = h5py.File(path, mode)
-        if attr_dict is not None:
-            metadata = file.require_group("metadata")
-            for key, val in attr_dict.items():
-                metadata.attrs[key] = val
-        for key, val in asset_dict.items():
-            data_shape = val.shape
-            if key not in file:
-                data_type = val.dtype
-                chunk_shape = (1,) + data_shape[1:]
-                maxshape = (None,) + data_shape[1:]
-                dset = file.create_dataset(
-                    key,
-                    shape=data_shape,
-                    maxshape=maxshape,
-                    chunks=chunk_shape,
-                    dtype=data_type,
+            nbytes = sum(val.nbytes for val in asset_dict.values())
+        self._buffered_bytes -= nbytes
+
+        path = self.output_dir / (slide_name + "_features.h5")
+        first_write = slide_name not in self._written_slides
+        if first_write:
+            self._written_slides.add(slide_name)
+            if not path.exists():
+                print(f"Saving slide features in h5 file: {path}")
+                self._slide_num += 1
+
+        write_kwargs = {}
+        if complete:
+            del self._open_slides[slide_name]
+            if self.quantization is not None:
+                write_kwargs["quantization_axis"] = self.quantization_axis
+        if self.resumable:
+            write_kwargs["truncate"] = first_write
+            if complete:
+                self._completed_slides.add(slide_name)
+                write_kwargs.update(
+                    final_path=path,
+                    manifest=self.manifest,
+                    manifest_entry={"slide_name": slide_name, "checkpoint_hash": self._checkpoint_hash},
                 )
-                dset[:] = val
-            else:
-                dset = file[key]
-                dset.resize(len(dset) + data_shape[0], axis=0)
-                dset[-data_shape[0] :] = val
-        file.close()
+            # a partial slide never replaces the features file of an earlier run
+            path = self.output_dir / f".{slide_name}_features.h5.tmp-{self._rank}"
+        if not asset_dict and not write_kwargs:
+            return
+
+        while self._pending and (
+            self._pending[0][0].done() or self._pending_bytes + nbytes > self.max_buffer_bytes
+        ):
+            self._wait_oldest()
+        future = self._get_executor().submit(
+            _write_slide_h5, path, asset_dict, attr_dict, self.chunk_bytes, self.compression, **write_kwargs
+        )
+        self._pending.append((future, nbytes))
+        self._pending_bytes += nbytes
+
+    def _wait_oldest(self):
+        future, nbytes = self._pending.popleft()
+        self._pending_bytes -= nbytes
+        future.result()  # raises the errors of the writer
@@ -0,0 +1,82 @@
+from typing import Optional, Tuple
+
+import numpy as np
+import torch
+
+from .features_store import FeaturesReader
+from ..core.h5_tiles import TileIndex
+
+# int8 features with an affine scale and zero point, x ~ (q - zero_point) * scale.
+# The scale and zero point are (features_dim,) vectors, computed per slide either for every
+# dimension ("dimension") or once for all of them ("slide", the same value in every entry).
+quantization_axes = ("dimension", "slide")
+_int8_min, _int8_max = -128, 127
+
+
+def get_int8_quantization(features: np.ndarray, axis: str = "dimension") -> Tuple[np.ndarray, np.ndarray]:
+    """Returns the float32 scale and int32 zero point of the (N, D) features, the range always includes 0."""
+    if axis not in quantization_axes:
+        raise ValueError(f"Unknown quantization axis {axis}, expected one of {quantization_axes}")
+    features = np.asarray(features, dtype=np.float32)
+    reduce_axis = 0 if axis == "dimension" else None
+    if features.shape[0] > 0:
+        low = np.minimum(features.min(axis=reduce_axis), 0)
+        high = np.maximum(features.max(axis=reduce_axis), 0)
+    else:
+        low = high = np.float32(0)
+    low = np.broadcast_to(low, features.shape[1:]).astype(np.float32)
+    high = np.broadcast_to(high, features.shape[1:]).astype(np.float32)
+    scale = (high - low) / (_int8_max - _int8_min)
+    scale[scale == 0] = 1
+    zero_point = np.clip(np.round(_int8_min - low / scale), _int8_min, _int8_max).astype(np.int32)
+    return scale, zero_point
+
+
+def quantize_int8(
+    features: np.ndarray,
+    axis: str = "dimension",
+    scale: Optional[np.ndarray] = None,
+    zero_point: Optional[np.ndarray] = None,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Quantizes (N, D) features to int8, with the given scale and zero point (values outside
+    their range are clipped) or with ones computed from the features.
+    """
+    if scale is None or zero_point is None:
+        scale, zero_point = get_int8_quantization(features, axis=axis)
+    quantized = np.round(np.asarray(features, dtype=np.float32) / scale) + zero_point
+    return np.clip(quantized, _int8_min, _int8_max).astype(np.int8), scale, zero_point
+
+
+def dequantize_int8(quantized: np.ndarray, scale: np.ndarray, zero_point: np.ndarray) -> np.ndarray:
+    return ((quantized.astype(np.float32) - zero_point) * scale).astype(np.float32)
+
+
+def dequantize_features(x: torch.Tensor, scale: torch.Tensor, zero_point: torch.Tensor) -> torch.Tensor:
+    """Dequantizes a (B, N, D) batch of int8 bags with its (B, D) scales and zero points, on the device of the batch."""
+    return (x.float() - zero_point.unsqueeze(-2).float()) * scale.unsqueeze(-2).float()
+
+
+class QuantizedRoundTripReader(FeaturesReader):
+    """
+    Reads the features of another reader after an int8 quantization round trip of the whole
+    slide, as if they were written quantized. Used to measure the effect of quantization.
+    """
+
+    def __init__(self, reader: FeaturesReader, axis: str = "dimension"):
+        self._reader = reader
+        self._axis = axis
+
+    def get_slide_size(self, slide_name: str) -> int:
+        return self._reader.get_slide_size(slide_name)
+
+    def get_coords(self, slide_name: str) -> np.ndarray:
+        return self._reader.get_coords(slide_name)
+
+    def get_coords_index(self, slide_name: str) -> TileIndex:
+        return self._reader.get_coords_index(slide_name)
+
+    def get_features(self, slide_name: str, rows: np.ndarray) -> np.ndarray:
+        features = self._reader.get_features(slide_name, np.arange(self.get_slide_size(slide_name)))
+        quantized, scale, zero_point = quantize_int8(features, axis=self._axis)
+        return dequantize_int8(quantized[np.asarray(rows, dtype=np.int64)], scale, zero_point)
@@ -1,5 +1,6 @@
+import time
 from pathlib import Path
-from typing import Literal, Optional, Dict
+from typing import Literal, Optional, Dict, List
 
 import pandas as pd
 import numpy as np
@@ -21,9 +22,12 @@ from wsi.models.resnet_custom import resnet50_baseline
 # import wsi_ssl # circular import here for ssl model loading. needs to be taken care of at some point.
 from .models.preact_resnet import PreActResNet50
 from .core import constants
+from .models.slide_metrics import SlideMeanScores
+from .models.static_quantization import get_calibration_loader, quantize_static_int8
+from .utils.embeddings_cache import EmbeddingsCacheMixin
 
 
-class WsiClassifier(LightningModule):
+class WsiClassifier(EmbeddingsCacheMixin, LightningModule):
     """
     WsiClassifier is a PyTorch Lightning module for Whole Slide Image classification tasks. 
     The classifier uses a specified model architecture and applies specific learning rate, 
@@ -60,6 +64,12 @@ class WsiClassifier(LightningModule):
         debug: bool = False,
         drop_rate: float = 0.0,
         log_scores: bool = False,
+        cache_embeddings: bool = False,
+        embeddings_cache_dir_path: str = constants.embeddings_cache_dir_path,
+        static_quantization: bool = False,
+        calibration_patches: int = 256,
+        quantization_backend: str = "fbgemm",
+        auroc_thresholds: Optional[int] = 200,
         **kwargs,
     ):
         """
@@ -81,6 +91,12 @@ class WsiClassifier(LightningModule):
             debug (bool, optional): Whether to run in debug mode. Defaults to False.
             drop_rate (float, optional): Dropout rate. Defaults to 0.0.
             log_scores (bool, optional): Whether to log scores. Defaults to False.
+            cache_embeddings (bool, optional): Whether to train the classifier on cached backbone embeddings, when the backbone is frozen and the datamodule has deterministic_train_patches. Defaults to False.
+            embeddings_cache_dir_path (str, optional): Directory of the embeddings cache, see utils.embeddings_cache.
+            static_quantization (bool, optional): Whether to predict (extract features) with the backbone quantized to int8, calibrated on patches of the predict dataset. CPU only. Defaults to False.
+            calibration_patches (int, optional): Number of predict patches to calibrate the quantization on. Defaults to 256.
+            quantization_backend (str, optional): Quantized kernels, "fbgemm" on x86 or "qnnpack" on ARM. Defaults to "fbgemm".
+            auroc_thresholds (Optional[int], optional): Number of thresholds of the binned training patch AUROC, None for the exact AUROC, which keeps all training scores. Defaults to 200.
             **kwargs: Additional keyword arguments.
         """
         super().__init__()
@@ -98,6 +114,19 @@ class WsiClassifier(LightningModule):
         self.log_params = log_params
         
         self.debug = debug
+        self._embeddings_cache = None
+
+        # accumulated over the training steps, a binned AUROC has a fixed size state
+        self.train_patch_auroc = torchmetrics.AUROC(
+            task="multiclass", num_classes=num_classes, thresholds=auroc_thresholds
+        )
+
+        # evaluation on chunks of slides (see WsiDataModule eval_chunk_size)
+        self.val_slide_scores = SlideMeanScores()
+        self.val_patch_auroc = torchmetrics.AUROC(task="multiclass", num_classes=num_classes)
+        self.test_slide_scores = SlideMeanScores()
+        self.test_patch_auroc = torchmetrics.AUROC(task="multiclass", num_classes=num_classes)
+        self._chunk_slide_names: Dict[int, str] = {}
 
     def forward(self, x):
         return self.classifier(self.backbone(x))
@@ -108,14 +137,47 @@ class WsiClassifier(LightningModule):
     def on_fit_start(self):
         if self.log_params:
             self.logger.watch(self, log="all")
+        if self.hparams.cache_embeddings:
+            self._embeddings_cache = self._create_embeddings_cache()
+
+    def on_predict_start(self):
+        if self.hparams.static_quantization:
+            self.backbone = self._quantize_backbone()
+        self._predict_patches = 0
+        self._predict_start_time = time.perf_counter()
+
+    def on_predict_end(self):
+        # the extraction throughput, to compare the float and the quantized backbones
+        elapsed = time.perf_counter() - self._predict_start_time
+        print(f"Predicted {self._predict_patches} patches in {elapsed:.1f}s, {self._predict_patches / max(elapsed, 1e-9):.1f} patches/s")
+
+    def _quantize_backbone(self) -> nn.Module:
+        if self.device.type != "cpu":
+            raise ValueError("Static int8 quantization runs on CPU, predict with trainer.accelerator=cpu")
+        datamodule = self.trainer.datamodule
+        calibration_loader = get_calibration_loader(
+            datamodule.predict_dataset,
+            num_patches=self.hparams.calibration_patches,
+            batch_size=min(self.hparams.batch_size, self.hparams.calibration_patches),
+            num_workers=datamodule.num_workers,
+        )
+        # the batches the backbone sees in predict_step, normalized by the eval batch transforms with gpu_augment
+        calibration_batches = (
+            datamodule.on_after_batch_transfer(batch, dataloader_idx=0) for batch in calibration_loader
+        )
+        return quantize_static_int8(self.backbone, calibration_batches, backend=self.hparams.quantization_backend)
 
     def training_step(self, batch, batch_idx):
-        x = batch["patch"]
+        # no patches once all embeddings are cached
+        x = batch.get("patch")
         y = batch["label"]
         # if self.debug:
         #     slide_names = batch["slide_name"]
         #     center_pixels = batch["center_pixel"]
-        loss, preds, scores = self.shared_step(x, y)
+        embeddings = None
+        if self._embeddings_cache is not None:
+            embeddings = self._embeddings_cache.get_embeddings(self.backbone, batch)
+        loss, preds, scores = self.shared_step(x, y, embeddings=embeddings)
 
         self.log(
             "train/loss",
@@ -136,38 +198,76 @@ class WsiClassifier(LightningModule):
             batch_size=self.hparams.batch_size,
             sync_dist=True,
         )
-
-        return {"loss": loss, "patch_preds": preds, "patch_scores": scores, "y": y}
-
-    def training_epoch_end(self, outputs):
-        scores = torch.cat([x["patch_scores"] for x in outputs], dim=0).detach().cpu()
-        y = torch.cat([x["y"] for x in outputs], dim=0).cpu()
-#         if self.debug: #TODO: fix
-#             worst_examples = torch.cat([x["loss"].detach().cpu() for x in outputs], dim=0).sort(order="loss")[-100:]
-#             best_examples = torch.cat([x[["loss", "slide_names"]] for x in outputs], dim=0).detach().cpu().sort(order="loss")[:100]
-#             self.log(
-#                 "train/worst_examples",
-#                 worst_examples,
-#                 logger=True
-#             )
-#             self.log(
-#                 "train/best_examples",
-#                 best_examples,
-#                 logger=True
-#             )
-#             grid = torchvision.utils.make_grid(sample_imgs) 
-#             self.logger.experiment.add_image('worst examples', grid, 0) 
-            
+        self.train_patch_auroc.update(scores.detach(), y)
         self.log(
             "train/patch_auc",
-            auroc(scores, y, task="multiclass", num_classes=self.num_classes),
+            self.train_patch_auroc,
+            on_step=False,
+            on_epoch=True,
             prog_bar=True,
             logger=True,
-            sync_dist=True,
         )
-        
+
+        return loss
+
+    def _chunks_step(self, batch, slide_scores: SlideMeanScores, patch_auroc: torchmetrics.AUROC):
+        # a batch of chunks of SlideStridedChunksDataset, the scores are accumulated per slide
+        mask = batch["mask"].flatten()
+        x = batch["bag"].flatten(0, 1)[mask]
+        y = batch["label"].flatten(0, 1)[mask]
+        slide_idx = batch["slide_idx"].repeat_interleave(batch["mask"].shape[1])[mask]
+        loss, patch_preds, patch_scores = self.shared_step(x, y)
+        slide_scores.update(patch_scores, slide_idx, y, slides_count=int(batch["slides_count"][0]))
+        patch_auroc.update(patch_scores, y)
+        self._chunk_slide_names.update(zip(batch["slide_idx"].tolist(), batch["slide_name"]))
+        return loss, patch_preds, y
+
+    def _log_chunks_epoch_end(self, stage: str, slide_scores: SlideMeanScores, patch_auroc: torchmetrics.AUROC):
+        # the metrics are synced across ranks, every rank has all slides
+        slide_idx, scores, slide_labels, _ = slide_scores.compute()
+        slide_labels = slide_labels.long()
+        slide_preds = scores.argmax(dim=1)
+        self.log(
+            f"{stage}/slide_acc",
+            accuracy(slide_preds, slide_labels, task="multiclass", num_classes=self.num_classes),
+            logger=True,
+        )
+        self.log(f"{stage}/patch_auc", patch_auroc.compute(), prog_bar=True, logger=True)
+        self.log(
+            f"{stage}/slide_auc",
+            auroc(scores, slide_labels, task="multiclass", num_classes=self.num_classes),
+            prog_bar=True,
+            logger=True,
+        )
+        slide_scores.reset()
+        patch_auroc.reset()
+        return slide_idx.cpu(), scores.cpu(), slide_labels.cpu(), slide_preds.cpu()
+
+    def _get_chunk_slide_names(self, slide_idx: torch.Tensor) -> List[str]:
+        names = dict(self._chunk_slide_names)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            gathered = [None] * torch.distributed.get_world_size()
+            torch.distributed.all_gather_object(gathered, names)
+            for rank_names in gathered:
+                names.update(rank_names)
+        self._chunk_slide_names = {}
+        return [names.get(idx, str(idx)) for idx in slide_idx.tolist()]
 
     def validation_step(self, batch, batch_idx):
+        if "slide_idx" in batch:
+            loss, patch_preds, y = self._chunks_step(batch, self.val_slide_scores, self.val_patch_auroc)
+            self.log("val/loss", loss, on_epoch=True, prog_bar=True, logger=True, batch_size=y.shape[0], sync_dist=True)
+            self.log(
+                "val/patch_acc",
+                accuracy(patch_preds, y, task="multiclass", num_classes=self.num_classes),
+                on_epoch=True,
+                prog_bar=False,
+                logger=True,
+                batch_size=y.shape[0],
+                sync_dist=True,
+            )
+            return None
+
         x = batch["bag"]
         y = batch["label"]
         slide_name = batch["slide_name"]
@@ -218,6 +318,13 @@ class WsiClassifier(LightningModule):
 
 
     def validation_epoch_end(self, outputs_for_rank):
+        if not self.val_slide_scores.empty:
+            _, slide_scores, slide_labels, _ = self._log_chunks_epoch_end("val", self.val_slide_scores, self.val_patch_auroc)
+            self._chunk_slide_names = {}
+            if isinstance(self.logger, WandbLogger) and self.trainer.is_global_zero:
+                self.logger.experiment.log({"val/slide_roc": wandb.plot.roc_curve(slide_labels, slide_scores)})
+            return
+
         outputs = self.all_gather(outputs_for_rank)
         patch_scores = (
             torch.cat([x["patch_scores"][i] for i in range(torch.distributed.get_world_size()) for x in outputs], dim=0).detach().cpu()
@@ -340,6 +447,10 @@ class WsiClassifier(LightningModule):
             self.logger.experiment.log({"val/conf_mat": cm})
 
     def test_step(self, batch, batch_idx):
+        if "slide_idx" in batch:
+            self._chunks_step(batch, self.test_slide_scores, self.test_patch_auroc)
+            return None
+
         x = batch["bag"]
         y = batch["label"]
         slide_name = batch["slide_name"]
@@ -364,6 +475,20 @@ class WsiClassifier(LightningModule):
         }
 
     def test_epoch_end(self, outputs):
+        if not self.test_slide_scores.empty:
+            slide_idx, slide_scores, slide_labels, _ = self._log_chunks_epoch_end(
+                "test", self.test_slide_scores, self.test_patch_auroc
+            )
+            slide_names = self._get_chunk_slide_names(slide_idx)
+            if self.num_classes > 2 or not self.trainer.is_global_zero:
+                return
+            df = pd.DataFrame(
+                data={"slide_name": slide_names, "score": slide_scores[:, 1], "label": slide_labels}
+            )
+            log_dir = self.logger.experiment.dir if isinstance(self.logger, WandbLogger) else self.logger.log_dir
+            df.to_csv(Path(log_dir) / "slide_scores.csv")
+            return
+
         positive_patch_scores_per_slide = (
             torch.vstack([item['patch_scores'][:, 1].flatten() for item in outputs]).detach().cpu()
         )
@@ -468,10 +593,11 @@ class WsiClassifier(LightningModule):
     def predict_step(self, batch, batch_idx):
         x = batch["patch"]
         features = self.forward_features(x)
+        self._predict_patches += x.shape[0]
         return features
 
-    def shared_step(self, x, y):
-        logits = self(x)
+    def shared_step(self, x, y, embeddings=None):
+        logits = self(x) if embeddings is None else self.classifier(embeddings)
         loss = self.criterion(logits, y)
         preds = torch.argmax(logits, dim=1)
         scores = logits.softmax(1)
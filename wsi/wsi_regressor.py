@@ -13,7 +13,7 @@ from pytorch_lightning.loggers import WandbLogger
 from torch import nn
 from torchmetrics.functional.regression import r2_score, mse, mean_absolute_error
 from torchmetrics.functional.classification import auroc
-from .models.metrics import c_index
+from .models.metrics import c_index, c_index_bootstrap
 
 from .models.loss import CoxPHLoss, DeepHitLoss, NaiveCensoredPinballLoss
 from pycox.evaluation.eval_surv import EvalSurv # Use later
@@ -23,9 +23,10 @@ sys.path.append("../wsi-ssl")
 import wsi_ssl # circular import here for ssl model loading. needs to be taken care of at some point.
 from .models.preact_resnet import PreActResNet50
 from .core import constants
+from .utils.embeddings_cache import EmbeddingsCacheMixin
 
 
-class WsiRegressor(LightningModule):
+class WsiRegressor(EmbeddingsCacheMixin, LightningModule):
     """
     WsiRegressor is a PyTorch Lightning module for Whole Slide Image regression tasks. 
     The regressor uses a specified model architecture and applies specific learning rate, 
@@ -63,6 +64,8 @@ class WsiRegressor(LightningModule):
         survival = False,
         quantile_to_predict = 0.1,
         log_preds = False,
+        cache_embeddings: bool = False,
+        embeddings_cache_dir_path: str = constants.embeddings_cache_dir_path,
         **kwargs,
     ):
         """
@@ -82,6 +85,8 @@ class WsiRegressor(LightningModule):
             train_regressor_from_scratch (bool, optional): Whether to train the regressor from scratch. Defaults to False.
             debug (bool, optional): Whether to run in debug mode. Defaults to False.
             drop_rate (float, optional): Dropout rate. Defaults to 0.0.
+            cache_embeddings (bool, optional): Whether to train the regressor on cached backbone embeddings, when the backbone is frozen and the datamodule has deterministic_train_patches. Defaults to False.
+            embeddings_cache_dir_path (str, optional): Directory of the embeddings cache, see utils.embeddings_cache.
             **kwargs: Additional keyword arguments.
         """
         super().__init__()
@@ -92,11 +97,18 @@ class WsiRegressor(LightningModule):
             model, ckpt_path, imagenet_pretrained, finetune, train_regressor_from_scratch, drop_rate
         )
 
+        # epoch metrics, accumulated over the training steps with fixed size states
+        self.train_loss = torchmetrics.MeanMetric()
+        self.train_r2 = torchmetrics.R2Score()
+        self.train_mse = torchmetrics.MeanSquaredError()
+        self.train_mae = torchmetrics.MeanAbsoluteError()
+
         self.loss = self.init_loss(loss, quantile_to_predict)
 
         self.log_params = log_params
         
         self.debug = debug
+        self._embeddings_cache = None
 
     def init_loss(self, loss, quantile_to_predict):
         if loss == "MSE":
@@ -115,14 +127,26 @@ class WsiRegressor(LightningModule):
     def forward_features(self, x):
         return self.backbone(x)
 
+    def setup(self, stage=None):
+        # validation_step and test_step take a slide per batch, not chunks of many slides
+        datamodule = self.trainer.datamodule if self.trainer is not None else None
+        if getattr(datamodule, "eval_chunk_size", None) is not None:
+            raise ValueError("WsiRegressor does not support eval_chunk_size, evaluate one slide per batch")
+
     def on_fit_start(self):
         if self.log_params:
             self.logger.watch(self, log="all")
+        if self.hparams.cache_embeddings:
+            self._embeddings_cache = self._create_embeddings_cache()
 
     def training_step(self, batch, batch_idx):
-        x = batch["patch"]
+        # no patches once all embeddings are cached
+        x = batch.get("patch")
         y = batch["label"]
-        loss, preds = self.shared_step(x, y)
+        embeddings = None
+        if self._embeddings_cache is not None:
+            embeddings = self._embeddings_cache.get_embeddings(self.backbone, batch)
+        loss, preds = self.shared_step(x, y, embeddings=embeddings)
 
         self.log(
             "train/step_loss",
@@ -135,51 +159,18 @@ class WsiRegressor(LightningModule):
             sync_dist=True,
         )
 
-        return {"loss": loss, "patch_preds": preds, "y": y}
+        self.train_loss.update(loss.detach())
+        self.log("train/loss", self.train_loss, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+        if not self.hparams.survival:
+            preds, y = preds.detach().flatten(), y.flatten()
+            self.train_r2.update(preds, y)
+            self.train_mse.update(preds, y)
+            self.train_mae.update(preds, y)
+            self.log("train/r2_score", self.train_r2, on_step=False, on_epoch=True, logger=True)
+            self.log("train/MSE", self.train_mse, on_step=False, on_epoch=True, logger=True)
+            self.log("train/mean_absolute_error", self.train_mae, on_step=False, on_epoch=True, logger=True)
 
-    def training_epoch_end(self, outputs):
-        preds = torch.cat([x["patch_preds"] for x in outputs], dim=0).detach().cpu()
-        loss = torch.cat([x["loss"].reshape(1) for x in outputs], dim=0).detach().cpu()
-        y = torch.cat([x["y"] for x in outputs], dim=0).cpu()
-            
-        self.log(
-            "train/loss",
-            loss.mean(),
-            prog_bar=True,
-            logger=True,
-            sync_dist=True,
-        )
-        if self.hparams.survival:
-            pass
-        else:
-            self.log(
-                "train/r2_score",
-                r2_score(preds, y),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
-            self.log(
-                "train/MSE",
-                mse(preds, y),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
-            self.log(
-                "train/mean_absolute_error",
-                mean_absolute_error(preds, y),
-                on_epoch=True,
-                prog_bar=False,
-                logger=True,
-                batch_size=self.hparams.batch_size,
-                sync_dist=True,
-            )
-        
+        return loss
 
     def validation_step(self, batch, batch_idx):
         x = batch["bag"]
@@ -346,14 +337,10 @@ class WsiRegressor(LightningModule):
         slide_labels = torch.stack([x["slide_label"] for x in outputs]).cpu()
 
         if self.hparams.survival:
-            self.log(
-                "test/c_index",
-                c_index(
-                    slide_preds,
-                    slide_labels
-                ),
-                logger=True,
-            )
+            c_index_value, c_index_lower, c_index_upper = c_index_bootstrap(slide_preds, slide_labels)
+            self.log("test/c_index", c_index_value, logger=True)
+            self.log("test/c_index_ci_lower", c_index_lower, logger=True)
+            self.log("test/c_index_ci_upper", c_index_upper, logger=True)
 
         else:
             self.log(
@@ -419,8 +406,8 @@ class WsiRegressor(LightningModule):
         features = self.forward_features(x)
         return features
 
-    def shared_step(self, x, y):
-        preds = self(x)
+    def shared_step(self, x, y, embeddings=None):
+        preds = self(x) if embeddings is None else self.regressor(embeddings)
         loss = self.loss(preds, y)
         if preds.isnan().any():
             print("some preds are none")